@@ -0,0 +1,115 @@
+'''
+Registry of the ZigBee attributes reported by Saturn South meters
+
+Attributes are identified by (cluster id, cluster manufacturer, attribute id)
+and carry a field name, units, divisor and type. The tables come from the
+device manuals:
+  - SS9000 Mini Smart Meter / SS9007 Mini CT Meter (see Single_phase_meter)
+  - SS9005 Mini Three Phase Meter, which reports phases A, B and C on
+    endpoints 1-3 and the three phase aggregate on endpoint 4
+
+The registry is flattened into lookup arrays once at import, so that all of
+the values in a message can be scaled with a single NumPy operation.
+
+'''
+
+import numpy as np
+import SSMessages_8834 as M
+
+# Attribute types
+FLOAT = "float"     # scaled by the divisor
+INT = "int"         # stored as reported (divisor is 1)
+STRING = "string"
+
+BASIC = (M.ClusterParts.Basic.ClusterId, M.ClusterParts.Basic.ClusterManufacturer)
+ON_OFF = (M.ClusterParts.OnOff.ClusterId, M.ClusterParts.OnOff.ClusterManufacturer)
+SM = (M.ClusterParts.SM.ClusterId, M.ClusterParts.SM.ClusterManufacturer)
+
+class Attribute():
+
+    def __init__(self, cluster, attr_id, name, unit, divisor, attr_type):
+        self.cluster_id, self.manufacturer = cluster
+        self.attr_id = attr_id
+        self.name = name
+        self.unit = unit
+        self.divisor = divisor
+        self.attr_type = attr_type
+
+    def key(self):
+        return (self.cluster_id, self.manufacturer, self.attr_id)
+
+ATTRIBUTES = [
+    # Basic cluster (all devices)
+    Attribute(BASIC, 0, "zcl_version", None, 1, INT),
+    Attribute(BASIC, 1, "application_version", None, 1, INT),
+    Attribute(BASIC, 2, "stack_version", None, 1, INT),
+    Attribute(BASIC, 3, "hardware_version", None, 1, INT),
+    Attribute(BASIC, 4, "manufacturer_name", None, 1, STRING),
+    Attribute(BASIC, 5, "model_identifier", None, 1, STRING),
+    Attribute(BASIC, 6, "date_code", None, 1, STRING),
+    Attribute(BASIC, 7, "power_source", None, 1, INT),
+    Attribute(BASIC, 16, "location_description", None, 1, STRING),
+    Attribute(BASIC, 18, "device_enabled", None, 1, INT),
+
+    # On/Off cluster
+    Attribute(ON_OFF, 0, "switch_state", None, 1, INT),
+    Attribute(ON_OFF, 57726, "switch_safe_state", None, 1, INT),            # SS9005 only
+
+    # Simple Metering cluster - Saturn South extended attributes
+    Attribute(SM, 57610, "voltage", "V", 100, FLOAT),
+    Attribute(SM, 57628, "current", "A", 100, FLOAT),
+    Attribute(SM, 57646, "power_w", "W", 1, INT),
+    Attribute(SM, 57649, "power_var", "var", 1, INT),
+    Attribute(SM, 57655, "power_factor", None, 1000, FLOAT),
+    Attribute(SM, 57664, "energy_import_wh", "Wh", 1, INT),
+    Attribute(SM, 57665, "energy_import_varh", "varh", 1, INT),
+    Attribute(SM, 57667, "frequency", "Hz", 100, FLOAT),
+    Attribute(SM, 57676, "temperature", "C", 100, FLOAT),                   # SS9000/SS9007 only
+    Attribute(SM, 57721, "energy_export_wh", "Wh", 1, INT),
+    Attribute(SM, 57722, "energy_export_varh", "varh", 1, INT),
+    Attribute(SM, 57723, "phase_angle_ab", "deg", 100, FLOAT),              # SS9005 endpoint 4
+    Attribute(SM, 57724, "phase_angle_bc", "deg", 100, FLOAT),              # SS9005 endpoint 4
+    Attribute(SM, 57725, "maximum_current", "A", 100, FLOAT),               # SS9005 endpoint 1
+]
+
+# Row used for attributes that aren't in the registry
+UNKNOWN = 0
+
+class AttributeRegistry():
+
+    def __init__(self, attributes):
+        # Row 0 is reserved for unknown attributes: numeric values pass through unscaled
+        self.rows = {}
+        self.names = [None]
+        self.units = [None]
+        self.types = [INT]
+        divisors = [1]
+        for each_attr in attributes:
+            self.rows[each_attr.key()] = len(self.names)
+            self.names.append(each_attr.name)
+            self.units.append(each_attr.unit)
+            self.types.append(each_attr.attr_type)
+            divisors.append(each_attr.divisor)
+        self.divisors = np.array(divisors, dtype=np.float64)
+        self.is_scaled = np.array([t == FLOAT for t in self.types], dtype=bool)
+
+    def __len__(self):
+        return len(self.names) - 1
+
+    def row(self, cluster_id, manufacturer, attr_id):
+        return self.rows.get((cluster_id, manufacturer, attr_id), UNKNOWN)
+
+    def name(self, row, attr_id):
+        # Unknown attributes keep their numeric id as the name so nothing is lost
+        if row == UNKNOWN:
+            return str(attr_id)
+        return self.names[row]
+
+    def scale(self, rows, values):
+        # Scale a whole batch of raw numeric values by their divisors in one go
+        return np.asarray(values, dtype=np.float64) / self.divisors[rows]
+
+registry = AttributeRegistry(ATTRIBUTES)
+
+def attribute_name(cluster_id, manufacturer, attr_id):
+    return registry.name(registry.row(cluster_id, manufacturer, attr_id), attr_id)
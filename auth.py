@@ -0,0 +1,228 @@
+'''
+ESBox authentication
+
+Every container carries an Auth field of [ESBox IEEE, link key]. Link keys
+are checked against a credential store: a file with one line per ESBox,
+
+    <ESBox IEEE> <salt> <iterations> <PBKDF2-SHA256 hash of the link key>
+
+so the keys themselves are never kept on the ESCo. Hashing is deliberately
+slow, so verified (IEEE, link key) pairs are remembered in an LRU cache for
+CACHE_TTL seconds and the common case - a box we've already seen checking in
+again - is a dict hit (cached()). Anything else needs a hash (verify()), which
+the server does in a thread rather than on the reactor.
+
+Wrong keys aren't cached, so they can't push verified pairs out of the cache.
+Instead each IEEE gets MAX_FAILURES wrong keys per FAILURE_WINDOW seconds, after
+which its keys are refused without being hashed until the window is up. A box
+with a bad key, or something trying keys for a known IEEE, costs a handful of
+hashes a minute. A box whose key was verified recently is still let in.
+
+The store is reloaded when the file changes, which is only checked on a
+cache miss.
+
+Usage:
+
+    python auth.py add <ESBox IEEE> <link key>
+    python auth.py remove <ESBox IEEE>
+
+'''
+
+from collections import OrderedDict
+import argparse
+import binascii
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+DEFAULT_CREDENTIALS_FILE = "credentials"
+CACHE_SIZE = 100000
+CACHE_TTL = 3600 # sec
+MAX_FAILURES = 5 # wrong keys hashed per ESBox IEEE per FAILURE_WINDOW
+FAILURE_WINDOW = 60 # sec
+HASH_ITERATIONS = 10000
+SALT_LENGTH = 16
+
+def as_ascii(value):
+    # IEEEs and link keys are hex. Those decoded from JSON are unicode, which has to be made
+    # bytes before hashing or it hashes differently. Raises UnicodeError if it's not ASCII.
+    return value.upper().encode("ascii")
+
+def hash_link_key(link_key, salt, iterations):
+    return hashlib.pbkdf2_hmac("sha256", as_ascii(link_key), salt, iterations)
+
+class Credential():
+
+    def __init__(self, salt, iterations, key_hash):
+        self.salt = salt
+        self.iterations = iterations
+        self.key_hash = key_hash
+
+    def matches(self, link_key):
+        return hmac.compare_digest(hash_link_key(link_key, self.salt, self.iterations), self.key_hash)
+
+class CredentialStore():
+
+    def __init__(self, path=DEFAULT_CREDENTIALS_FILE):
+        self.path = path
+        self.credentials = {}
+        self.mtime = None
+        self.lock = threading.Lock()
+
+    def _reload_if_changed(self):
+        # Caller holds the lock
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        credentials = {}
+        if mtime is not None:
+            with open(self.path) as credentials_file:
+                for each_line in credentials_file:
+                    parts = each_line.split()
+                    if len(parts) != 4 or parts[0].startswith("#"):
+                        continue
+                    esbox_id, salt, iterations, key_hash = parts
+                    credentials[esbox_id.upper()] = Credential(binascii.unhexlify(salt), int(iterations),
+                                                               binascii.unhexlify(key_hash))
+        self.credentials = credentials
+        self.mtime = mtime
+
+    def lookup(self, esbox_id):
+        esbox_id = as_ascii(esbox_id)
+        with self.lock:
+            self._reload_if_changed()
+            return self.credentials.get(esbox_id)
+
+    def set(self, esbox_id, link_key, iterations=HASH_ITERATIONS):
+        esbox_id = as_ascii(esbox_id)
+        salt = os.urandom(SALT_LENGTH)
+        credential = Credential(salt, iterations, hash_link_key(link_key, salt, iterations))
+        with self.lock:
+            self._reload_if_changed()
+            self.credentials[esbox_id] = credential
+            self._save()
+
+    def remove(self, esbox_id):
+        esbox_id = as_ascii(esbox_id)
+        with self.lock:
+            self._reload_if_changed()
+            self.credentials.pop(esbox_id, None)
+            self._save()
+
+    def _save(self):
+        # Caller holds the lock
+        with open(self.path + ".tmp", "w") as credentials_file:
+            for esbox_id, credential in sorted(self.credentials.iteritems()):
+                credentials_file.write("%s %s %d %s\n" % (esbox_id, binascii.hexlify(credential.salt),
+                                                          credential.iterations, binascii.hexlify(credential.key_hash)))
+        os.rename(self.path + ".tmp", self.path)
+        self.mtime = os.stat(self.path).st_mtime
+
+class Authenticator():
+
+    def __init__(self, store, cache_size=CACHE_SIZE, ttl=CACHE_TTL, max_failures=MAX_FAILURES,
+                 failure_window=FAILURE_WINDOW):
+        self.store = store
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.max_failures = max_failures
+        self.failure_window = failure_window
+        # (ESBox IEEE, link key) -> expiry time of each verified pair, least recently used first
+        self.cache = OrderedDict()
+        # ESBox IEEE (as ASCII) -> (wrong keys hashed, start of the window they were counted in)
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def cached(self, auth, now=None):
+        # Returns True or False if a container's Auth field can be checked without hashing its
+        # link key, or None if it needs verify()
+        try:
+            esbox_id, link_key = auth
+            key = (esbox_id, link_key)
+            hash(key)
+            failures_key = as_ascii(esbox_id)
+        except (AttributeError, TypeError, ValueError):
+            # Not an IEEE and a key, not strings, or not ASCII (UnicodeError is a ValueError)
+            return False
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            expiry = self.cache.pop(key, None)
+            if expiry is not None and expiry > now:
+                self.cache[key] = expiry
+                return True
+            failures = self.failures.get(failures_key)
+            if failures is not None:
+                if now - failures[1] >= self.failure_window:
+                    del self.failures[failures_key]
+                elif failures[0] >= self.max_failures:
+                    return False
+        return None
+
+    def verify(self, auth, now=None):
+        # Returns True if a container's Auth field holds a known ESBox IEEE and its link key.
+        # Hashes the key unless cached() can answer, so call it from a thread.
+        if now is None:
+            now = time.time()
+        verified = self.cached(auth, now)
+        if verified is not None:
+            return verified
+
+        esbox_id, link_key = auth
+        try:
+            credential = self.store.lookup(esbox_id)
+            if credential is None:
+                # Nothing was hashed, so there's nothing to limit
+                return False
+            verified = credential.matches(link_key)
+        except (AttributeError, TypeError, ValueError):
+            return False
+
+        with self.lock:
+            if verified:
+                self.cache[(esbox_id, link_key)] = now + self.ttl
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            else:
+                failures_key = as_ascii(esbox_id)
+                num_failures, window_start = self.failures.get(failures_key, (0, now))
+                self.failures[failures_key] = (num_failures + 1, window_start)
+        return verified
+
+    def forget(self, esbox_id=None):
+        # Drop cached verifications (and failures) for one ESBox or all of them, e.g. after
+        # changing its key
+        with self.lock:
+            if esbox_id is None:
+                self.cache.clear()
+                self.failures.clear()
+                return
+            for each_key in [key for key in self.cache if key[0] == esbox_id]:
+                del self.cache[each_key]
+            self.failures.pop(as_ascii(esbox_id), None)
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the ESBox credential store")
+    parser.add_argument("--file", default=DEFAULT_CREDENTIALS_FILE)
+    subparsers = parser.add_subparsers(dest="command")
+    add_parser = subparsers.add_parser("add", help="add an ESBox or change its link key")
+    add_parser.add_argument("esbox")
+    add_parser.add_argument("link_key")
+    remove_parser = subparsers.add_parser("remove", help="remove an ESBox")
+    remove_parser.add_argument("esbox")
+    args = parser.parse_args()
+
+    store = CredentialStore(args.file)
+    if args.command == "add":
+        store.set(args.esbox, args.link_key)
+    else:
+        store.remove(args.esbox)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+'''
+Microbenchmark: decoding and walking one ESBox container
+
+Times the work render_PUT does on the SendData container in Raw_data, per
+container:
+  - before: json.loads, then walking the container with every key looked up
+    through SSMessages_8834 (M.F.Dat.Attributes_1_1 and so on)
+  - after:  jsoncodec.loads, then the same walk with the keys from keys.py
+  - points: jsoncodec.loads plus building the database points with
+    PointBuilder, i.e. everything process_data() does before the write
+
+Usage:
+
+    python bench_decode.py [number of repeats]
+
+'''
+
+import ast
+import json
+import os
+import sys
+import timeit
+
+import SSMessages_8834 as M
+import jsoncodec
+from keys import MESSAGES, DATA, HAN, ENDPOINT_ID, CLUSTERS, CLUSTER, ATTRIBUTES, ATTRIBUTE_ID, TIME
+from points import PointBuilder
+
+# Next to this file, wherever the benchmark is run from
+RAW_DATA_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Raw_data")
+DEFAULT_REPEATS = 20000
+
+def load_raw_container(filename=RAW_DATA_FILENAME):
+    # The first complete SendData container logged in Raw_data, as the JSON an ESBox would send
+    with open(filename) as raw_file:
+        for each_line in raw_file:
+            if each_line.startswith("{") and M.SS_ESB.E.SendData in each_line:
+                try:
+                    return json.dumps(ast.literal_eval(each_line.strip()))
+                except (SyntaxError, ValueError):
+                    continue
+    raise ValueError("No SendData container found in %s" % filename)
+
+def walk_before(data):
+    num_attributes = 0
+    json_data = json.loads(data)
+    for each_message in json_data[M.F.Gen.Messages_1_1]:
+        for each_han_endpoint in each_message[M.F.Dat.Data_1_1]:
+            han = each_han_endpoint[M.F.Nwk.HAN_1_1]
+            endpoint_id = each_han_endpoint[M.F.Nwk.EndpointID_1_1]
+            for each_cluster in each_han_endpoint[M.F.Dat.Clusters_1_1]:
+                cluster = each_cluster[M.F.Gen.Cluster_1_1]
+                for each_attr in each_cluster[M.F.Dat.Attributes_1_1]:
+                    attr = (han, endpoint_id, cluster[M.F.Gen.ClusterID_1_1], each_attr[M.F.Dat.AttributeID_1_1],
+                            each_attr.get(M.F.Dat.Time_1_1), each_attr[M.F.Dat.Data_1_1])
+                    num_attributes += 1
+    return num_attributes
+
+def walk_after(data):
+    num_attributes = 0
+    json_data = jsoncodec.loads(data)
+    for each_message in json_data[MESSAGES]:
+        for each_han_endpoint in each_message[DATA]:
+            han = each_han_endpoint[HAN]
+            endpoint_id = each_han_endpoint[ENDPOINT_ID]
+            for each_cluster in each_han_endpoint[CLUSTERS]:
+                cluster = each_cluster[CLUSTER]
+                for each_attr in each_cluster[ATTRIBUTES]:
+                    attr = (han, endpoint_id, cluster, each_attr[ATTRIBUTE_ID], each_attr.get(TIME), each_attr[DATA])
+                    num_attributes += 1
+    return num_attributes
+
+def build_points(data):
+    json_data = jsoncodec.loads(data)
+    point_builder = PointBuilder(0, 0)
+    for each_message in json_data[MESSAGES]:
+        for each_han_endpoint in each_message[DATA]:
+            for each_cluster in each_han_endpoint[CLUSTERS]:
+                point_builder.add_cluster(each_han_endpoint[HAN], each_han_endpoint[ENDPOINT_ID],
+                                          each_cluster[CLUSTER], each_cluster[ATTRIBUTES])
+    return point_builder.finish()
+
+def time_per_container(function, data, repeats):
+    # Best of three runs, in microseconds
+    return min(timeit.repeat(lambda: function(data), number=repeats, repeat=3)) / repeats * 1e6
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_REPEATS
+    data = load_raw_container()
+    assert walk_before(data) == walk_after(data)
+
+    print "Raw_data SendData container: %d bytes, %d attributes, JSON library: %s" % (
+        len(data), walk_after(data), jsoncodec.NAME)
+    before = time_per_container(walk_before, data, repeats)
+    after = time_per_container(walk_after, data, repeats)
+    points = time_per_container(build_points, data, repeats)
+    print "\tbefore (json + M lookups):     %7.2f us/container" % before
+    print "\tafter  (%s + bound keys): %7.2f us/container (%.2fx)" % (jsoncodec.NAME.ljust(5), after, before / after)
+    print "\tdecode + build points:         %7.2f us/container" % points
+
+if __name__ == '__main__':
+    main()
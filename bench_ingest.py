@@ -0,0 +1,368 @@
+'''
+Benchmark suite: the ingest hot path, stage by stage
+
+Times each stage of what the ESCo does with a container, per container:
+  - decode:          jsoncodec.loads
+  - receive:         the body written to an httpbody.RequestBody in
+                     RECEIVE_CHUNK_SIZE chunks and decoded, as the server
+                     receives it (incrementally, for bodies bigger than
+                     httpbody.INCREMENTAL_THRESHOLD)
+  - receive_gzip:    the same with the body gzipped
+  - normalise:       rewriting a 1.0 container in the 1.1 shape (see
+                     normalise.py), for 1.0 containers only
+  - route:           get_protocol() and MessageRouter.route() with handlers
+                     that do nothing, i.e. the dispatch alone
+  - points:          the SendData handler writetodb.py registers (see
+                     handlers.py) building the points from the decoded
+                     messages, and finish()
+  - serialise_line:  rendering the points as InfluxDB line protocol, as the
+                     InfluxDB client does before sending them (skipped if the
+                     influxdb package isn't installed)
+  - serialise_chunk: grouping the points by series and encoding them as the
+                     embedded store's chunks (see embeddedstore.py)
+  - total:           decode to serialise through a WriteBuffer onto a
+                     MockBackend, which serialises the points but doesn't
+                     store them anywhere
+
+The fixtures are generated with esbox_simulator.py's virtual ESBoxes, with 1,
+10 and 100 meters per ESBox:
+  - latest_readings_N: SendData from the latest readings buffer
+  - latest_readings_1_0_N: the same readings in a 1.0 SendLatestReadings
+  - sdb_N:             SendData from the stream database, delta encoded, for
+                       a GetData as the SdbDrain sends it (up to SDB_NUM_CELLS
+                       cells from SDB_NUM_REPORTS reports per meter)
+  - device_list_N:     SendDeviceList with neighbour tables, which the ESCo
+                     only routes (as unrecognised)
+plus raw_data, the SendData container in Raw_data. --save-fixtures writes them
+out, one container per file, and --fixtures runs on a directory of them
+instead, e.g. containers captured from real ESBoxes.
+
+Results are written as JSON (with the commit, Python, JSON library and NumPy
+versions they came from), and compared against a --baseline from an earlier
+run: any stage more than --threshold (and MIN_REGRESSION) slower is reported
+as a regression and the exit status is 1.
+
+The baseline is kept in the repository as bench_baseline.json, from the commit
+named in its "meta". Timings only compare on the same machine and Python, so
+check against it with:
+
+    python bench_ingest.py --baseline bench_baseline.json
+
+on the machine that wrote it, or run the baseline's commit first to make one
+locally. When a change makes the hot path deliberately slower (or faster),
+rewrite it with --output bench_baseline.json in the same commit. Each run's own
+results (bench_results.json by default) aren't kept.
+
+Usage:
+
+    python bench_ingest.py [--output FILE] [--baseline FILE] [--threshold FRACTION]
+                           [--fixtures DIR | --save-fixtures DIR] [--seed SEED]
+
+'''
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import timeit
+import zlib
+
+import numpy as np
+
+import SSMessages_8834 as M
+import jsoncodec
+from points import PointBuilder
+from router import MessageRouter, get_protocol, PROTOCOL_1_0
+from normalise import normalise_container
+import handlers
+import sdb
+from storage import StorageBackend
+from embeddedstore import group_by_series, encode_chunk
+from writebuffer import WriteBuffer
+from httpbody import RequestBody, IDENTITY, GZIP
+from bench_decode import load_raw_container
+from esbox_simulator import VirtualESBox, PROTOCOL_1_1
+
+try:
+    from influxdb.line_protocol import make_lines
+except ImportError:
+    make_lines = None
+
+DEFAULT_OUTPUT = "bench_results.json"
+DEFAULT_THRESHOLD = 0.2 # fraction slower that counts as a regression
+DEFAULT_SEED = 8447
+MIN_RUN_TIME = 0.2 # sec, each timed run is made at least this long
+NUM_RUNS = 3
+# Slowdowns smaller than this are timer noise rather than regressions, whatever the fraction
+MIN_REGRESSION = 10 # us
+
+METERS_PER_ESBOX = (1, 10, 100)
+REPORT_INTERVAL = 10 # sec
+SDB_NUM_REPORTS = 6
+SDB_NUM_CELLS = 500
+# The ESBoxes' clocks, so the fixtures come out the same each time
+FIXTURE_TIME = 1500000000
+# How much of a body arrives at a time
+RECEIVE_CHUNK_SIZE = 65536
+
+STAGES = ("decode", "receive", "receive_gzip", "normalise", "route", "points", "serialise_line", "serialise_chunk", "total")
+
+#---------------------------------------------------------------------------#
+# Fixtures
+#---------------------------------------------------------------------------#
+
+def generate_fixtures(seed=DEFAULT_SEED):
+    # Returns [(name, container as JSON), ...]
+    random.seed(seed)
+    fixtures = []
+    for num_meters in METERS_PER_ESBOX:
+        now = FIXTURE_TIME
+        box = VirtualESBox(num_meters, PROTOCOL_1_1.version, num_meters, REPORT_INTERVAL)
+        for each_meter in box.meters:
+            each_meter.next_report = now + random.uniform(0, REPORT_INTERVAL)
+        now += SDB_NUM_REPORTS * REPORT_INTERVAL
+        box.update(now)
+
+        latest_readings, num_attributes = box.generate_latest_readings()
+        send_latest_readings, num_attributes = box.generate_send_latest_readings_1_0()
+        stream_data, num_attributes = box.generate_stream_data(sdb.generate_get_data(SDB_NUM_CELLS))
+        device_list = box.generate_send_device_list(detailed=True, now=now)
+        for name, protocol, message in (("latest_readings", PROTOCOL_1_1, latest_readings),
+                                        ("latest_readings_1_0", PROTOCOL_1_0, send_latest_readings),
+                                        ("sdb", PROTOCOL_1_1, stream_data),
+                                        ("device_list", PROTOCOL_1_1, device_list)):
+            container = box.generate_container(protocol, [message], now)
+            fixtures.append(("%s_%d" % (name, num_meters), jsoncodec.dumps(container)))
+    fixtures.append(("raw_data", load_raw_container()))
+    return fixtures
+
+def save_fixtures(directory, fixtures):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for name, data in fixtures:
+        with open(os.path.join(directory, name + ".json"), "wb") as fixture_file:
+            fixture_file.write(data)
+
+def load_fixtures(directory):
+    fixtures = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        with open(path, "rb") as fixture_file:
+            fixtures.append((os.path.splitext(os.path.basename(path))[0], fixture_file.read().strip()))
+    if not fixtures:
+        raise ValueError("No fixtures (*.json) found in %s" % directory)
+    return fixtures
+
+#---------------------------------------------------------------------------#
+# The stages
+#---------------------------------------------------------------------------#
+
+class BenchContainer():
+    # The parts of writetodb.Container the handlers use (see handlers.py)
+
+    def __init__(self, esbox_id):
+        self.esbox_id = esbox_id
+        self.point_builder = PointBuilder(0, FIXTURE_TIME)
+        self.sdb_drain = None
+
+def ignore_message(message, container):
+    pass
+
+# The readings handlers writetodb registers. Its other handlers keep per-ESBox state and log,
+# so the messages they'd take are left to the unrecognised handler here.
+router = MessageRouter()
+handlers.register(router)
+router.unrecognised_handler = ignore_message
+
+# The same keys with handlers that do nothing
+dispatch_router = MessageRouter()
+dispatch_router.handlers = dict.fromkeys(router.handlers, ignore_message)
+dispatch_router.unrecognised_handler = ignore_message
+
+def as_1_1(json_data):
+    # As process_data() does, 1.0 containers take the 1.1 path
+    if get_protocol(json_data) is PROTOCOL_1_0:
+        return normalise_container(json_data)
+    return json_data
+
+def route(json_data):
+    protocol = get_protocol(json_data)
+    dispatch_router.route(protocol, json_data[protocol.messages_key], None)
+
+def build_points(json_data):
+    protocol = get_protocol(json_data)
+    container = BenchContainer(json_data.get(M.F.Gen.Auth, [None])[0])
+    for each_message in json_data[protocol.messages_key]:
+        if each_message.get(protocol.msg_id_key) == M.SS_ESB.E.SendData:
+            handlers.handle_send_data(each_message, container)
+    return container.point_builder.finish()
+
+def serialise_line(points):
+    return make_lines({"points": points}, precision="s")
+
+def serialise_chunks(points):
+    chunks = []
+    for series_id, rows in enumerate(group_by_series(points).itervalues()):
+        chunks.append(encode_chunk(series_id, [row[0] for row in rows], [row[1] for row in rows]))
+    return "".join(chunks)
+
+class MockBackend(StorageBackend):
+    # Serialises each batch as a real backend would, then throws it away
+
+    def __init__(self, serialise):
+        self.serialise = serialise
+        self.num_points = 0
+        self.num_bytes = 0
+
+    def write_points(self, points, time_precision='s'):
+        self.num_points += len(points)
+        self.num_bytes += len(self.serialise(points))
+
+def receive(data, encoding=IDENTITY):
+    body = RequestBody(encoding)
+    for offset in xrange(0, len(data), RECEIVE_CHUNK_SIZE):
+        body.write(data[offset:offset + RECEIVE_CHUNK_SIZE])
+    return body.container()
+
+def gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def make_ingest_function(data):
+    # Returns a function that takes a container from JSON to a (mock) storage write
+    write_buffer = WriteBuffer(MockBackend(serialise_line if make_lines is not None else serialise_chunks))
+
+    def ingest():
+        json_data = as_1_1(jsoncodec.loads(data))
+        protocol = get_protocol(json_data)
+        container = BenchContainer(json_data.get(M.F.Gen.Auth, [None])[0])
+        router.route(protocol, json_data[protocol.messages_key], container)
+        write_buffer.add(container.point_builder.finish())
+        write_buffer.flush()
+    return ingest
+
+#---------------------------------------------------------------------------#
+# Timing
+#---------------------------------------------------------------------------#
+
+def time_per_call(function):
+    # Best of NUM_RUNS runs, in microseconds, with enough calls in each run to take MIN_RUN_TIME
+    start = time.time()
+    function()
+    number = max(1, int(MIN_RUN_TIME / max(time.time() - start, 1e-6)))
+    return min(timeit.repeat(function, number=number, repeat=NUM_RUNS)) / number * 1e6
+
+def bench_fixture(data):
+    received = jsoncodec.loads(data)
+    protocol = get_protocol(received)
+    if protocol is None:
+        raise ValueError("Not an ESBox container (missing or unknown protocol version)")
+    json_data = as_1_1(received)
+    points = build_points(json_data)
+    gzipped = gzip(data)
+    stages = {
+        "decode": time_per_call(lambda: jsoncodec.loads(data)),
+        "receive": time_per_call(lambda: receive(data)),
+        "receive_gzip": time_per_call(lambda: receive(gzipped, GZIP)),
+        "normalise": time_per_call(lambda: normalise_container(received)) if protocol is PROTOCOL_1_0 else None,
+        "route": time_per_call(lambda: route(json_data)),
+        "points": time_per_call(lambda: build_points(json_data)),
+        "serialise_line": time_per_call(lambda: serialise_line(points)) if make_lines is not None else None,
+        "serialise_chunk": time_per_call(lambda: serialise_chunks(points)),
+        "total": time_per_call(make_ingest_function(data)),
+    }
+    return {
+        "bytes": len(data),
+        "gzipped_bytes": len(gzipped),
+        "messages": len(received[protocol.messages_key]),
+        "points": len(points),
+        "stages": stages,
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def find_regressions(results, baseline, threshold):
+    # Returns [(fixture, stage, baseline us, us), ...] for the stages more than threshold slower
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        baseline_result = baseline.get(name)
+        if baseline_result is None:
+            continue
+        for stage in STAGES:
+            before = baseline_result["stages"].get(stage)
+            after = result["stages"].get(stage)
+            if before and after is not None and after > before * (1 + threshold) and after - before >= MIN_REGRESSION:
+                regressions.append((name, stage, before, after))
+    return regressions
+
+def print_results(results):
+    print "%-24s %7s %5s %6s  %s" % ("fixture", "bytes", "msgs", "points",
+                                     " ".join("%15s" % each_stage for each_stage in STAGES))
+    for name in sorted(results):
+        result = results[name]
+        print "%-24s %7d %5d %6d  %s" % (name, result["bytes"], result["messages"], result["points"], " ".join(
+            "%15s" % ("-" if result["stages"][each_stage] is None else "%.1f" % result["stages"][each_stage])
+            for each_stage in STAGES))
+    print "(us/container)"
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ESCo's ingest hot path")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="where to write the results as JSON")
+    parser.add_argument("--baseline", help="results from an earlier run to check for regressions against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="fraction slower than the baseline that counts as a regression")
+    parser.add_argument("--fixtures", help="benchmark the containers in this directory instead")
+    parser.add_argument("--save-fixtures", help="write the generated fixtures to this directory")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    args = parser.parse_args()
+
+    if args.fixtures:
+        fixtures = load_fixtures(args.fixtures)
+    else:
+        fixtures = generate_fixtures(args.seed)
+        if args.save_fixtures:
+            save_fixtures(args.save_fixtures, fixtures)
+
+    results = {}
+    for name, data in fixtures:
+        results[name] = bench_fixture(data)
+    print_results(results)
+
+    with open(args.output, "wb") as output_file:
+        json.dump({
+            "meta": {
+                "date": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "json_library": jsoncodec.NAME,
+                "numpy": np.__version__,
+                "line_protocol": make_lines is not None,
+            },
+            "results": results,
+        }, output_file, indent=2, sort_keys=True)
+    print "Results written to %s" % args.output
+
+    if args.baseline:
+        with open(args.baseline, "rb") as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = find_regressions(results, baseline["results"], args.threshold)
+        print "Compared with %s (commit %s):" % (args.baseline, baseline["meta"].get("commit"))
+        for name, stage, before, after in regressions:
+            print "\tREGRESSION %s %s: %.1f -> %.1f us (+%.0f%%)" % (name, stage, before, after,
+                                                                    100 * (after / before - 1))
+        if regressions:
+            sys.exit(1)
+        print "\tno regressions over %.0f%%" % (100 * args.threshold)
+
+if __name__ == '__main__':
+    main()
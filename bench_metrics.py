@@ -0,0 +1,93 @@
+'''
+Microbenchmark: overhead of the hot path metrics
+
+Times the metric updates render_PUT makes for one request - reading the clock
+five times, three histogram observations and a counter increment for the
+request and for each message in it - against:
+  - decoding the SendData container in Raw_data and building its points (see
+    bench_decode.py), only part of the work a request does, so this gives an
+    upper bound on the overhead
+  - a whole request for it through twisted.web on a new connection, as an
+    ESBox makes them, with a resource that decodes the container and builds
+    its points but doesn't store them
+
+Usage:
+
+    python bench_metrics.py [number of repeats]
+
+'''
+
+import sys
+import time
+import timeit
+
+from twisted.internet import address
+from twisted.internet.error import ConnectionDone
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.web import server, resource
+
+import metrics
+from bench_decode import load_raw_container, build_points, time_per_container
+import jsoncodec
+from keys import MESSAGES, MSG_ID
+
+DEFAULT_REPEATS = 20000
+
+request_seconds = metrics.Histogram("request_seconds", "", ("protocol",))
+decode_seconds = metrics.Histogram("decode_seconds", "")
+process_seconds = metrics.Histogram("process_seconds", "", ("protocol",))
+request_bytes = metrics.Counter("request_bytes_total", "")
+points_built = metrics.Counter("points_total", "")
+messages_received = metrics.Counter("messages_total", "", ("protocol", "msg_id"))
+
+def instrument_request(num_bytes, msg_ids, num_points):
+    # The same updates as writetodb.TestServer.render_PUT, process_data and MessageRouter.route
+    start = time.time()
+    request_bytes.inc(amount=num_bytes)
+    decode_seconds.observe(time.time() - start)
+    process_start = time.time()
+    for msg_id in msg_ids:
+        messages_received.inc(("1.1", msg_id))
+    points_built.inc(amount=num_points)
+    process_seconds.observe(time.time() - process_start, ("1.1",))
+    request_seconds.observe(time.time() - start, ("1.1",))
+
+class BenchResource(resource.Resource):
+    isLeaf = True
+
+    def render_PUT(self, request):
+        build_points(request.content.read())
+        return '{"PVer":"1.1","Msgs":[{"M":"Close","Cl":{"I":0,"M":4278}}]}'
+
+def make_request_function(data):
+    # Returns a function that PUTs data to a BenchResource on a new connection
+    site = server.Site(BenchResource())
+    raw_request = "PUT / HTTP/1.1\r\nHost: esco\r\nContent-Length: %d\r\n\r\n%s" % (len(data), data)
+    client_address = address.IPv4Address("TCP", "127.0.0.1", 40000)
+
+    def put_request():
+        protocol = site.buildProtocol(client_address)
+        protocol.makeConnection(proto_helpers.StringTransport())
+        protocol.dataReceived(raw_request)
+        protocol.connectionLost(failure.Failure(ConnectionDone()))
+    return put_request
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_REPEATS
+    data = load_raw_container()
+    msg_ids = [each_message.get(MSG_ID) for each_message in jsoncodec.loads(data)[MESSAGES]]
+    num_points = len(build_points(data))
+
+    work = time_per_container(build_points, data, repeats)
+    request = min(timeit.repeat(make_request_function(data), number=repeats // 4, repeat=3)) / (repeats // 4) * 1e6
+    overhead = min(timeit.repeat(lambda: instrument_request(len(data), msg_ids, num_points),
+                                 number=repeats, repeat=3)) / repeats * 1e6
+    print "Raw_data SendData container: %d bytes, %d messages, %d points" % (len(data), len(msg_ids), num_points)
+    print "\tdecode + build points: %7.2f us/request" % work
+    print "\twhole HTTP request:    %7.2f us/request" % request
+    print "\tmetrics:               %7.2f us/request (%.1f%% of decode + build points, %.1f%% of a request)" % (
+        overhead, 100 * overhead / work, 100 * overhead / request)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+'''
+What each ESBox supports
+
+The first time an ESBox checks in it's sent GetSupportedVersions, and the
+protocol versions in its SendSupportedVersions reply are remembered, so from
+then on it can be sent whatever is most compact for it: 1.1 boxes have their
+readings drained from the stream database with delta encoding, while 1.0-only
+boxes are sent 1.0 containers asking for their latest readings. A 1.0-only
+box ignores GetSupportedVersions, so a box that hasn't replied within
+NEGOTIATION_TIMEOUT is taken to support only the version it speaks.
+
+Each box's firmware (the ESBoxVersion in every container) is remembered too,
+and the negotiation is started again if it changes. The protocol version a box
+used last time is tried first on its next container, so a container is only
+probed for its version when the box changes.
+
+Everything kept per box is a number - the supported versions and the version
+of its last container as bitmasks, a hash of its firmware and when it was
+asked - so it can all be shared between worker processes (see
+sharedstate.SharedField). Each box is then asked once, whichever workers it
+reaches, and the workers agree on what it supports.
+
+'''
+
+import threading
+import time
+import zlib
+
+from router import get_protocol, PROTOCOLS
+
+# How long to wait for SendSupportedVersions
+NEGOTIATION_TIMEOUT = 30 # sec
+
+PROTOCOL_BITS = {
+    "1.0": 1,
+    "1.1": 2,
+}
+
+def versions_to_mask(versions):
+    mask = 0
+    for each_version in versions:
+        mask |= PROTOCOL_BITS.get(each_version, 0)
+    return mask
+
+def mask_to_versions(mask):
+    return frozenset(version for version, bit in PROTOCOL_BITS.iteritems() if mask & bit)
+
+PROTOCOLS_BY_BIT = dict((bit, PROTOCOLS[version]) for version, bit in PROTOCOL_BITS.iteritems())
+
+def firmware_hash(esbox_version):
+    # Firmware versions are only ever compared, so a hash of one will do
+    return zlib.crc32(repr(esbox_version)) & 0xffffffff
+
+class CapabilityCache():
+
+    def __init__(self, protocols=None, container_protocols=None, firmware=None, asked=None,
+                 timeout=NEGOTIATION_TIMEOUT):
+        # By ESBox: the versions it supports, the version of its last container, its firmware
+        # hash, and when it was sent GetSupportedVersions if it hasn't answered yet. Each can
+        # be shared between processes (see sharedstate.SharedField).
+        self.protocols = {} if protocols is None else protocols
+        self.container_protocols = {} if container_protocols is None else container_protocols
+        self.firmware = {} if firmware is None else firmware
+        self.asked = {} if asked is None else asked
+        self.timeout = timeout
+        self.lock = threading.Lock()
+
+    def _last_protocol(self, esbox_id):
+        return PROTOCOLS_BY_BIT.get(self.container_protocols.get(esbox_id))
+
+    def container_protocol(self, esbox_id, json_data):
+        # Returns the ProtocolKeys for a box's container, or None if it doesn't say which version it is
+        protocol = self._last_protocol(esbox_id)
+        if protocol is not None and json_data.get(protocol.version_key) == protocol.version:
+            return protocol
+        protocol = get_protocol(json_data)
+        if protocol is not None and esbox_id is not None:
+            self.container_protocols[esbox_id] = PROTOCOL_BITS[protocol.version]
+        return protocol
+
+    def check_firmware(self, esbox_id, esbox_version):
+        # Start again with a box that's changed firmware
+        new_firmware = firmware_hash(esbox_version)
+        old_firmware = self.firmware.get(esbox_id)
+        if old_firmware == new_firmware:
+            return
+        with self.lock:
+            if old_firmware is not None:
+                self.protocols.pop(esbox_id, None)
+                self.asked.pop(esbox_id, None)
+            self.firmware[esbox_id] = new_firmware
+
+    def supported_versions(self, esbox_id, now=None):
+        # Returns the set of protocol versions a box supports, or None if we don't know yet
+        mask = self.protocols.get(esbox_id)
+        if mask is not None:
+            return mask_to_versions(mask)
+        asked = self.asked.get(esbox_id)
+        if asked is None:
+            return None
+        if now is None:
+            now = time.time()
+        if now - asked < self.timeout:
+            return None
+        # No answer, so it only knows the version it speaks
+        protocol = self._last_protocol(esbox_id)
+        if protocol is None:
+            return None
+        self.received_versions(esbox_id, [protocol.version])
+        return frozenset([protocol.version])
+
+    def should_ask(self, esbox_id, now=None):
+        # True if a box needs sending GetSupportedVersions. Only says so once per negotiation.
+        if esbox_id is None or self.protocols.get(esbox_id) is not None:
+            return False
+        with self.lock:
+            if self.asked.get(esbox_id) is not None:
+                return False
+            self.asked[esbox_id] = time.time() if now is None else now
+        return True
+
+    def received_versions(self, esbox_id, versions):
+        # From SendSupportedVersions
+        if esbox_id is None:
+            return
+        mask = versions_to_mask(versions)
+        protocol = self._last_protocol(esbox_id)
+        if not mask and protocol is not None:
+            # Nothing we know, so stick to what it speaks
+            mask = PROTOCOL_BITS[protocol.version]
+        with self.lock:
+            self.protocols[esbox_id] = mask
+            self.asked.pop(esbox_id, None)
+
+    def forget(self, esbox_id):
+        with self.lock:
+            self.protocols.pop(esbox_id, None)
+            self.container_protocols.pop(esbox_id, None)
+            self.firmware.pop(esbox_id, None)
+            self.asked.pop(esbox_id, None)
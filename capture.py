@@ -0,0 +1,163 @@
+'''
+Capture of ESBox traffic, for replaying offline
+
+When capturing is turned on (CAPTURE_TRAFFIC in writetodb.py) render_PUT
+records every request body it receives (decompressed), the response it sent
+back (before compression) and how long it took. Records go through a zlib stream into numbered segment files,
+which are rolled over once they've taken segment_size bytes of traffic. The
+server calls flush() every few seconds, so a crash loses at most that much.
+In the decompressed stream each record is:
+
+    [received: double][seconds taken: double][request length: uint32][response length: uint32]
+    [request body][response body]
+
+Containers from the same ESBoxes compress very well, typically by 10x or more.
+replay.py feeds captured traffic back through the server.
+
+'''
+
+import glob
+import logging
+import os
+import struct
+import zlib
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024 # bytes of traffic before compression
+COMPRESSION_LEVEL = 1
+
+RECORD_HEADER = struct.Struct(">ddII")
+SEGMENT_SUFFIX = ".cap"
+READ_SIZE = 1024 * 1024
+
+def segment_filename(segment_no):
+    return "%010d%s" % (segment_no, SEGMENT_SUFFIX)
+
+class CapturedRequest():
+
+    def __init__(self, received, seconds, request, response):
+        self.received = received
+        self.seconds = seconds
+        self.request = request
+        self.response = response
+
+class TrafficCapture():
+    # Only ever used from the reactor thread
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Always start a new segment, as the last one may have been cut off mid-stream
+        segment_numbers = segment_numbers_in(directory)
+        self.segment_no = segment_numbers[-1] + 1 if segment_numbers else 0
+        self.segment_file = None
+        self.compressor = None
+        self.segment_bytes = 0
+
+        self.num_records = 0
+        self.num_bytes = 0
+
+    def _open_segment(self):
+        self.segment_file = open(os.path.join(self.directory, segment_filename(self.segment_no)), "ab")
+        self.compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        self.segment_bytes = 0
+
+    def _close_segment(self):
+        self.segment_file.write(self.compressor.flush(zlib.Z_FINISH))
+        self.segment_file.close()
+        self.segment_file = None
+        self.compressor = None
+        self.segment_no += 1
+
+    def record(self, received, seconds, request, response):
+        if response is None:
+            response = ""
+        if self.segment_file is None:
+            self._open_segment()
+        record = RECORD_HEADER.pack(received, seconds, len(request), len(response)) + request + response
+        try:
+            self.segment_file.write(self.compressor.compress(record))
+        except IOError as e:
+            log.error("Couldn't capture a request: %s", e)
+            return
+        self.segment_bytes += len(record)
+        self.num_records += 1
+        self.num_bytes += len(record)
+
+        if self.segment_bytes >= self.segment_size:
+            self._close_segment()
+
+    def flush(self):
+        # Make everything captured so far readable
+        if self.segment_file is None:
+            return
+        try:
+            self.segment_file.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.segment_file.flush()
+        except IOError as e:
+            log.error("Couldn't flush the traffic capture: %s", e)
+
+    def close(self):
+        if self.segment_file is not None:
+            self._close_segment()
+
+#---------------------------------------------------------------------------#
+# Reading captures back
+#---------------------------------------------------------------------------#
+
+def segment_numbers_in(directory):
+    numbers = []
+    for path in glob.glob(os.path.join(directory, "*" + SEGMENT_SUFFIX)):
+        try:
+            numbers.append(int(os.path.basename(path)[:-len(SEGMENT_SUFFIX)]))
+        except ValueError:
+            continue
+    return sorted(numbers)
+
+def capture_files(paths):
+    # The segment files in each of paths (capture directories or segment files), oldest first
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, segment_filename(segment_no)) for segment_no in segment_numbers_in(path))
+        else:
+            files.append(path)
+    return files
+
+def read_segment(path):
+    # Yields a CapturedRequest for each complete record in a segment file. A segment that
+    # was still being written (or was cut off by a crash) is read as far as it was flushed.
+    decompressor = zlib.decompressobj()
+    data = ""
+    offset = 0
+    header_size = RECORD_HEADER.size
+    with open(path, "rb") as segment_file:
+        while True:
+            chunk = segment_file.read(READ_SIZE)
+            if not chunk:
+                break
+            try:
+                data = data[offset:] + decompressor.decompress(chunk)
+            except zlib.error as e:
+                log.warning("Capture segment %s is corrupt after %d bytes: %s", path, segment_file.tell(), e)
+                break
+            offset = 0
+            while offset + header_size <= len(data):
+                received, seconds, request_length, response_length = RECORD_HEADER.unpack_from(data, offset)
+                start = offset + header_size
+                end = start + request_length + response_length
+                if end > len(data):
+                    break
+                yield CapturedRequest(received, seconds, data[start:start + request_length],
+                                      data[start + request_length:end])
+                offset = end
+
+def read_captures(paths):
+    # Every captured request in paths, in the order they were received
+    for each_file in capture_files(paths):
+        for each_request in read_segment(each_file):
+            yield each_request
@@ -0,0 +1,307 @@
+'''
+Persistent per-ESBox command queue
+
+Commands for an ESBox (switching a relay, reading attributes, asking for its
+device list, setting its options...) are queued on disk until the box next
+checks in, and then as many as fit are packed into the reply container
+alongside any GetData. A change pushed to the whole fleet therefore goes out
+in one round trip per box, and survives a restart of the ESCo.
+
+Each ESBox with commands waiting has a file in the queue directory, named
+after its IEEE, with one line per command:
+
+    <command id> <lease expiry> <encoded message>
+
+A command taken for a reply is leased (its lease expiry is set LEASE_TIMEOUT
+ahead) so no other worker puts it in a reply too, and only removed from the
+file once the reply has been written to the box (acknowledge()). If the
+connection drops first it's released and goes in the next reply instead, and
+if the worker dies the lease runs out. Files are locked while they're read and
+changed, so operators (see the command line below) and several ESCo worker
+processes can share the directory. take(), acknowledge() and release() all
+write to disk, so the server calls them from a thread rather than the reactor.
+
+Commands are taken oldest first, as many as fit in the reply. The oldest always
+goes, even if the reply is already full, so one big command can't hold up the
+ones behind it; enqueue() refuses any command bigger than MAX_COMMAND_BYTES,
+which keeps that within bounds.
+
+Usage:
+
+    python commandqueue.py <esbox> switch <device ieee> <endpoint> on|off|toggle
+    python commandqueue.py <esbox> read <device ieee> <endpoint> <cluster id> <manufacturer> <attribute id>...
+    python commandqueue.py <esbox> devices
+    python commandqueue.py <esbox> options <option>=<value>...
+    python commandqueue.py <esbox> list
+
+'''
+
+import argparse
+import fcntl
+import os
+import re
+import threading
+import time
+import uuid
+
+import jsoncodec
+import SSMessages_8834 as M
+
+DEFAULT_DIRECTORY = "commands"
+QUEUE_SUFFIX = ".cmds"
+LOCK_FILENAME = ".lock"
+# How long a command taken for a reply is kept from other replies. Longer than any
+# reply takes to get to an ESBox.
+LEASE_TIMEOUT = 120 # sec
+# The biggest command that can be queued, encoded. Well under the ESCo's reply limit.
+MAX_COMMAND_BYTES = 4096
+
+ESBOX_ID_PATTERN = re.compile("^[0-9A-Fa-f]{1,16}$")
+
+#---------------------------------------------------------------------------#
+# Commands
+#---------------------------------------------------------------------------#
+
+def generate_switch_state(device_ieee, endpoint_id, action=M.V.OnOff.Toggle):
+    new_message = {}
+    new_message[M.F.Gen.Cluster_1_1] = M.Clusters_1_1.OnOff
+    new_message[M.F.Gen.MsgID_1_1] = M.OnOff.E.SwitchState
+    new_message[M.F.Nwk.DevIEEE] = device_ieee
+    new_message[M.F.Nwk.EndpointID] = endpoint_id
+    new_message[M.F.OnOff.Action] = action
+    return new_message
+
+def generate_read_attributes(device_ieee, endpoint_id, cluster_id, manufacturer, attr_ids):
+    new_message = {}
+    new_message[M.F.Gen.Cluster_1_1] = {M.F.Gen.ClusterID_1_1: cluster_id, M.F.Gen.ClusterManufacturer_1_1: manufacturer}
+    new_message[M.F.Gen.MsgID_1_1] = M.Common.E.ReadAttributes_1_1
+    new_message[M.F.Nwk.HAN_1_1] = device_ieee
+    new_message[M.F.Nwk.EndpointID_1_1] = endpoint_id
+    new_message[M.F.Dat.Attributes_1_1] = list(attr_ids)
+    return new_message
+
+def generate_get_device_list(detailed=True):
+    new_message = {}
+    new_message[M.F.Gen.Cluster_1_1] = M.Clusters_1_1.SS_ESB
+    new_message[M.F.Gen.MsgID_1_1] = M.SS_ESB.E.GetDeviceList_1_1
+    new_message[M.F.Nwk.Detailed_1_1] = detailed
+    return new_message
+
+def generate_set_esbox_options(options):
+    # options maps M.F.S.ESBox names to their new values
+    new_message = {}
+    new_message[M.F.Gen.Cluster_1_1] = M.Clusters_1_1.SS_ESB
+    new_message[M.F.Gen.MsgID_1_1] = M.SS_ESB.E.SetESBoxOptions_1_1
+    new_message[M.F.ESB.Options_1_1] = options
+    return new_message
+
+#---------------------------------------------------------------------------#
+# Queue
+#---------------------------------------------------------------------------#
+
+class CommandQueue():
+
+    def __init__(self, directory=DEFAULT_DIRECTORY):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+
+    def _path(self, esbox_id):
+        if esbox_id is None or not ESBOX_ID_PATTERN.match(esbox_id):
+            raise ValueError("Not an ESBox IEEE: %r" % (esbox_id,))
+        return os.path.join(self.directory, esbox_id.upper() + QUEUE_SUFFIX)
+
+    def _locked(self):
+        # Lock the queue against this process's other threads and against other processes
+        return QueueLock(self.lock, os.path.join(self.directory, LOCK_FILENAME))
+
+    def _read(self, path):
+        # Caller holds the lock. Returns [[command id, lease expiry, encoded message], ...]
+        commands = []
+        try:
+            with open(path, "rb") as queue_file:
+                for each_line in queue_file:
+                    if not each_line.endswith("\n"):
+                        # Partly written by a crash
+                        break
+                    command_id, lease_expiry, encoded = each_line.rstrip("\n").split(" ", 2)
+                    commands.append([command_id, float(lease_expiry), encoded])
+        except IOError:
+            pass
+        return commands
+
+    def _write(self, path, commands):
+        # Caller holds the lock
+        if not commands:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        with open(path + ".tmp", "wb") as queue_file:
+            for command_id, lease_expiry, encoded in commands:
+                queue_file.write("%s %.3f %s\n" % (command_id, lease_expiry, encoded))
+            queue_file.flush()
+            os.fsync(queue_file.fileno())
+        os.rename(path + ".tmp", path)
+
+    def enqueue(self, esbox_id, message):
+        # Queue a command for an ESBox. Returns the command's id.
+        path = self._path(esbox_id)
+        encoded = jsoncodec.dumps(message)
+        if len(encoded) + 1 > MAX_COMMAND_BYTES:
+            raise ValueError("Command is %d bytes encoded, over the limit of %d" % (len(encoded) + 1, MAX_COMMAND_BYTES))
+        command_id = uuid.uuid4().hex
+        with self._locked():
+            with open(path, "ab") as queue_file:
+                queue_file.write("%s 0 %s\n" % (command_id, encoded))
+                queue_file.flush()
+                os.fsync(queue_file.fileno())
+        return command_id
+
+    def pending(self, esbox_id):
+        # Returns [(command id, message), ...] in the order they'll be sent
+        with self._locked():
+            return [(command_id, jsoncodec.loads(encoded))
+                    for command_id, lease_expiry, encoded in self._read(self._path(esbox_id))]
+
+    def has_commands(self, esbox_id):
+        # True if there may be commands waiting for this ESBox. The usual answer is no, and
+        # only costs a stat.
+        try:
+            return os.path.exists(self._path(esbox_id))
+        except ValueError:
+            return False
+
+    def take(self, esbox_id, max_commands, max_bytes, now=None):
+        # Returns [(command id, encoded message), ...] for the commands waiting for this ESBox
+        # that fit in max_commands and max_bytes, oldest first (the oldest whether it fits or
+        # not), and leases them. Each one must then be acknowledged or released.
+        if not self.has_commands(esbox_id):
+            return []
+        path = self._path(esbox_id)
+        if now is None:
+            now = time.time()
+        taken = []
+        num_bytes = 0
+        with self._locked():
+            commands = self._read(path)
+            for each_command in commands:
+                command_id, lease_expiry, encoded = each_command
+                if lease_expiry > now:
+                    # In a reply from another worker (or thread)
+                    continue
+                if taken and (len(taken) >= max_commands or num_bytes + len(encoded) + 1 > max_bytes):
+                    break
+                taken.append((command_id, encoded))
+                num_bytes += len(encoded) + 1
+                each_command[1] = now + LEASE_TIMEOUT
+            if taken:
+                self._write(path, commands)
+        return taken
+
+    def acknowledge(self, esbox_id, command_ids):
+        # The reply holding these commands reached the ESBox, so they're done
+        command_ids = set(command_ids)
+        path = self._path(esbox_id)
+        with self._locked():
+            self._write(path, [each_command for each_command in self._read(path) if each_command[0] not in command_ids])
+
+    def release(self, esbox_id, command_ids):
+        # The reply holding these commands didn't get through, so send them again next time
+        command_ids = set(command_ids)
+        path = self._path(esbox_id)
+        with self._locked():
+            commands = self._read(path)
+            for each_command in commands:
+                if each_command[0] in command_ids:
+                    each_command[1] = 0.0
+            self._write(path, commands)
+
+class QueueLock():
+
+    def __init__(self, thread_lock, lock_path):
+        self.thread_lock = thread_lock
+        self.lock_path = lock_path
+        self.lock_file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        try:
+            self.lock_file = open(self.lock_path, "a")
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        except:
+            self.thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+            self.lock_file.close()
+        finally:
+            self.thread_lock.release()
+
+#---------------------------------------------------------------------------#
+# Command line
+#---------------------------------------------------------------------------#
+
+ACTIONS = {"on": M.V.OnOff.On, "off": M.V.OnOff.Off, "toggle": M.V.OnOff.Toggle}
+
+def parse_option_value(value):
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+def main():
+    parser = argparse.ArgumentParser(description="Queue commands for an ESBox")
+    parser.add_argument("--directory", default=DEFAULT_DIRECTORY)
+    parser.add_argument("esbox", help="the ESBox's IEEE")
+    subparsers = parser.add_subparsers(dest="command")
+
+    switch_parser = subparsers.add_parser("switch", help="switch a device's relay")
+    switch_parser.add_argument("device")
+    switch_parser.add_argument("endpoint", type=int)
+    switch_parser.add_argument("action", choices=sorted(ACTIONS))
+
+    read_parser = subparsers.add_parser("read", help="read attributes from a device")
+    read_parser.add_argument("device")
+    read_parser.add_argument("endpoint", type=int)
+    read_parser.add_argument("cluster_id", type=int)
+    read_parser.add_argument("manufacturer", type=int)
+    read_parser.add_argument("attr_ids", type=int, nargs="+")
+
+    subparsers.add_parser("devices", help="ask for the ESBox's device list")
+
+    options_parser = subparsers.add_parser("options", help="set ESBox options")
+    options_parser.add_argument("options", nargs="+", metavar="option=value")
+
+    subparsers.add_parser("list", help="show the commands waiting for the ESBox")
+
+    args = parser.parse_args()
+    queue = CommandQueue(args.directory)
+    if args.command == "list":
+        for command_id, message in queue.pending(args.esbox):
+            print command_id, jsoncodec.dumps(message)
+        return
+
+    if args.command == "switch":
+        message = generate_switch_state(args.device, args.endpoint, ACTIONS[args.action])
+    elif args.command == "read":
+        message = generate_read_attributes(args.device, args.endpoint, args.cluster_id, args.manufacturer, args.attr_ids)
+    elif args.command == "devices":
+        message = generate_get_device_list()
+    else:
+        options = {}
+        for each_option in args.options:
+            name, value = each_option.split("=", 1)
+            options[name] = parse_option_value(value)
+        message = generate_set_esbox_options(options)
+    try:
+        command_id = queue.enqueue(args.esbox, message)
+    except ValueError as e:
+        parser.error(str(e))
+    print "Queued command %s for ESBox %s" % (command_id, args.esbox)
+
+if __name__ == '__main__':
+    main()
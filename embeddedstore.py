@@ -0,0 +1,297 @@
+'''
+Embedded time-series store
+
+Stores readings in a local directory, so the ESCo can run without an InfluxDB
+server. Points are grouped into series by measurement and tags, and every
+write_points() call appends one chunk per series to an append-only data file.
+A chunk holds the times and each field as a column:
+
+    [header length: uint32][header: JSON][times: int64 * n][field columns...]
+
+Numeric fields are stored as int64 or float64 arrays (with a presence mask if
+some points don't have the field), anything else as a JSON list.
+
+Where each chunk went (series, first and last time, offset, length) is
+recorded in a fixed-size index file, which is held in memory so that a range
+query only reads the chunks that overlap it. Series are listed in a series
+file, one JSON line each.
+
+Writing the same point twice stores it twice, but queries apply the chunks
+in the order they were written, so the latest value wins like in InfluxDB.
+
+'''
+
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+
+from storage import StorageBackend
+
+DATA_FILENAME = "chunks.dat"
+INDEX_FILENAME = "chunks.idx"
+SERIES_FILENAME = "series.jsonl"
+
+CHUNK_HEADER = struct.Struct(">I")
+# series id, first time, last time, offset, length
+INDEX_ENTRY = struct.Struct(">IqqQI")
+
+INT_COLUMN = "i"
+FLOAT_COLUMN = "f"
+JSON_COLUMN = "j"
+
+COLUMN_DTYPES = {
+    INT_COLUMN: np.dtype(">i8"),
+    FLOAT_COLUMN: np.dtype(">f8"),
+}
+TIME_DTYPE = np.dtype(">i8")
+
+def series_key(measurement, tags):
+    return (measurement, tuple(sorted(tags.iteritems())))
+
+def column_kind(values):
+    kind = INT_COLUMN
+    for each_value in values:
+        if each_value is None:
+            continue
+        if isinstance(each_value, bool) or not isinstance(each_value, (int, long, float)):
+            return JSON_COLUMN
+        if isinstance(each_value, float):
+            kind = FLOAT_COLUMN
+    return kind
+
+def group_by_series(points):
+    # Returns {series key: [(time, fields), ...]} with each series' rows sorted by time
+    rows_by_series = {}
+    for each_point in points:
+        key = series_key(each_point["measurement"], each_point.get("tags", {}))
+        rows = rows_by_series.get(key)
+        if rows is None:
+            rows = rows_by_series[key] = []
+        rows.append((int(each_point["time"]), each_point["fields"]))
+    for rows in rows_by_series.itervalues():
+        rows.sort(key=lambda row: row[0])
+    return rows_by_series
+
+def encode_chunk(series_id, times, rows):
+    # times is a sorted list of point times and rows the matching field dicts
+    names = set()
+    for fields in rows:
+        names.update(fields)
+
+    columns = []
+    parts = [np.array(times, dtype=TIME_DTYPE).tostring()]
+    for name in sorted(names):
+        values = [fields.get(name) for fields in rows]
+        kind = column_kind(values)
+        masked = False
+        if kind == JSON_COLUMN:
+            data = json.dumps(values, separators=(",", ":"))
+        else:
+            data = ""
+            if None in values:
+                masked = True
+                data += np.array([each_value is not None for each_value in values], dtype=np.uint8).tostring()
+                values = [0 if each_value is None else each_value for each_value in values]
+            data += np.array(values, dtype=COLUMN_DTYPES[kind]).tostring()
+        columns.append([name, kind, masked, len(data)])
+        parts.append(data)
+
+    header = json.dumps({"s": series_id, "n": len(times), "c": columns}, separators=(",", ":"))
+    return CHUNK_HEADER.pack(len(header)) + header + "".join(parts)
+
+def decode_chunk(data):
+    # Returns (series id, times, [(name, values, presence mask or None), ...])
+    header_length, = CHUNK_HEADER.unpack_from(data, 0)
+    offset = CHUNK_HEADER.size
+    header = json.loads(data[offset:offset + header_length])
+    offset += header_length
+
+    num_rows = header["n"]
+    times = np.frombuffer(data, dtype=TIME_DTYPE, count=num_rows, offset=offset)
+    offset += num_rows * TIME_DTYPE.itemsize
+
+    columns = []
+    for name, kind, masked, length in header["c"]:
+        column_data = data[offset:offset + length]
+        offset += length
+        mask = None
+        if kind == JSON_COLUMN:
+            values = json.loads(column_data)
+        else:
+            column_offset = 0
+            if masked:
+                mask = np.frombuffer(column_data, dtype=np.uint8, count=num_rows).astype(bool)
+                column_offset = num_rows
+            values = np.frombuffer(column_data, dtype=COLUMN_DTYPES[kind], count=num_rows, offset=column_offset).tolist()
+        columns.append((name, values, mask))
+    return header["s"], times, columns
+
+class EmbeddedStore(StorageBackend):
+
+    def __init__(self, directory, fsync=True):
+        self.directory = directory
+        self.fsync = fsync
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.series_ids = {}
+        self.series_keys = []
+        # Per series id, a list of (first time, last time, offset, length) in the order written
+        self.chunks = []
+        self._load()
+
+        self.series_file = open(self._path(SERIES_FILENAME), "ab")
+        self.data_file = open(self._path(DATA_FILENAME), "ab")
+        self.index_file = open(self._path(INDEX_FILENAME), "ab")
+        # Cut off anything left half written by a crash
+        self.series_file.truncate(self.series_end)
+        self.data_file.truncate(self.data_end)
+        self.index_file.truncate(self.num_index_entries * INDEX_ENTRY.size)
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def _load(self):
+        self.series_end = 0
+        try:
+            with open(self._path(SERIES_FILENAME), "rb") as series_file:
+                for each_line in series_file:
+                    if not each_line.endswith("\n"):
+                        break
+                    try:
+                        measurement, tags = json.loads(each_line)
+                    except ValueError:
+                        break
+                    self.series_end += len(each_line)
+                    self.series_ids[series_key(measurement, tags)] = len(self.series_keys)
+                    self.series_keys.append(series_key(measurement, tags))
+                    self.chunks.append([])
+        except IOError:
+            pass
+
+        try:
+            data_size = os.path.getsize(self._path(DATA_FILENAME))
+        except OSError:
+            data_size = 0
+        self.data_end = 0
+        self.num_index_entries = 0
+        try:
+            with open(self._path(INDEX_FILENAME), "rb") as index_file:
+                index_data = index_file.read()
+        except IOError:
+            index_data = ""
+        for offset in range(0, len(index_data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+            series_id, first_time, last_time, chunk_offset, length = INDEX_ENTRY.unpack_from(index_data, offset)
+            if chunk_offset + length > data_size or series_id >= len(self.series_keys):
+                break
+            self.chunks[series_id].append((first_time, last_time, chunk_offset, length))
+            self.data_end = chunk_offset + length
+            self.num_index_entries += 1
+
+    def _series_id(self, key):
+        # Caller holds the lock
+        series_id = self.series_ids.get(key)
+        if series_id is None:
+            measurement, tags = key
+            self.series_file.write(json.dumps([measurement, dict(tags)], separators=(",", ":")) + "\n")
+            series_id = self.series_ids[key] = len(self.series_keys)
+            self.series_keys.append(key)
+            self.chunks.append([])
+        return series_id
+
+    def write_points(self, points, time_precision='s'):
+        if time_precision not in (None, 's'):
+            raise ValueError("The embedded store only keeps times in seconds, not %s" % time_precision)
+
+        rows_by_series = group_by_series(points)
+
+        with self.lock:
+            chunks = []
+            index_entries = []
+            new_chunks = []
+            offset = self.data_end
+            for key, rows in rows_by_series.iteritems():
+                series_id = self._series_id(key)
+                times = [row[0] for row in rows]
+                chunk = encode_chunk(series_id, times, [row[1] for row in rows])
+                chunks.append(chunk)
+                index_entries.append(INDEX_ENTRY.pack(series_id, times[0], times[-1], offset, len(chunk)))
+                new_chunks.append((series_id, (times[0], times[-1], offset, len(chunk))))
+                offset += len(chunk)
+
+            # Series first, then the data, then the index, so the index never points at something missing
+            try:
+                self.series_file.flush()
+                self.data_file.write("".join(chunks))
+                self.data_file.flush()
+                if self.fsync:
+                    os.fsync(self.series_file.fileno())
+                    os.fsync(self.data_file.fileno())
+                self.index_file.write("".join(index_entries))
+                self.index_file.flush()
+                if self.fsync:
+                    os.fsync(self.index_file.fileno())
+            except:
+                # Don't leave a partial write behind for the next one to be appended after
+                self.data_file.truncate(self.data_end)
+                self.index_file.truncate(self.num_index_entries * INDEX_ENTRY.size)
+                raise
+
+            self.data_end = offset
+            self.num_index_entries += len(index_entries)
+            for series_id, entry in new_chunks:
+                self.chunks[series_id].append(entry)
+
+    def matching_series(self, measurement, tags=None):
+        # Returns the ids of the series in a measurement whose tags include tags
+        wanted = set((tags or {}).iteritems())
+        with self.lock:
+            return [series_id for series_id, (series_measurement, series_tags) in enumerate(self.series_keys)
+                    if series_measurement == measurement and wanted.issubset(series_tags)]
+
+    def query_range(self, measurement, tags=None, start=None, end=None, fields=None):
+        points = []
+        with open(self._path(DATA_FILENAME), "rb") as data_file:
+            for series_id in self.matching_series(measurement, tags):
+                with self.lock:
+                    series_measurement, series_tags = self.series_keys[series_id]
+                    chunks = [each_chunk for each_chunk in self.chunks[series_id]
+                              if (start is None or each_chunk[1] >= start) and (end is None or each_chunk[0] <= end)]
+
+                fields_by_time = {}
+                for first_time, last_time, offset, length in chunks:
+                    data_file.seek(offset)
+                    chunk_series_id, times, columns = decode_chunk(data_file.read(length))
+                    lo = 0 if start is None else np.searchsorted(times, start, side="left")
+                    hi = len(times) if end is None else np.searchsorted(times, end, side="right")
+                    for name, values, mask in columns:
+                        if fields and name not in fields:
+                            continue
+                        for i in range(lo, hi):
+                            if mask is not None and not mask[i]:
+                                continue
+                            if values[i] is None:
+                                continue
+                            point_fields = fields_by_time.get(times[i])
+                            if point_fields is None:
+                                point_fields = fields_by_time[times[i]] = {}
+                            point_fields[name] = values[i]
+
+                for timestamp in sorted(fields_by_time):
+                    points.append({
+                        "measurement": series_measurement,
+                        "tags": dict(series_tags),
+                        "time": int(timestamp),
+                        "fields": fields_by_time[timestamp]
+                    })
+        return points
+
+    def close(self):
+        with self.lock:
+            for each_file in (self.series_file, self.data_file, self.index_file):
+                each_file.close()
@@ -0,0 +1,600 @@
+'''
+ESBox fleet simulator and load generator
+
+Runs thousands of virtual ESBoxes against an ESCo (writetodb.py) from one
+process, so the server's saturation point can be found without a room full
+of SS9002s. Each virtual ESBox:
+  - checks in every --interval seconds with a NoFurtherMessages container,
+    using protocol 1.1 or (for --v10-fraction of the fleet) 1.0
+  - follows the server's replies until it's told to close the connection,
+    answering GetData (latest readings or stream database) and
+    GetLatestReadings with data from its meters, GetSupportedVersions (1.1
+    boxes only) and GetDeviceList, and anything else with NoFurtherMessages.
+    Like a real ESBox it replies in whichever protocol version the server
+    used.
+  - has --meters simulated single phase meters attached, reporting every
+    --report-interval seconds. Voltage, current and power factor wander
+    around realistic values and the energy registers count up to match.
+
+With --compress, container bodies are sent gzipped and gzipped responses
+are accepted.
+
+Latency percentiles, throughput and errors are printed every
+--print-interval seconds and again at the end (optionally as JSON too).
+
+Example:
+
+    python esbox_simulator.py --boxes 2000 --duration 120 http://localhost:8081/
+
+'''
+
+from __future__ import division
+
+import argparse
+from collections import deque
+import json
+import math
+import random
+import time
+import zlib
+
+import numpy as np
+from twisted.internet import defer, reactor
+from twisted.web.client import Agent, ContentDecoderAgent, GzipDecoder, HTTPConnectionPool, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+from StringIO import StringIO
+
+import SSMessages_8834 as M
+from attributes import ATTRIBUTES, SM
+from router import get_protocol, PROTOCOL_1_0, PROTOCOL_1_1
+
+DEFAULT_URL = "http://localhost:8081/"
+DEFAULT_NUM_BOXES = 100
+DEFAULT_METERS_PER_BOX = 4
+DEFAULT_CHECK_IN_INTERVAL = 10 # sec
+DEFAULT_REPORT_INTERVAL = 10 # sec, how often each meter reports its readings
+DEFAULT_DURATION = 60 # sec
+DEFAULT_MAX_CONNECTIONS = 500
+DEFAULT_REQUEST_TIMEOUT = 30 # sec
+DEFAULT_PRINT_INTERVAL = 10 # sec
+
+# A session that hasn't been closed after this many exchanges is abandoned
+MAX_EXCHANGES = 20
+
+# How many stream database cells an ESBox keeps before the oldest are overwritten
+SDB_CAPACITY = 5000
+
+ESBOX_VERSION = "SS9002.1.2_13270_13017_5651_?_?"
+METER_MODEL_ID = "SS9007.2.0_6000_2290_SSHA_R"
+ESBOX_IEEE_BASE = 0x001BC502B0200000
+METER_IEEE_BASE = 0x001BC502B0300000
+METER_ENDPOINT = 10
+
+# Simple Metering attribute ids and divisors, by field name
+SM_ATTRIBUTES = dict((each_attr.name, (each_attr.attr_id, each_attr.divisor))
+                     for each_attr in ATTRIBUTES if (each_attr.cluster_id, each_attr.manufacturer) == SM)
+
+# What a single phase meter reports, and the type the ESBox normalises each value to
+METER_FIELDS = [
+    ("voltage", M.V.Dat.Type.Uint),
+    ("current", M.V.Dat.Type.Uint),
+    ("power_w", M.V.Dat.Type.Int),
+    ("power_var", M.V.Dat.Type.Int),
+    ("power_factor", M.V.Dat.Type.Int),
+    ("energy_import_wh", M.V.Dat.Type.Int),
+    ("energy_import_varh", M.V.Dat.Type.Int),
+    ("frequency", M.V.Dat.Type.Uint),
+    ("temperature", M.V.Dat.Type.Int),
+    ("energy_export_wh", M.V.Dat.Type.Int),
+    ("energy_export_varh", M.V.Dat.Type.Int),
+]
+
+def format_ieee(address):
+    return "%016X" % address
+
+#---------------------------------------------------------------------------#
+# Simulated meters
+#---------------------------------------------------------------------------#
+
+class SimulatedMeter():
+    # A single phase meter (SS9000/SS9007) on the Simple Metering cluster
+
+    def __init__(self, han, report_interval, start_time):
+        self.han = han
+        self.endpoint = METER_ENDPOINT
+        self.report_interval = report_interval
+        # Spread the reports out so the meters on a box don't all report together
+        self.next_report = start_time + random.uniform(0, report_interval)
+
+        self.nominal_voltage = random.choice((230.0, 240.0))
+        self.max_current = random.choice((10.0, 20.0, 32.0))
+        self.voltage = self.nominal_voltage
+        self.current = random.uniform(0, self.max_current / 2)
+        self.power_factor = random.uniform(0.85, 1.0)
+        self.frequency = 50.0
+        self.temperature = random.uniform(20, 35)
+        self.has_solar = random.random() < 0.2
+        self.energy_import_wh = random.uniform(0, 5e6)
+        self.energy_import_varh = random.uniform(0, 1e5)
+        self.energy_export_wh = random.uniform(0, 1e6) if self.has_solar else 0.0
+        self.energy_export_varh = random.uniform(0, 1e6)
+
+    def step(self, elapsed):
+        # Move the readings on by elapsed seconds
+        self.voltage = min(max(self.voltage + random.gauss(0, 0.5) + (self.nominal_voltage - self.voltage) * 0.1,
+                               self.nominal_voltage * 0.94), self.nominal_voltage * 1.1)
+        self.current = min(max(self.current + random.gauss(0, 0.3), 0.0), self.max_current)
+        self.power_factor = min(max(self.power_factor + random.gauss(0, 0.01), 0.5), 1.0)
+        self.frequency = 50.0 + random.gauss(0, 0.02)
+        self.temperature = min(max(self.temperature + random.gauss(0, 0.05), 0.0), 60.0)
+
+        apparent_power = self.voltage * self.current
+        power_w = apparent_power * self.power_factor
+        power_var = apparent_power * math.sin(math.acos(self.power_factor))
+        if self.has_solar and random.random() < 0.3:
+            # Exporting
+            power_w = -power_w
+            self.energy_export_wh += -power_w * elapsed / 3600
+        else:
+            self.energy_import_wh += power_w * elapsed / 3600
+        if power_var > 0:
+            self.energy_import_varh += power_var * elapsed / 3600
+        return {
+            "voltage": self.voltage,
+            "current": self.current,
+            "power_w": power_w,
+            "power_var": -power_var,
+            "power_factor": self.power_factor,
+            "energy_import_wh": self.energy_import_wh,
+            "energy_import_varh": self.energy_import_varh,
+            "frequency": self.frequency,
+            "temperature": self.temperature,
+            "energy_export_wh": self.energy_export_wh,
+            "energy_export_varh": self.energy_export_varh,
+        }
+
+    def reports_due(self, now):
+        # Yields (report time, [(attr id, type, raw value), ...]) for every report up to now
+        while self.next_report <= now:
+            readings = self.step(self.report_interval)
+            attributes = []
+            for name, attr_type in METER_FIELDS:
+                attr_id, divisor = SM_ATTRIBUTES[name]
+                attributes.append((attr_id, attr_type, int(round(readings[name] * divisor))))
+            yield int(self.next_report), attributes
+            self.next_report += self.report_interval
+
+#---------------------------------------------------------------------------#
+# Virtual ESBoxes
+#---------------------------------------------------------------------------#
+
+class VirtualESBox():
+
+    def __init__(self, number, version, num_meters, report_interval, clock_offset=0):
+        self.ieee = format_ieee(ESBOX_IEEE_BASE + number)
+        self.link_key = "%032X" % random.getrandbits(128)
+        self.protocol = PROTOCOL_1_1 if version == PROTOCOL_1_1.version else PROTOCOL_1_0
+        # Seconds the ESBox's clock is out by (see timebase.py)
+        self.clock_offset = clock_offset
+
+        now = time.time()
+        self.meters = [SimulatedMeter(format_ieee(METER_IEEE_BASE + number * num_meters + i), report_interval, now)
+                       for i in range(num_meters)]
+        # Latest reading of each attribute by (HAN, endpoint), and everything reported for the stream database
+        self.latest_readings = {}
+        self.sdb = deque(maxlen=SDB_CAPACITY)
+
+    def esbox_time(self, now):
+        return int(now) + self.clock_offset
+
+    def update(self, now):
+        # Collect every meter report made since the last check-in
+        for each_meter in self.meters:
+            for report_time, attributes in each_meter.reports_due(now):
+                esbox_time = report_time + self.clock_offset
+                key = (each_meter.han, each_meter.endpoint)
+                self.latest_readings[key] = (esbox_time, attributes)
+                self.sdb.append((each_meter.han, each_meter.endpoint, esbox_time, attributes))
+
+    def generate_container(self, protocol, messages, now):
+        container = {}
+        container[protocol.version_key] = protocol.version
+        container[protocol.esbox_version_key] = ESBOX_VERSION
+        container[M.F.Gen.Auth] = [self.ieee, self.link_key]
+        if protocol is PROTOCOL_1_1:
+            container[M.F.Dat.Time_1_1] = self.esbox_time(now)
+        else:
+            container[M.F.Dat.Time] = self.esbox_time(now)
+        container[protocol.messages_key] = messages
+        return container
+
+    def generate_message(self, protocol, msg_id):
+        new_message = {}
+        new_message[protocol.msg_id_key] = msg_id
+        new_message[protocol.cluster_key] = {protocol.cluster_id_key: M.ClusterParts.SS_ESB.ClusterId,
+                                             protocol.manufacturer_key: M.ClusterParts.SS_ESB.ClusterManufacturer}
+        return new_message
+
+    def generate_no_further_messages(self, protocol):
+        if protocol is PROTOCOL_1_1:
+            return self.generate_message(protocol, M.SS_ESB.E.NoFurtherMessages_1_1)
+        return self.generate_message(protocol, M.SS_ESB.E.NoFurtherMessages)
+
+    def generate_latest_readings(self):
+        # SendData from the latest readings buffer (1.1). Returns (message, number of attributes).
+        data = []
+        num_attributes = 0
+        for (han, endpoint), (esbox_time, attributes) in self.latest_readings.iteritems():
+            attrs = []
+            for attr_id, attr_type, value in attributes:
+                attrs.append({M.F.Dat.AttributeID_1_1: attr_id, M.F.Dat.Type_1_1: attr_type,
+                              M.F.Dat.Time_1_1: esbox_time, M.F.Dat.Data_1_1: value})
+            num_attributes += len(attrs)
+            data.append({M.F.Nwk.HAN_1_1: han, M.F.Nwk.EndpointID_1_1: endpoint,
+                         M.F.Dat.Clusters_1_1: [{M.F.Gen.Cluster_1_1: M.Clusters_1_1.SM,
+                                                 M.F.Dat.Attributes_1_1: attrs}]})
+        new_message = self.generate_message(PROTOCOL_1_1, M.SS_ESB.E.SendData)
+        new_message[M.F.Dat.Source] = M.V.Dat.Source.LatestReadings_1_1
+        new_message[M.F.Dat.Data_1_1] = data
+        return new_message, num_attributes
+
+    def generate_send_latest_readings_1_0(self):
+        # SendLatestReadings (1.0). The 1.0 buffer is emptied as it's read.
+        endpoints = []
+        num_attributes = 0
+        for (han, endpoint), (esbox_time, attributes) in self.latest_readings.iteritems():
+            attrs = []
+            for attr_id, attr_type, value in attributes:
+                attrs.append({M.F.Dat.DataTime: esbox_time, M.F.Dat.AttributeID: attr_id, M.F.Dat.Value: value})
+            num_attributes += len(attrs)
+            endpoints.append({M.F.Nwk.DevIEEE: han, M.F.Nwk.EndpointID: endpoint,
+                              M.F.Dat.Clusters: [{M.F.Dat.DataCluster: {M.F.Gen.ClusterID: M.ClusterParts.SM.ClusterId,
+                                                                        M.F.Gen.ClusterManufacturer: M.ClusterParts.SM.ClusterManufacturer},
+                                                  M.F.Dat.Attributes: attrs}]})
+        self.latest_readings = {}
+        new_message = self.generate_message(PROTOCOL_1_0, M.SS_ESB.E.SendLatestReadings)
+        new_message[M.F.Nwk.Endpoints] = endpoints
+        return new_message, num_attributes
+
+    def generate_send_device_list(self, detailed=False, now=None):
+        # SendDeviceList (1.1): the ESBox's coordinator and its meters, with their neighbour
+        # tables if detailed
+        if now is None:
+            now = time.time()
+        esbox_time = self.esbox_time(now)
+        devices = [{M.F.Nwk.HAN_1_1: self.ieee, M.F.Nwk.ModelID_1_1: ESBOX_VERSION,
+                    M.F.Nwk.ManufacturerName_1_1: "Saturn South", M.F.Nwk.LocationDescription_1_1: "",
+                    M.F.Nwk.OnlineStatus_1_1: M.V.Nwk.Online_1_1, M.F.Nwk.NodeType_1_1: M.V.Nwk.ZigBeeCoordinator,
+                    M.F.Nwk.JoinTime_1_1: esbox_time - 86400, M.F.Nwk.LastContact_1_1: esbox_time,
+                    M.F.Nwk.LastRejoinTime_1_1: esbox_time - 86400, M.F.Nwk.IsCoordForThisESBox_1_1: 1,
+                    M.F.Nwk.PermitJoiningEnabled_1_1: 0}]
+        for each_meter in self.meters:
+            device = {M.F.Nwk.HAN_1_1: each_meter.han, M.F.Nwk.ModelID_1_1: METER_MODEL_ID,
+                      M.F.Nwk.ManufacturerName_1_1: "Saturn South", M.F.Nwk.LocationDescription_1_1: "",
+                      M.F.Nwk.OnlineStatus_1_1: M.V.Nwk.Online_1_1, M.F.Nwk.NodeType_1_1: M.V.Nwk.ZigBeeEndDevice,
+                      M.F.Nwk.JoinTime_1_1: esbox_time - 86000, M.F.Nwk.LastContact_1_1: esbox_time - random.randint(0, 60),
+                      M.F.Nwk.LastRejoinTime_1_1: esbox_time - 86000,
+                      M.F.Nwk.LQI: {M.F.Nwk.CoordLQI_1_1: random.randint(100, 255),
+                                    M.F.Nwk.EndDeviceLQI_1_1: random.randint(100, 255)}}
+            if detailed:
+                device[M.F.Nwk.Detailed_1_1] = {M.F.Nwk.Neighbours_1_1: [
+                    {M.F.Nwk.PANAddr_1_1: self.ieee, M.F.Nwk.HAN_1_1: self.ieee, M.F.Nwk.NwkAddr_1_1: "0000",
+                     M.F.Nwk.DeviceProperties_1_1: 37, M.F.Nwk.PermitJoiningEnabled_1_1: 0, M.F.Nwk.Depth_1_1: 0,
+                     M.F.Nwk.LQI: random.randint(100, 255)}]}
+            devices.append(device)
+        new_message = self.generate_message(PROTOCOL_1_1, M.SS_ESB.E.SendDeviceList_1_1)
+        new_message[M.F.Nwk.DeviceList_1_1] = devices
+        return new_message
+
+    def generate_send_supported_versions(self):
+        new_message = self.generate_message(PROTOCOL_1_1, M.SS_ESB.E.SendSupportedVersions_1_1)
+        new_message[M.F.Gen.ProtocolVersions_1_1] = [PROTOCOL_1_0.version, PROTOCOL_1_1.version]
+        return new_message
+
+    def generate_stream_data(self, request):
+        # SendData from the stream database (1.1), honouring the request's cell count and
+        # delta encoding options. Returns (message, number of attributes).
+        num_cells = min(request.get(M.F.Dat.Sdb.NCells, 10), len(self.sdb))
+        delta_han = request.get(M.F.Dat.Sdb.DelIeee, 1)
+        delta_endpoint = request.get(M.F.Dat.Sdb.DelEP, 1)
+        delta_cluster = request.get(M.F.Dat.Sdb.DelClu, 1)
+        delta_time = request.get(M.F.Dat.Sdb.DelTime, 1)
+
+        cells = []
+        num_attributes = 0
+        previous = None
+        for i in range(num_cells):
+            han, endpoint, esbox_time, attributes = self.sdb.popleft()
+            cell = {}
+            if not delta_han or previous is None or han != previous[0]:
+                cell[M.F.Nwk.HAN_1_1] = han
+            if not delta_endpoint or previous is None or endpoint != previous[1]:
+                cell[M.F.Nwk.EndpointID_1_1] = endpoint
+            if not delta_cluster or previous is None:
+                cell[M.F.Gen.Cluster_1_1] = M.Clusters_1_1.SM
+            if not delta_time or previous is None:
+                cell[M.F.Dat.Time_1_1] = esbox_time
+            elif esbox_time != previous[2]:
+                cell[M.F.Dat.DeltaTime_1_1] = esbox_time - previous[2]
+            cell[M.F.Dat.Attributes_1_1] = [{M.F.Dat.AttributeID_1_1: attr_id, M.F.Dat.Type_1_1: attr_type,
+                                             M.F.Dat.Value_1_1: value} for attr_id, attr_type, value in attributes]
+            num_attributes += len(attributes)
+            cells.append(cell)
+            previous = (han, endpoint, esbox_time)
+
+        new_message = self.generate_message(PROTOCOL_1_1, M.SS_ESB.E.SendData)
+        new_message[M.F.Dat.Source] = M.V.Dat.Source.Sdb
+        new_message[M.F.Dat.Data_1_1] = {M.F.Dat.Sdb.Fifo: request.get(M.F.Dat.Sdb.Fifo, 0),
+                                         M.F.Dat.Sdb.Cells: cells}
+        return new_message, num_attributes
+
+    def start_session(self, now):
+        self.update(now)
+        return self.generate_container(self.protocol, [self.generate_no_further_messages(self.protocol)], now)
+
+    def respond(self, response, stats, now):
+        # Work out the reply to a container from the server. Returns None when the
+        # server has closed the connection. stats is told about anything worth counting.
+        protocol = get_protocol(response)
+        if protocol is None or protocol.messages_key not in response:
+            stats.add_error("bad_container")
+            return None
+        closed = False
+        messages = []
+        for each_message in response[protocol.messages_key]:
+            msg_id = each_message.get(protocol.msg_id_key)
+            if msg_id in (M.SS_ESB.E.CloseConnection_1_1, M.SS_ESB.E.CloseConnection):
+                closed = True
+            elif msg_id in (M.SS_ESB.E.NotAuthenticated_1_1, M.SS_ESB.E.NotAuthenticated):
+                stats.add_error("not_authenticated")
+                closed = True
+            elif protocol is PROTOCOL_1_1 and msg_id == M.SS_ESB.E.GetData_1_1:
+                source = each_message.get(M.F.Dat.Source, M.V.Dat.Source.Sdb)
+                if source == M.V.Dat.Source.LatestReadings_1_1:
+                    new_message, num_attributes = self.generate_latest_readings()
+                else:
+                    new_message, num_attributes = self.generate_stream_data(each_message)
+                messages.append(new_message)
+                stats.count("num_attributes_sent", num_attributes)
+            elif protocol is PROTOCOL_1_1 and msg_id == M.SS_ESB.E.GetSupportedVersions_1_1:
+                # 1.0 firmware doesn't know it, and ignores it
+                if self.protocol is PROTOCOL_1_1:
+                    messages.append(self.generate_send_supported_versions())
+                else:
+                    stats.count("num_ignored_messages")
+            elif protocol is PROTOCOL_1_1 and msg_id == M.SS_ESB.E.GetDeviceList_1_1:
+                messages.append(self.generate_send_device_list(each_message.get(M.F.Nwk.Detailed_1_1, False), now))
+            elif protocol is PROTOCOL_1_0 and msg_id == M.SS_ESB.E.GetLatestReadings:
+                new_message, num_attributes = self.generate_send_latest_readings_1_0()
+                messages.append(new_message)
+                stats.count("num_attributes_sent", num_attributes)
+            else:
+                stats.count("num_ignored_messages")
+        if closed:
+            return None
+        if not messages:
+            messages.append(self.generate_no_further_messages(protocol))
+        return self.generate_container(protocol, messages, now)
+
+#---------------------------------------------------------------------------#
+# Statistics
+#---------------------------------------------------------------------------#
+
+class LoadStats():
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.latencies = []
+        self.num_requests = 0
+        self.num_sessions = 0
+        self.num_abandoned_sessions = 0
+        self.num_attributes_sent = 0
+        self.num_ignored_messages = 0
+        self.num_bytes_sent = 0
+        self.errors = {}
+
+    def add_error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def num_errors(self):
+        return sum(self.errors.itervalues())
+
+    def summary(self, now=None):
+        if now is None:
+            now = time.time()
+        elapsed = max(now - self.start_time, 1e-9)
+        summary = {
+            "elapsed": elapsed,
+            "requests": self.num_requests,
+            "requests_per_sec": self.num_requests / elapsed,
+            "sessions": self.num_sessions,
+            "abandoned_sessions": self.num_abandoned_sessions,
+            "attributes_per_sec": self.num_attributes_sent / elapsed,
+            "bytes_per_sec": self.num_bytes_sent / elapsed,
+            "ignored_messages": self.num_ignored_messages,
+            "errors": dict(self.errors),
+            "error_rate": self.num_errors() / max(self.num_requests, 1),
+        }
+        if self.latencies:
+            latencies = np.array(self.latencies) * 1000
+            p50, p90, p99, p999 = np.percentile(latencies, [50, 90, 99, 99.9])
+            summary["latency_ms"] = {"mean": latencies.mean(), "p50": p50, "p90": p90, "p99": p99,
+                                     "p99.9": p999, "max": latencies.max()}
+        return summary
+
+def print_summary(title, summary):
+    print "%s (%.1f sec)" % (title, summary["elapsed"])
+    print "\t%d requests (%.1f/sec), %d sessions, %d abandoned" % (
+        summary["requests"], summary["requests_per_sec"], summary["sessions"], summary["abandoned_sessions"])
+    print "\t%.1f attributes/sec, %.1f kB/sec sent" % (summary["attributes_per_sec"], summary["bytes_per_sec"] / 1024)
+    if "latency_ms" in summary:
+        latency = summary["latency_ms"]
+        print "\tlatency ms: mean %.1f  p50 %.1f  p90 %.1f  p99 %.1f  p99.9 %.1f  max %.1f" % (
+            latency["mean"], latency["p50"], latency["p90"], latency["p99"], latency["p99.9"], latency["max"])
+    print "\terror rate %.3f%% %s" % (summary["error_rate"] * 100, summary["errors"] or "")
+
+#---------------------------------------------------------------------------#
+# Load generator
+#---------------------------------------------------------------------------#
+
+class FleetSimulator():
+
+    def __init__(self, url, boxes, check_in_interval, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 request_timeout=DEFAULT_REQUEST_TIMEOUT, compress=False):
+        self.url = url
+        self.boxes = boxes
+        self.check_in_interval = check_in_interval
+        self.request_timeout = request_timeout
+        self.compress = compress
+        # Every exchange is a new connection, as it would be from separate ESBoxes
+        self.agent = Agent(reactor, pool=HTTPConnectionPool(reactor, persistent=False), connectTimeout=request_timeout)
+        if compress:
+            # Sends Accept-Encoding: gzip and decompresses the responses
+            self.agent = ContentDecoderAgent(self.agent, [("gzip", GzipDecoder)])
+        self.connections = defer.DeferredSemaphore(max_connections)
+        self.stats = LoadStats()
+        self.window = LoadStats()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.stats = LoadStats()
+        self.window = LoadStats()
+        for each_box in self.boxes:
+            # Ramp up over one interval rather than having every box check in at once
+            reactor.callLater(random.uniform(0, self.check_in_interval), self.run_session, each_box)
+
+    def stop(self):
+        self.running = False
+
+    def count(self, name, amount=1):
+        for each_stats in (self.stats, self.window):
+            setattr(each_stats, name, getattr(each_stats, name) + amount)
+
+    def add_error(self, kind):
+        self.stats.add_error(kind)
+        self.window.add_error(kind)
+
+    @defer.inlineCallbacks
+    def exchange(self, container):
+        # PUT one container and return the decoded response (None on error)
+        body = json.dumps(container)
+        headers = Headers({"Content-Type": ["application/json"]})
+        if self.compress:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers.addRawHeader("Content-Encoding", "gzip")
+        self.count("num_bytes_sent", len(body))
+        yield self.connections.acquire()
+        start_time = time.time()
+        try:
+            d = self.agent.request("PUT", self.url, headers, FileBodyProducer(StringIO(body)))
+            d.addTimeout(self.request_timeout, reactor)
+            response = yield d
+            data = yield readBody(response)
+        except Exception as e:
+            self.add_error(e.__class__.__name__)
+            defer.returnValue(None)
+        finally:
+            self.connections.release()
+        latency = time.time() - start_time
+        self.count("num_requests")
+        self.stats.latencies.append(latency)
+        self.window.latencies.append(latency)
+
+        if response.code != 200:
+            self.add_error("http_%d" % response.code)
+            defer.returnValue(None)
+        try:
+            defer.returnValue(json.loads(data))
+        except ValueError:
+            self.add_error("bad_json")
+            defer.returnValue(None)
+
+    @defer.inlineCallbacks
+    def run_session(self, box):
+        if not self.running:
+            return
+        session_start = time.time()
+        container = box.start_session(session_start)
+        for i in range(MAX_EXCHANGES):
+            response = yield self.exchange(container)
+            if response is None:
+                break
+            container = box.respond(response, self, time.time())
+            if container is None:
+                break
+        else:
+            self.count("num_abandoned_sessions")
+        self.count("num_sessions")
+
+        if self.running:
+            # Check in again one interval after this session started, like the ESBox does
+            delay = max(self.check_in_interval - (time.time() - session_start), 0)
+            reactor.callLater(delay * random.uniform(0.95, 1.05), self.run_session, box)
+
+    def print_window(self):
+        print_summary("Last window", self.window.summary())
+        self.window = LoadStats()
+
+def build_fleet(num_boxes, meters_per_box, report_interval, v10_fraction, bad_clock_fraction):
+    boxes = []
+    for number in range(num_boxes):
+        if random.random() < v10_fraction:
+            version = PROTOCOL_1_0.version
+        else:
+            version = PROTOCOL_1_1.version
+        clock_offset = 0
+        if random.random() < bad_clock_fraction:
+            # Some ESBoxes have a clock that is decades out (see Raw_data)
+            clock_offset = random.randint(10 ** 8, 15 * 10 ** 8)
+        boxes.append(VirtualESBox(number, version, meters_per_box, report_interval, clock_offset))
+    return boxes
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of ESBoxes checking in to an ESCo")
+    parser.add_argument("url", nargs="?", default=DEFAULT_URL)
+    parser.add_argument("--boxes", type=int, default=DEFAULT_NUM_BOXES)
+    parser.add_argument("--meters", type=int, default=DEFAULT_METERS_PER_BOX, help="meters per ESBox")
+    parser.add_argument("--interval", type=float, default=DEFAULT_CHECK_IN_INTERVAL, help="check-in interval (sec)")
+    parser.add_argument("--report-interval", type=float, default=DEFAULT_REPORT_INTERVAL,
+                        help="meter reporting interval (sec)")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="how long to run for (sec)")
+    parser.add_argument("--v10-fraction", type=float, default=0.1, help="fraction of ESBoxes starting in protocol 1.0")
+    parser.add_argument("--bad-clock-fraction", type=float, default=0.1,
+                        help="fraction of ESBoxes with a badly set clock")
+    parser.add_argument("--max-connections", type=int, default=DEFAULT_MAX_CONNECTIONS)
+    parser.add_argument("--timeout", type=float, default=DEFAULT_REQUEST_TIMEOUT, help="request timeout (sec)")
+    parser.add_argument("--print-interval", type=float, default=DEFAULT_PRINT_INTERVAL)
+    parser.add_argument("--compress", action="store_true", help="gzip containers and accept gzipped responses")
+    parser.add_argument("--json", help="write the final summary to this file")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    boxes = build_fleet(args.boxes, args.meters, args.report_interval, args.v10_fraction, args.bad_clock_fraction)
+    simulator = FleetSimulator(args.url, boxes, args.interval, args.max_connections, args.timeout, args.compress)
+
+    def print_window():
+        simulator.print_window()
+        if simulator.running:
+            reactor.callLater(args.print_interval, print_window)
+
+    def finish():
+        simulator.stop()
+        summary = simulator.stats.summary()
+        print_summary("Total: %d ESBoxes, %d meters" % (len(boxes), len(boxes) * args.meters), summary)
+        if args.json:
+            with open(args.json, "w") as json_file:
+                json.dump(summary, json_file, indent=2)
+        reactor.stop()
+
+    print "Simulating %d ESBoxes with %d meters each against %s" % (len(boxes), args.meters, args.url)
+    reactor.callWhenRunning(simulator.start)
+    reactor.callLater(args.print_interval, print_window)
+    reactor.callLater(args.duration, finish)
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
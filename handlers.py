@@ -0,0 +1,61 @@
+'''
+Handlers for the ESBox messages that carry readings
+
+These build the points from a container's SendData messages. They're kept out
+of writetodb.py, which starts the whole ESCo when it's imported, so that
+bench_ingest.py can time exactly the handlers the server runs.
+
+Each handler takes the message and the container it came in, which must have:
+  - esbox_id:      the ESBox's IEEE, or None
+  - point_builder: the points.PointBuilder for the container
+  - sdb_drain:     the sdb.SdbDrain told how many stream database cells
+                   arrived, or None
+
+'''
+
+import logging
+
+import SSMessages_8834 as M
+from keys import DATA, SOURCE, HAN, ENDPOINT_ID, CLUSTERS, CLUSTER, ATTRIBUTES, CELLS
+from logs import fields
+from sdb import decode_cells
+
+log = logging.getLogger(__name__)
+
+def handle_no_further_messages(message, container):
+    pass
+
+def handle_latest_readings(message, container):
+    add_cluster = container.point_builder.add_cluster
+    for each_han_endpoint in message[DATA]:
+        this_node_ieee = each_han_endpoint[HAN]
+        this_endpoint_id = each_han_endpoint[ENDPOINT_ID]
+        for each_cluster in each_han_endpoint[CLUSTERS]:
+            # All of the cluster's attributes read at the same time go into one point
+            add_cluster(this_node_ieee, this_endpoint_id, each_cluster[CLUSTER], each_cluster[ATTRIBUTES])
+
+def handle_stream_data(message, container):
+    # Delta encoded cells from the stream database
+    columns = decode_cells(message[DATA][CELLS])
+    container.point_builder.add_columns(columns)
+    if container.sdb_drain is not None:
+        container.sdb_drain.received(container.esbox_id, columns.num_cells)
+
+DATA_SOURCE_HANDLERS = {
+    M.V.Dat.Source.LatestReadings_1_1: handle_latest_readings,
+    M.V.Dat.Source.Sdb: handle_stream_data,
+}
+
+def handle_send_data(message, container):
+    handler = DATA_SOURCE_HANDLERS.get(message.get(SOURCE))
+    if handler is None:
+        log.warning("Received data from an unsupported source from ESBox %s", container.esbox_id,
+                    extra=fields(source=message.get(SOURCE)))
+        return
+    handler(message, container)
+
+def register(router):
+    # Registers the handlers with a router.MessageRouter. 1.0 containers are normalised to 1.1
+    # before they're routed, so only the 1.1 messages need handlers.
+    router.register("1.1", M.SS_ESB.E.NoFurtherMessages_1_1, M.ClusterParts.Common, handle_no_further_messages)
+    router.register("1.1", M.SS_ESB.E.SendData, M.ClusterParts.SS_ESB, handle_send_data)
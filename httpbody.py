@@ -0,0 +1,413 @@
+'''
+ESBox request and response bodies
+
+Request bodies are decoded as they arrive rather than being buffered whole.
+ESBoxRequest (the Site's request factory) hands each chunk of a PUT body -
+after any chunked transfer encoding has been taken off by twisted.web - to a
+RequestBody in place of the usual request.content file:
+  - a gzip or deflate Content-Encoding is decompressed on the fly, with the
+    decompressed size limited to MAX_BODY_BYTES
+  - small bodies are kept until they're complete and decoded in one go with
+    jsoncodec, as before
+  - once a body passes INCREMENTAL_THRESHOLD it's handed to a ContainerParser,
+    which decodes the container's messages, and the elements of the arrays in
+    them (stream database cells, devices...), one by one as they arrive, so only
+    the part of the text that hasn't been decoded yet is ever held. Every
+    object in the container shares one copy of each key, where the json module
+    would make a new one for each object; in a container full of small objects
+    (like stream database cells) the copies take more memory than the values.
+    Big bodies no longer go through the temporary file twisted.web puts them
+    in either.
+
+Responses are compressed with gzip or deflate when the request's
+Accept-Encoding allows it and they're at least MIN_COMPRESS_BYTES, as the
+smallest ones would only get bigger.
+
+'''
+
+import json
+import re
+import zlib
+
+from twisted.web import http, server
+
+import jsoncodec
+
+# Bodies bigger than this once decompressed are refused
+MAX_BODY_BYTES = 16 * 1024 * 1024
+# Bodies bigger than this are decoded as they arrive. Decoding incrementally takes a bit
+# longer, so it's kept for the bodies big enough for the memory to matter.
+INCREMENTAL_THRESHOLD = 256 * 1024
+
+MIN_COMPRESS_BYTES = 1024
+COMPRESSION_LEVEL = 6
+
+IDENTITY = "identity"
+GZIP = "gzip"
+DEFLATE = "deflate"
+
+# zlib window bits for each content coding. Deflate is meant to have a zlib header, but
+# some clients send raw deflate, so which it is is worked out from the first byte.
+WBITS = {
+    GZIP: 16 + zlib.MAX_WBITS,
+    DEFLATE: zlib.MAX_WBITS,
+}
+RAW_DEFLATE_WBITS = -zlib.MAX_WBITS
+
+# Content codings for responses, best first
+RESPONSE_ENCODINGS = (GZIP, DEFLATE)
+
+class BodyError(Exception):
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+#---------------------------------------------------------------------------#
+# Incremental container parsing
+#---------------------------------------------------------------------------#
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+NUMBER_START = "-0123456789"
+# What a number can go on with after any prefix the json scanner accepts
+NUMBER_CHARS = "0123456789.eE+-"
+
+# What comes next in the text
+VALUE = 0
+FIRST_KEY = 1
+KEY = 2
+COLON = 3
+AFTER_MEMBER = 4
+FIRST_ELEMENT = 5
+AFTER_ELEMENT = 6
+END = 7
+
+# The container, its messages array, each message, the message's data and the arrays in
+# that are taken apart. Anything nested deeper (a stream database cell, a device...) is
+# decoded whole.
+SPLIT_DEPTH = 5
+
+scan_string = json.decoder.scanstring
+
+def shared_keys_hook(keys):
+    # An object_pairs_hook that makes every object use the copy of each key in keys
+    share = keys.setdefault
+    def make_object(pairs):
+        return dict([(share(key, key), value) for key, value in pairs])
+    return make_object
+
+class ContainerParser():
+    # A push parser for one JSON document. Objects and arrays up to split_depth deep are
+    # parsed here; everything inside them is decoded by the json module's scanner.
+
+    def __init__(self, split_depth=SPLIT_DEPTH):
+        self.split_depth = split_depth
+        self.data = ""
+        self.offset = 0
+        self.state = VALUE
+        # [object or array, key of the member being parsed] for each one still open
+        self.stack = []
+        self.result = None
+        self.closed = False
+        self.keys = {}
+        self.scan_value = json.JSONDecoder(object_pairs_hook=shared_keys_hook(self.keys)).scan_once
+        # How much text the last failed attempt at decoding a value had. It's not tried
+        # again until there's twice as much, so a big value isn't decoded over and over.
+        self.attempted = 0
+
+    def feed(self, data):
+        if self.offset:
+            self.data = self.data[self.offset:]
+            self.offset = 0
+        self.data += data
+        self.parse()
+
+    def close(self):
+        # Returns the decoded document
+        self.closed = True
+        self.parse()
+        if self.state != END:
+            raise ValueError("Incomplete JSON document")
+        return self.result
+
+    def add_value(self, value):
+        if not self.stack:
+            self.result = value
+            self.state = END
+            return
+        parent = self.stack[-1]
+        if type(parent[0]) is dict:
+            parent[0][parent[1]] = value
+            self.state = AFTER_MEMBER
+        else:
+            parent[0].append(value)
+            self.state = AFTER_ELEMENT
+
+    def close_nested(self):
+        self.offset += 1
+        self.add_value(self.stack.pop()[0])
+
+    def parse(self):
+        data = self.data
+        data_length = len(data)
+        skip = WHITESPACE.match
+        while True:
+            offset = skip(data, self.offset).end()
+            self.offset = offset
+            if offset >= data_length:
+                return
+            char = data[offset]
+            state = self.state
+
+            if state == VALUE:
+                if char in "{[" and len(self.stack) < self.split_depth:
+                    self.offset += 1
+                    if char == "{":
+                        self.stack.append([{}, None])
+                        self.state = FIRST_KEY
+                    else:
+                        self.stack.append([[], None])
+                        self.state = FIRST_ELEMENT
+                    continue
+                if not self.closed and data_length - offset < 2 * self.attempted:
+                    return
+                try:
+                    value, end = self.scan_value(data, offset)
+                except (StopIteration, ValueError):
+                    if self.closed:
+                        raise ValueError("Invalid JSON value at %d" % offset)
+                    self.attempted = data_length - offset
+                    return
+                if not self.closed and char in NUMBER_START and (end >= data_length or data[end] in NUMBER_CHARS):
+                    # Only part of a number has arrived (e.g. "1" of "1.5", or "1." of "1.5e3")
+                    return
+                self.attempted = 0
+                self.offset = end
+                self.add_value(value)
+
+            elif state == FIRST_KEY or state == KEY:
+                if char == "}" and state == FIRST_KEY:
+                    self.close_nested()
+                    continue
+                if char != '"':
+                    raise ValueError("Expected a key at %d" % offset)
+                try:
+                    key, end = scan_string(data, offset + 1)
+                except ValueError:
+                    if self.closed:
+                        raise
+                    return
+                self.stack[-1][1] = self.keys.setdefault(key, key)
+                self.offset = end
+                self.state = COLON
+
+            elif state == COLON:
+                if char != ":":
+                    raise ValueError("Expected ':' at %d" % offset)
+                self.offset += 1
+                self.state = VALUE
+
+            elif state == AFTER_MEMBER or state == AFTER_ELEMENT:
+                if char == ",":
+                    self.offset += 1
+                    self.state = KEY if state == AFTER_MEMBER else VALUE
+                elif char == ("}" if state == AFTER_MEMBER else "]"):
+                    self.close_nested()
+                else:
+                    raise ValueError("Expected ',' at %d" % offset)
+
+            elif state == FIRST_ELEMENT:
+                if char == "]":
+                    self.close_nested()
+                else:
+                    self.state = VALUE
+
+            else:
+                raise ValueError("Extra data at %d" % offset)
+
+#---------------------------------------------------------------------------#
+# Request bodies
+#---------------------------------------------------------------------------#
+
+def is_zlib_header(data):
+    # True if data starts with a zlib header (RFC 1950) rather than raw deflate
+    if len(data) < 2:
+        return True
+    cmf, flg = ord(data[0]), ord(data[1])
+    return cmf & 0x0f == 8 and (cmf << 8 | flg) % 31 == 0
+
+def content_encoding(headers):
+    # The content coding of a request body, from its Content-Encoding header
+    values = headers.getRawHeaders("content-encoding")
+    if not values:
+        return IDENTITY
+    codings = [each_coding.strip().lower() for each_coding in ",".join(values).split(",") if each_coding.strip()]
+    codings = [each_coding for each_coding in codings if each_coding != IDENTITY]
+    if not codings:
+        return IDENTITY
+    if len(codings) > 1 or codings[0] not in WBITS:
+        raise BodyError(http.UNSUPPORTED_MEDIA_TYPE, "Unsupported Content-Encoding: %s" % ", ".join(codings))
+    return codings[0]
+
+class RequestBody():
+    # Stands in for request.content (twisted.web writes the body to it, and seeks and
+    # tells), decoding the body as it's written
+
+    def __init__(self, encoding=IDENTITY, keep_text=False, max_bytes=MAX_BODY_BYTES,
+                 incremental_threshold=INCREMENTAL_THRESHOLD):
+        self.encoding = encoding
+        self.keep_text = keep_text
+        self.max_bytes = max_bytes
+        self.incremental_threshold = incremental_threshold
+        self.decompressor = None
+
+        self.chunks = []
+        self.parser = None
+        self.text_chunks = [] if keep_text else None
+        self.error = None
+
+        self.num_wire_bytes = 0
+        self.num_bytes = 0
+
+    def _decompress(self, data):
+        if self.decompressor is None:
+            wbits = WBITS[self.encoding]
+            if self.encoding == DEFLATE and not is_zlib_header(data):
+                wbits = RAW_DEFLATE_WBITS
+            self.decompressor = zlib.decompressobj(wbits)
+        data = self.decompressor.decompress(data, self.max_bytes - self.num_bytes + 1)
+        if self.decompressor.unconsumed_tail:
+            raise BodyError(http.REQUEST_ENTITY_TOO_LARGE, "Body is more than %d bytes decompressed" % self.max_bytes)
+        return data
+
+    def write(self, data):
+        if self.error is not None or not data:
+            return
+        self.num_wire_bytes += len(data)
+        try:
+            if self.encoding != IDENTITY:
+                data = self._decompress(data)
+            self._add(data)
+        except zlib.error as e:
+            self.error = BodyError(http.BAD_REQUEST, "Couldn't decompress the body: %s" % e)
+        except (BodyError, ValueError) as e:
+            self.error = e
+        if self.error is not None:
+            # Nothing more is needed
+            self.chunks = self.parser = self.text_chunks = None
+
+    def _add(self, data):
+        self.num_bytes += len(data)
+        if self.num_bytes > self.max_bytes:
+            raise BodyError(http.REQUEST_ENTITY_TOO_LARGE, "Body is more than %d bytes" % self.max_bytes)
+        if self.text_chunks is not None:
+            self.text_chunks.append(data)
+        if self.parser is not None:
+            self.parser.feed(data)
+            return
+        self.chunks.append(data)
+        if self.num_bytes > self.incremental_threshold:
+            self.parser = ContainerParser()
+            self.parser.feed("".join(self.chunks))
+            self.chunks = None
+
+    def container(self):
+        # Returns the decoded body. Raises BodyError if it couldn't be received, or ValueError
+        # if it isn't valid JSON.
+        if self.error is not None:
+            raise self.error
+        if self.decompressor is not None:
+            tail = self.decompressor.flush()
+            self.decompressor = None
+            if tail:
+                self._add(tail)
+        if self.parser is not None:
+            return self.parser.close()
+        return jsoncodec.loads("".join(self.chunks))
+
+    def text(self):
+        # The decompressed body, or nothing if it wasn't kept (or couldn't be received)
+        if self.text_chunks is None:
+            return ""
+        return "".join(self.text_chunks)
+
+    # What twisted.web uses of a file
+
+    def tell(self):
+        return self.num_bytes
+
+    def seek(self, offset, whence=0):
+        pass
+
+    def read(self):
+        return self.text()
+
+    def close(self):
+        self.chunks = self.parser = self.text_chunks = None
+
+class ESBoxRequest(server.Request):
+    # Keeps the decompressed text of each body as well when keep_text is set (for capturing)
+    keep_text = False
+    # Set once the client has gone, so a response finished later (see send()) isn't written
+    connection_lost = False
+
+    def connectionLost(self, reason):
+        self.connection_lost = True
+        server.Request.connectionLost(self, reason)
+
+    def send(self, body):
+        # Writes the response to a request whose render returned NOT_DONE_YET
+        if self.connection_lost:
+            return
+        if body:
+            self.write(body)
+        self.finish()
+
+    def gotLength(self, length):
+        try:
+            encoding = content_encoding(self.requestHeaders)
+        except BodyError as e:
+            self.content = RequestBody(keep_text=self.keep_text)
+            self.content.error = e
+            return
+        self.content = RequestBody(encoding, keep_text=self.keep_text)
+
+#---------------------------------------------------------------------------#
+# Responses
+#---------------------------------------------------------------------------#
+
+def accepted_encoding(headers):
+    # The best content coding for a response that the request's Accept-Encoding allows
+    values = headers.getRawHeaders("accept-encoding")
+    if not values:
+        return IDENTITY
+    qualities = {}
+    for each_coding in ",".join(values).split(","):
+        name, _, params = each_coding.partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        qualities[name.strip().lower()] = quality
+    best = IDENTITY
+    best_quality = 0.0
+    for each_encoding in RESPONSE_ENCODINGS:
+        quality = qualities.get(each_encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = each_encoding, quality
+    return best
+
+def encode_response(request, body, min_bytes=MIN_COMPRESS_BYTES):
+    # Returns the response body compressed as the request allows, and sets Content-Encoding to match
+    if body is None or len(body) < min_bytes:
+        return body
+    encoding = accepted_encoding(request.requestHeaders)
+    if encoding == IDENTITY:
+        return body
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, WBITS[encoding])
+    request.setHeader("content-encoding", encoding)
+    request.setHeader("vary", "Accept-Encoding")
+    return compressor.compress(body) + compressor.flush()
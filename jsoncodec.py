@@ -0,0 +1,30 @@
+'''
+JSON codec
+
+Picks the fastest JSON library available when it's imported - orjson, then
+ujson, then the standard library - and exposes it as loads() and dumps().
+dumps() always returns a compact byte string.
+
+'''
+
+try:
+    import orjson
+
+    NAME = "orjson"
+    loads = orjson.loads
+    dumps = orjson.dumps
+except ImportError:
+    try:
+        import ujson
+
+        NAME = "ujson"
+        loads = ujson.loads
+
+        def dumps(obj):
+            return ujson.dumps(obj, escape_forward_slashes=False)
+    except ImportError:
+        import json
+
+        NAME = "json"
+        loads = json.loads
+        dumps = json.JSONEncoder(separators=(",", ":")).encode
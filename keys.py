@@ -0,0 +1,43 @@
+'''
+Protocol key strings, bound once
+
+The field names in SSMessages_8834 are nested class attributes, so every use
+of one like M.F.Dat.Attributes_1_1 costs three attribute lookups. The keys
+read while walking incoming containers are bound to plain constants here,
+for the hot loops to import.
+
+'''
+
+import SSMessages_8834 as M
+
+# Wrapper
+PROTOCOL_VERSION = M.F.Gen.ProtocolVersion_1_1
+ESBOX_VERSION = M.F.Gen.ESBoxVersion_1_1
+MESSAGES = M.F.Gen.Messages_1_1
+AUTH = M.F.Gen.Auth
+TIME = M.F.Dat.Time_1_1
+
+# Messages
+MSG_ID = M.F.Gen.MsgID_1_1
+CLUSTER = M.F.Gen.Cluster_1_1
+CLUSTER_ID = M.F.Gen.ClusterID_1_1
+MANUFACTURER = M.F.Gen.ClusterManufacturer_1_1
+SOURCE = M.F.Dat.Source
+DATA = M.F.Dat.Data_1_1
+
+# Readings
+HAN = M.F.Nwk.HAN_1_1
+ENDPOINT_ID = M.F.Nwk.EndpointID_1_1
+CLUSTERS = M.F.Dat.Clusters_1_1
+ATTRIBUTES = M.F.Dat.Attributes_1_1
+ATTRIBUTE_ID = M.F.Dat.AttributeID_1_1
+TYPE = M.F.Dat.Type_1_1
+VALUE = M.F.Dat.Value_1_1
+DELTA_TIME = M.F.Dat.DeltaTime_1_1
+CELLS = M.F.Dat.Sdb.Cells
+
+# Attribute types
+TYPE_INT = M.V.Dat.Type.Int
+TYPE_UINT = M.V.Dat.Type.Uint
+TYPE_STRING = M.V.Dat.Type.String
+TYPE_TIMECHANGE = M.V.Dat.Type.Timechange
@@ -0,0 +1,183 @@
+'''
+Logging for the ESCo
+
+Built on the standard logging module, so modules log with lazy formatting:
+
+    log = logging.getLogger(__name__)
+    log.warning("Received an unrecognised V%s message from ESBox %s", version, esbox_id,
+                extra=logs.fields(msg_id=msg_id))
+
+and nothing is formatted unless the record is actually written. configure()
+sets up the root logger with:
+  - RateLimitFilter: each kind of record (logger and message template) gets a
+    burst of records per interval, after which they're only counted, and the
+    count is added to the next one that gets through. A box sending the same
+    bad message every 10 seconds produces a handful of lines an hour rather
+    than one per check-in.
+  - AsyncHandler: records are put on a bounded queue and formatted and written
+    by a background thread, so a slow stdout never holds up the reactor. If
+    the queue fills up records are dropped (and counted) rather than waited
+    for.
+  - StructuredFormatter: one line per record, with the fields given through
+    fields() as key=value pairs after the message.
+
+'''
+
+from collections import deque
+import logging
+import os
+import sys
+import threading
+import time
+
+DEFAULT_LEVEL = "INFO"
+DEFAULT_RATE_LIMIT_BURST = 10
+DEFAULT_RATE_LIMIT_INTERVAL = 60 # sec
+DEFAULT_MAX_QUEUED_RECORDS = 10000
+# Message templates should be constants, but in case one isn't, stop tracking them all past this
+MAX_RATE_LIMIT_KEYS = 10000
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+def fields(**kwargs):
+    # extra= for a record with structured fields
+    return {"fields": kwargs}
+
+class StructuredFormatter(logging.Formatter):
+
+    def __init__(self):
+        logging.Formatter.__init__(self, "%(asctime)s %(levelname)s %(name)s: %(message)s", DATE_FORMAT)
+
+    def format(self, record):
+        line = logging.Formatter.format(self, record)
+        record_fields = getattr(record, "fields", None)
+        if record_fields:
+            line += " " + " ".join("%s=%s" % (key, record_fields[key]) for key in sorted(record_fields))
+        num_suppressed = getattr(record, "num_suppressed", 0)
+        if num_suppressed:
+            line += " (%d similar messages suppressed)" % num_suppressed
+        return line
+
+class RateLimitState():
+
+    def __init__(self, window_start):
+        self.window_start = window_start
+        self.num_in_window = 0
+        self.num_suppressed = 0
+
+class RateLimitFilter(logging.Filter):
+
+    def __init__(self, burst=DEFAULT_RATE_LIMIT_BURST, interval=DEFAULT_RATE_LIMIT_INTERVAL):
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.interval = interval
+        # (logger name, message template) -> RateLimitState
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = record.created
+        with self.lock:
+            state = self.states.get(key)
+            if state is None:
+                if len(self.states) >= MAX_RATE_LIMIT_KEYS:
+                    self.states.clear()
+                state = self.states[key] = RateLimitState(now)
+            elif now - state.window_start >= self.interval:
+                state.window_start = now
+                state.num_in_window = 0
+            if state.num_in_window >= self.burst:
+                state.num_suppressed += 1
+                return False
+            state.num_in_window += 1
+            record.num_suppressed = state.num_suppressed
+            state.num_suppressed = 0
+        return True
+
+class AsyncHandler(logging.Handler):
+
+    def __init__(self, stream=None, max_queued_records=DEFAULT_MAX_QUEUED_RECORDS):
+        logging.Handler.__init__(self)
+        self.stream = stream if stream is not None else sys.stdout
+        self.max_queued_records = max_queued_records
+        self.queue = deque()
+        self.not_empty = threading.Condition(threading.Lock())
+        self.num_dropped = 0
+        self.thread = None
+        self.pid = None
+
+    def _start(self):
+        # Caller holds not_empty. Threads don't survive a fork, so each process starts its own.
+        self.pid = os.getpid()
+        self.queue.clear()
+        self.thread = threading.Thread(target=self._run, name="log-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        # Never blocks on the stream
+        with self.not_empty:
+            if self.pid != os.getpid():
+                self._start()
+            if len(self.queue) >= self.max_queued_records:
+                self.num_dropped += 1
+                return
+            self.queue.append(record)
+            self.not_empty.notify()
+
+    def _run(self):
+        while True:
+            with self.not_empty:
+                while not self.queue and not self.num_dropped:
+                    self.not_empty.wait()
+                records = list(self.queue)
+                self.queue.clear()
+                num_dropped = self.num_dropped
+                self.num_dropped = 0
+            self._write(records, num_dropped)
+
+    def _write(self, records, num_dropped):
+        lines = []
+        for each_record in records:
+            try:
+                lines.append(self.format(each_record) + "\n")
+            except Exception:
+                self.handleError(each_record)
+        if num_dropped:
+            lines.append("%s WARNING %s: %d log messages dropped, the log queue was full\n" % (
+                time.strftime(DATE_FORMAT), __name__, num_dropped))
+        try:
+            self.stream.write("".join(lines))
+            self.stream.flush()
+        except (IOError, ValueError):
+            pass
+
+    def flush(self, timeout=1):
+        # Wait (a little) for everything queued to be written
+        deadline = time.time() + timeout
+        while self.queue and time.time() < deadline and self.pid == os.getpid():
+            time.sleep(0.01)
+
+def configure(level=DEFAULT_LEVEL, stream=None, burst=DEFAULT_RATE_LIMIT_BURST, interval=DEFAULT_RATE_LIMIT_INTERVAL,
+              max_queued_records=DEFAULT_MAX_QUEUED_RECORDS):
+    # Send everything logged in this process through one rate limited, asynchronous handler.
+    # Calling it again replaces the handler.
+    # Don't work out the caller, thread and process of every record, as none of them are written
+    logging._srcfile = None
+    logging.logThreads = 0
+    logging.logProcesses = 0
+    logging.logMultiprocessing = 0
+
+    handler = AsyncHandler(stream, max_queued_records)
+    handler.setFormatter(StructuredFormatter())
+    handler.addFilter(RateLimitFilter(burst, interval))
+
+    root = logging.getLogger()
+    for each_handler in list(root.handlers):
+        if isinstance(each_handler, AsyncHandler):
+            each_handler.flush()
+        root.removeHandler(each_handler)
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
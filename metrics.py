@@ -0,0 +1,195 @@
+'''
+Counters and histograms for the ESCo's hot paths
+
+Metrics are registered once, at import, by the module that updates them:
+
+    requests = metrics.counter("esco_requests_total", "ESBox requests", ("protocol",))
+    requests.inc(("1.1",))
+
+    decode_seconds = metrics.histogram("esco_decode_seconds", "Time to decode a container")
+    decode_seconds.observe(time.time() - start)
+
+Updates are a dict lookup and an add, with no locking: each metric is only
+ever updated from one thread (the reactor, or the writer thread for storage
+metrics), and only read from others. Histograms have fixed buckets, so
+observing a value is a bisect and two adds. Label values should come from
+small, known sets - never straight from an ESBox - so the number of series
+stays bounded.
+
+render() produces the Prometheus text format for the /metrics endpoint. Each
+worker process (see supervisor.py) keeps its own metrics, and writes a
+snapshot of them to its directory every few seconds so that whichever worker
+is scraped can report all of them, labelled by worker.
+
+'''
+
+from bisect import bisect_left
+import glob
+import logging
+import math
+import os
+
+import jsoncodec
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_FILENAME = "metrics.json"
+
+# Seconds, from 100 us to 10 s
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Counter():
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        # Label values -> count
+        self.values = {}
+        if not labelnames:
+            self.values[()] = 0
+
+    def inc(self, labels=(), amount=1):
+        values = self.values
+        values[labels] = values.get(labels, 0) + amount
+
+    def samples(self):
+        return [(self.name, zip(self.labelnames, labels), value) for labels, value in self.values.items()]
+
+class Histogram():
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.bounds = tuple(sorted(buckets))
+        # Label values -> [count in each bucket..., count above the last bucket, sum]
+        self.states = {}
+
+    def observe(self, value, labels=()):
+        state = self.states.get(labels)
+        if state is None:
+            state = self.states[labels] = [0] * (len(self.bounds) + 1) + [0.0]
+        state[bisect_left(self.bounds, value)] += 1
+        state[-1] += value
+
+    def samples(self):
+        samples = []
+        for labels, state in self.states.items():
+            labels = zip(self.labelnames, labels)
+            count = 0
+            for bound, bucket_count in zip(self.bounds, state):
+                count += bucket_count
+                samples.append((self.name + "_bucket", labels + [("le", format_value(bound))], count))
+            count += state[-2]
+            samples.append((self.name + "_bucket", labels + [("le", "+Inf")], count))
+            samples.append((self.name + "_sum", labels, state[-1]))
+            samples.append((self.name + "_count", labels, count))
+        return samples
+
+class Callback():
+    # A value kept somewhere else, read when the metrics are collected
+
+    def __init__(self, name, help, function, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.kind = kind
+
+    def samples(self):
+        return [(self.name, [], self.function())]
+
+class Registry():
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self):
+        # Returns [(name, kind, help, [(sample name, [(label, value), ...], value), ...]), ...]
+        return [(metric.name, metric.kind, metric.help, metric.samples()) for metric in self.metrics]
+
+registry = Registry()
+
+def counter(name, help, labelnames=()):
+    return registry.register(Counter(name, help, labelnames))
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, help, labelnames, buckets))
+
+def callback(name, help, function, kind="gauge"):
+    return registry.register(Callback(name, help, function, kind))
+
+#---------------------------------------------------------------------------#
+# Exposition
+#---------------------------------------------------------------------------#
+
+def format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if math.isnan(value):
+            return "NaN"
+        return repr(value)
+    return str(value)
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_sample(sample_name, labels, value):
+    if labels:
+        return "%s{%s} %s" % (sample_name, ",".join('%s="%s"' % (label, escape_label_value(label_value))
+                                                   for label, label_value in labels), format_value(value))
+    return "%s %s" % (sample_name, format_value(value))
+
+def render(collections):
+    # Render [(extra labels, collected metrics), ...] - one per worker - in the Prometheus text format,
+    # with each metric's samples from every worker together
+    families = []
+    samples_by_name = {}
+    for extra_labels, collected in collections:
+        for name, kind, help, samples in collected:
+            if name not in samples_by_name:
+                families.append((name, kind, help))
+                samples_by_name[name] = []
+            samples_by_name[name].extend((sample_name, list(extra_labels) + list(labels), value)
+                                         for sample_name, labels, value in samples)
+    lines = []
+    for name, kind, help in families:
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s %s" % (name, kind))
+        lines.extend(format_sample(*each_sample) for each_sample in samples_by_name[name])
+    # Snapshots from other workers come back from JSON as unicode
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+#---------------------------------------------------------------------------#
+# Sharing between worker processes
+#---------------------------------------------------------------------------#
+
+def write_snapshot(directory, collected):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, SNAPSHOT_FILENAME)
+    with open(path + ".tmp", "wb") as snapshot_file:
+        snapshot_file.write(jsoncodec.dumps(collected))
+    os.rename(path + ".tmp", path)
+
+def read_snapshots(directory, exclude=None):
+    # Returns [(worker directory name, collected metrics), ...] for the snapshots written by
+    # each worker under directory, except the one in exclude
+    snapshots = []
+    for path in sorted(glob.glob(os.path.join(directory, "*", SNAPSHOT_FILENAME))):
+        worker_directory = os.path.dirname(path)
+        if exclude is not None and os.path.abspath(worker_directory) == os.path.abspath(exclude):
+            continue
+        try:
+            with open(path, "rb") as snapshot_file:
+                snapshots.append((os.path.basename(worker_directory), jsoncodec.loads(snapshot_file.read())))
+        except (IOError, ValueError) as e:
+            log.warning("Couldn't read the metrics snapshot %s: %s", path, e)
+    return snapshots
@@ -0,0 +1,127 @@
+'''
+Rewrites protocol 1.0 containers into the 1.1 shape
+
+ESBoxes on older firmware (8447) only speak protocol 1.0, which uses the long
+field names (MsgID, Messages, DevIEEE...) where 1.1 uses short ones (M, Msgs,
+HAN...). Rather than handling every message twice, normalise_container()
+rewrites a 1.0 container as the 1.1 container it's equivalent to, and it goes
+through the same router, handlers and point building as any other.
+
+The key mapping is generated once, at import, from the constant classes in
+SSMessages_8834: every field X with an X_1_1 counterpart in the same class,
+the deprecated Short aliases, and the few fields that were renamed outright
+(RENAMED_FIELDS). Message IDs are mapped the same way. The container is then
+rewritten in a single walk, with two changes of structure on top of the keys:
+  - stream database cells carry their cluster as separate CluId and CluMan
+    fields, which become a Cl object
+  - SendLatestReadings becomes SendData from the latest readings buffer, with
+    each value's type worked out from its JSON type (1.0 doesn't send them)
+
+'''
+
+import SSMessages_8834 as M
+from keys import (PROTOCOL_VERSION, MESSAGES, MSG_ID, CLUSTER, CLUSTER_ID, MANUFACTURER, SOURCE, DATA, CLUSTERS, ATTRIBUTES,
+                  TYPE, VALUE, TYPE_INT, TYPE_STRING)
+
+# 1.0 fields that 1.1 renamed rather than just shortened, and their 1.1 names
+RENAMED_FIELDS = {
+    M.F.Nwk.DevIEEE: M.F.Nwk.HAN_1_1,
+    M.F.Nwk.Short.DevIEEE: M.F.Nwk.HAN_1_1,
+    M.F.Dat.DataTime: M.F.Dat.Time_1_1,
+    M.F.Dat.DataCluster: M.F.Gen.Cluster_1_1,
+}
+
+# Field classes whose names mean something else in 1.1 (Db3's single letter labels)
+SKIPPED_FIELD_CLASSES = ("Db3",)
+
+# The classes holding message IDs
+MESSAGE_CLASSES = (M.Common, M.SS_ESB, M.SS_LC, M.OnOff)
+
+CELL_CLUSTER_ID = M.F.Dat.DataClusterId
+CELL_MANUFACTURER = M.F.Dat.DataClusterManufacturer
+ENDPOINTS = M.F.Nwk.Endpoints_1_1
+
+def paired_names(constants_class):
+    # Yields (1.0 value, 1.1 value) for each name X in a class that also has an X_1_1
+    for name in dir(constants_class):
+        if name.endswith("_1_1") and hasattr(constants_class, name[:-len("_1_1")]):
+            yield getattr(constants_class, name[:-len("_1_1")]), getattr(constants_class, name)
+
+def add_mapping(mapping, old, new):
+    if mapping.get(old, new) != new:
+        raise ValueError("%s maps to both %s and %s" % (old, mapping[old], new))
+    if old != new:
+        mapping[old] = new
+
+def generate_key_map():
+    key_map = {}
+    classes = [M.F]
+    while classes:
+        constants_class = classes.pop()
+        for old, new in paired_names(constants_class):
+            add_mapping(key_map, old, new)
+        for name in dir(constants_class):
+            nested = getattr(constants_class, name)
+            if isinstance(nested, type(M.F)) and name not in SKIPPED_FIELD_CLASSES:
+                if name == "Short":
+                    # Deprecated short aliases, for the names in the enclosing class
+                    for short_name in dir(nested):
+                        if not short_name.startswith("_") and hasattr(constants_class, short_name + "_1_1"):
+                            add_mapping(key_map, getattr(nested, short_name), getattr(constants_class, short_name + "_1_1"))
+                else:
+                    classes.append(nested)
+    for old, new in RENAMED_FIELDS.iteritems():
+        add_mapping(key_map, old, new)
+    return key_map
+
+def generate_msg_id_map():
+    msg_id_map = {}
+    for each_class in MESSAGE_CLASSES:
+        for old, new in paired_names(each_class.E):
+            add_mapping(msg_id_map, old, new)
+    return msg_id_map
+
+KEY_MAP = generate_key_map()
+MSG_ID_MAP = generate_msg_id_map()
+
+def translate(value):
+    # The 1.1 form of any part of a 1.0 container
+    value_type = type(value)
+    if value_type is dict:
+        translated = {}
+        get_key = KEY_MAP.get
+        for key, item in value.iteritems():
+            translated[get_key(key, key)] = translate(item)
+        if CELL_CLUSTER_ID in translated or CELL_MANUFACTURER in translated:
+            # A stream database cell's cluster
+            translated[CLUSTER] = {CLUSTER_ID: translated.pop(CELL_CLUSTER_ID, 0),
+                                   MANUFACTURER: translated.pop(CELL_MANUFACTURER, 0)}
+        return translated
+    if value_type is list:
+        return [translate(item) for item in value]
+    return value
+
+def latest_readings_as_send_data(message):
+    # SendLatestReadings (already translated) becomes SendData from the latest readings buffer,
+    # where the values are under Data_1_1 and have a type
+    message[MSG_ID] = M.SS_ESB.E.SendData
+    message[SOURCE] = M.V.Dat.Source.LatestReadings_1_1
+    endpoints = message[DATA] = message.pop(ENDPOINTS, [])
+    for each_endpoint in endpoints:
+        for each_cluster in each_endpoint.get(CLUSTERS, ()):
+            for each_attr in each_cluster.get(ATTRIBUTES, ()):
+                value = each_attr.pop(VALUE, None)
+                each_attr[DATA] = value
+                each_attr[TYPE] = TYPE_STRING if isinstance(value, basestring) else TYPE_INT
+    return message
+
+def normalise_container(json_data):
+    # Returns the 1.1 equivalent of a 1.0 container
+    container = translate(json_data)
+    container[PROTOCOL_VERSION] = "1.1"
+    for each_message in container.get(MESSAGES, ()):
+        msg_id = MSG_ID_MAP.get(each_message.get(MSG_ID), each_message.get(MSG_ID))
+        each_message[MSG_ID] = msg_id
+        if msg_id == M.SS_ESB.E.SendLatestReadings:
+            latest_readings_as_send_data(each_message)
+    return container
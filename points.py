@@ -0,0 +1,121 @@
+'''
+Builds database points from ESBox attribute reports
+
+All of the attributes reported for one HAN/endpoint/cluster at one time are
+collapsed into a single 'wide' point, with one field per attribute named from
+the attribute registry in attributes.py. Points are stamped with the time the
+meter took the reading, so writing the same reading twice just overwrites it.
+
+Values that need scaling are collected over a whole container and divided by
+their divisors in one go when the points are finished.
+
+'''
+
+from attributes import registry, FLOAT, UNKNOWN
+from keys import CLUSTER_ID, MANUFACTURER, TIME, ATTRIBUTE_ID, TYPE, DATA, TYPE_INT, TYPE_UINT, TYPE_TIMECHANGE
+from timebase import to_utc
+
+READINGS_MEASUREMENT = "readings"
+
+NUMERIC_TYPES = (TYPE_INT, TYPE_UINT)
+
+# The registry lookups used for every value
+registry_rows = registry.rows
+registry_names = registry.names
+registry_types = registry.types
+
+def build_reading_point(han, endpoint_id, cluster_id, timestamp, fields):
+    return {
+        "measurement": READINGS_MEASUREMENT,
+        "tags": {
+            "ieee": str(han),
+            "endpoint": str(endpoint_id),
+            "cluster": str(cluster_id),
+        },
+        "time": timestamp,
+        "fields": fields
+    }
+
+class PointBuilder():
+
+    def __init__(self, offset, default_time):
+        # offset converts ESBox times to UTC (see timebase.py), default_time is used
+        # for attributes that don't carry a time of their own
+        self.offset = offset
+        self.default_time = default_time
+        self.points = []
+
+        # Values waiting to be scaled, and the fields to put them in once they are
+        self.pending_fields = []
+        self.pending_names = []
+        self.pending_rows = []
+        self.pending_values = []
+
+    def add_cluster(self, han, endpoint_id, cluster, attributes):
+        # Adds one point for each distinct time in a cluster report (a M.F.Dat.Clusters_1_1 entry)
+        cluster_id = cluster[CLUSTER_ID]
+        manufacturer = cluster[MANUFACTURER]
+
+        offset = self.offset
+        default_time = self.default_time
+        add_value = self._add_value
+        fields_by_time = {}
+        for each_attr in attributes:
+            esbox_time = each_attr.get(TIME)
+            if esbox_time is None:
+                timestamp = default_time
+            else:
+                timestamp = int(esbox_time) + offset # to_utc()
+            fields = fields_by_time.get(timestamp)
+            if fields is None:
+                fields = fields_by_time[timestamp] = {}
+
+            add_value(fields, cluster_id, manufacturer, each_attr[ATTRIBUTE_ID], each_attr.get(TYPE, TYPE_INT), each_attr[DATA])
+
+        for timestamp, fields in fields_by_time.iteritems():
+            self.points.append(build_reading_point(han, endpoint_id, cluster_id, timestamp, fields))
+
+    def add_columns(self, columns):
+        # Adds the attributes decoded from stream database cells (see sdb.py), one point
+        # for each HAN/endpoint/cluster/time
+        add_value = self._add_value
+        fields_by_key = {}
+        for han, endpoint_id, cluster_id, manufacturer, esbox_time, attr_id, attr_type, value in zip(
+                columns.han, columns.endpoint, columns.cluster_id, columns.manufacturer, columns.time,
+                columns.attr_id, columns.attr_type, columns.value):
+            key = (han, endpoint_id, cluster_id, esbox_time)
+            fields = fields_by_key.get(key)
+            if fields is None:
+                fields = fields_by_key[key] = {}
+            add_value(fields, cluster_id, manufacturer, attr_id, attr_type, value)
+
+        for (han, endpoint_id, cluster_id, esbox_time), fields in fields_by_key.iteritems():
+            self.points.append(build_reading_point(han, endpoint_id, cluster_id, to_utc(esbox_time, self.offset), fields))
+
+    def _add_value(self, fields, cluster_id, manufacturer, attr_id, attr_type, value):
+        if attr_type == TYPE_TIMECHANGE:
+            # A record of the ESBox's clock being changed rather than a reading
+            return
+        row = registry_rows.get((cluster_id, manufacturer, attr_id), UNKNOWN)
+        name = registry_names[row] if row != UNKNOWN else str(attr_id) # registry.name()
+        if attr_type not in NUMERIC_TYPES:
+            fields[name] = value
+        elif registry_types[row] == FLOAT:
+            self.pending_fields.append(fields)
+            self.pending_names.append(name)
+            self.pending_rows.append(row)
+            self.pending_values.append(value)
+        else:
+            fields[name] = int(value)
+
+    def finish(self):
+        # Scale everything that needs it and return the finished points
+        if self.pending_rows:
+            scaled = registry.scale(self.pending_rows, self.pending_values).tolist()
+            for fields, name, value in zip(self.pending_fields, self.pending_names, scaled):
+                fields[name] = value
+            self.pending_fields = []
+            self.pending_names = []
+            self.pending_rows = []
+            self.pending_values = []
+        return self.points
@@ -0,0 +1,126 @@
+'''
+HTTP query API for recent readings
+
+Answers GET requests from dashboards out of the in-memory recent readings
+(see recentreadings.py), so polling for current values doesn't touch the
+database:
+
+    /meters/<meter IEEE>/latest
+        the last reading of every attribute of a meter, by endpoint
+    /esbox/<ESBox IEEE>/meters
+        the meters an ESBox has reported readings for
+    /meters/<meter IEEE>/window?attr=<attribute>&s=<seconds>[&endpoint=<endpoint>]
+        an attribute's readings over the last s seconds (DEFAULT_WINDOW if not
+        given), with their count, min, max, mean and last value
+
+Attributes are named as in attributes.py, e.g. voltage. Every response carries
+an ETag of its body, so a dashboard sending If-None-Match gets 304 Not
+Modified until a new reading comes in.
+
+'''
+
+import math
+import time
+import zlib
+
+from twisted.web import http
+
+import jsoncodec
+
+DEFAULT_WINDOW = 300 # sec
+
+class QueryError(Exception):
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+def finite(value):
+    # JSON has no NaN
+    if math.isnan(value):
+        return None
+    return float(value)
+
+def get_arg(request, name, default=None):
+    values = request.args.get(name)
+    if not values:
+        return default
+    return values[0]
+
+class QueryAPI():
+
+    def __init__(self, recent_readings, default_window=DEFAULT_WINDOW):
+        self.recent_readings = recent_readings
+        self.default_window = default_window
+        self.routes = {
+            ("meters", "latest"): self.meter_latest,
+            ("esbox", "meters"): self.esbox_meters,
+            ("meters", "window"): self.meter_window,
+        }
+
+    def render(self, request):
+        # Returns the response body for a query, or None if the request isn't one
+        segments = [each_segment for each_segment in request.postpath if each_segment]
+        if len(segments) != 3:
+            return None
+        query = self.routes.get((segments[0], segments[2]))
+        if query is None:
+            return None
+
+        try:
+            result = query(segments[1].upper(), request)
+        except QueryError as e:
+            request.setResponseCode(e.code)
+            result = {"error": str(e)}
+
+        body = jsoncodec.dumps(result)
+        request.setHeader("content-type", "application/json")
+        request.setHeader("cache-control", "no-cache")
+        if request.setETag('"%08x"' % (zlib.crc32(body) & 0xffffffff)) is http.CACHED:
+            return ""
+        return body
+
+    def meter_latest(self, han, request):
+        latest = self.recent_readings.meter_latest(han)
+        if not latest:
+            raise QueryError(http.NOT_FOUND, "No readings for meter %s" % han)
+        endpoints = {}
+        for (endpoint, name), (timestamp, value) in latest.iteritems():
+            endpoints.setdefault(endpoint, {})[name] = {"time": timestamp, "value": value}
+        return {"ieee": han, "endpoints": endpoints}
+
+    def esbox_meters(self, esbox_id, request):
+        meters = self.recent_readings.esbox_meters(esbox_id)
+        if not meters:
+            raise QueryError(http.NOT_FOUND, "No meters for ESBox %s" % esbox_id)
+        return {"esbox": esbox_id, "meters": meters}
+
+    def meter_window(self, han, request):
+        name = get_arg(request, "attr")
+        if name is None:
+            raise QueryError(http.BAD_REQUEST, "attr is required")
+        try:
+            seconds = int(get_arg(request, "s", self.default_window))
+        except ValueError:
+            raise QueryError(http.BAD_REQUEST, "s must be a number of seconds")
+        endpoint = get_arg(request, "endpoint")
+
+        start = int(time.time()) - seconds
+        keys, stats = self.recent_readings.window_stats(name, start=start, han=han)
+        endpoints = {}
+        for index, (each_han, each_endpoint) in enumerate(keys):
+            if endpoint is not None and each_endpoint != endpoint:
+                continue
+            times, values = self.recent_readings.window(han, each_endpoint, name, start=start)
+            endpoints[each_endpoint] = {
+                "times": times.tolist(),
+                "values": values.tolist(),
+                "count": int(stats["count"][index]),
+                "min": finite(stats["min"][index]),
+                "max": finite(stats["max"][index]),
+                "mean": finite(stats["mean"][index]),
+                "last": finite(stats["last"][index]),
+            }
+        if not endpoints:
+            raise QueryError(http.NOT_FOUND, "No %s readings for meter %s" % (name, han))
+        return {"ieee": han, "attr": name, "start": start, "endpoints": endpoints}
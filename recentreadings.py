@@ -0,0 +1,295 @@
+'''
+In-memory ring buffers of recent readings
+
+Keeps the last few readings of every numeric attribute of every meter, so the
+current state of a meter (or the last few minutes of it) can be had without
+querying the database. Each series - one HAN/endpoint/attribute - is a row in
+two preallocated arrays, one of times (int64, UTC seconds) and one of values
+(float64), used as a ring:
+
+    times[row, :]   t3 t4 t0 t1 t2
+    values[row, :]  v3 v4 v0 v1 v2
+                          ^ head[row]: where the next reading goes
+
+so the whole store costs at most 16 bytes per reading slot. The arrays are
+zeroed by the OS as they're first touched, so memory is only used for rows
+that have held a series. The depth of the rings is the memory budget divided
+between max_series series. When every row is taken the series updated longest ago are dropped to
+make room, though never one added earlier in the same container.
+
+Readings are added from the points built for the database (see points.py),
+a container at a time, along with the ESBox that sent them so its meters can
+be listed. Readings that aren't newer than the last one held for
+their series - e.g. the same latest reading fetched twice - are skipped.
+
+Each ESCo worker process (see supervisor.py) only holds the readings of the
+ESBoxes that have checked in with it.
+
+'''
+
+import threading
+import time
+
+import numpy as np
+
+MAX_SERIES = 131072
+MEMORY_BUDGET = 128 * 1024 * 1024 # bytes
+# Bytes for the time and the value of each reading
+BYTES_PER_READING = 16
+# How much of the store to free at once when it's full
+EVICT_FRACTION = 1.0 / 64
+
+# The time in slots that haven't held a reading
+MISSING_TIME = 0
+# last_update of rows given out for the batch being added, so they aren't evicted for the same batch
+PINNED = np.inf
+
+NUMERIC_VALUE_TYPES = (int, long, float)
+
+class RecentReadings():
+
+    def __init__(self, max_series=MAX_SERIES, memory_budget=MEMORY_BUDGET):
+        self.max_series = max_series
+        self.depth = memory_budget // (max_series * BYTES_PER_READING)
+        if self.depth < 1:
+            raise ValueError("A memory budget of %d bytes can't hold %d series" % (memory_budget, max_series))
+        self.times = np.zeros((max_series, self.depth), dtype=np.int64)
+        self.values = np.zeros((max_series, self.depth), dtype=np.float64)
+        self.head = np.zeros(max_series, dtype=np.int64)
+        # When each row was last added to (our clock), to choose which to drop when full
+        self.last_update = np.zeros(max_series, dtype=np.float64)
+
+        # (HAN, endpoint, attribute name) -> row, and the reverse
+        self.rows = {}
+        self.keys = [None] * max_series
+        # HAN -> set of (endpoint, attribute name) held for it
+        self.series_by_han = {}
+        # HAN -> the ESBox it was last reported by, and ESBox -> set of HANs
+        self.esbox_by_han = {}
+        self.meters_by_esbox = {}
+        self.free_rows = range(max_series - 1, -1, -1)
+        self.lock = threading.Lock()
+
+    #---------------------------------------------------------------------------#
+    # Adding readings
+    #---------------------------------------------------------------------------#
+
+    def _new_row(self, key):
+        # Caller holds the lock. Returns None if every row is pinned.
+        if not self.free_rows:
+            self._evict()
+            if not self.free_rows:
+                return None
+        row = self.free_rows.pop()
+        self.last_update[row] = PINNED
+        self.rows[key] = row
+        self.keys[row] = key
+        han, endpoint, name = key
+        self.series_by_han.setdefault(han, set()).add((endpoint, name))
+        return row
+
+    def _evict(self):
+        # Caller holds the lock. Drops the series that were updated longest ago.
+        num_rows = max(1, int(self.max_series * EVICT_FRACTION))
+        oldest = np.argpartition(self.last_update, num_rows - 1)[:num_rows]
+        oldest = oldest[self.last_update[oldest] != PINNED]
+        for row in oldest.tolist():
+            key = self.keys[row]
+            if key is None:
+                continue
+            del self.rows[key]
+            self.keys[row] = None
+            han, endpoint, name = key
+            han_series = self.series_by_han[han]
+            han_series.discard((endpoint, name))
+            if not han_series:
+                del self.series_by_han[han]
+                self._forget_esbox(han)
+            self.free_rows.append(row)
+        self.times[oldest] = MISSING_TIME
+        self.values[oldest] = 0
+        self.head[oldest] = 0
+        self.last_update[oldest] = 0
+
+    def _forget_esbox(self, han):
+        # Caller holds the lock
+        esbox_id = self.esbox_by_han.pop(han, None)
+        if esbox_id is not None:
+            meters = self.meters_by_esbox[esbox_id]
+            meters.discard(han)
+            if not meters:
+                del self.meters_by_esbox[esbox_id]
+
+    def _set_esbox(self, han, esbox_id):
+        # Caller holds the lock
+        if self.esbox_by_han.get(han) == esbox_id:
+            return
+        self._forget_esbox(han)
+        self.esbox_by_han[han] = esbox_id
+        self.meters_by_esbox.setdefault(esbox_id, set()).add(han)
+
+    def add_points(self, points, esbox_id=None, now=None):
+        # Adds the numeric fields of database points (as built by points.PointBuilder)
+        # reported by an ESBox
+        if now is None:
+            now = time.time()
+        with self.lock:
+            rows = []
+            times = []
+            values = []
+            new_rows = []
+            hans = set()
+            rows_get = self.rows.get
+            new_row = self._new_row
+            for each_point in points:
+                tags = each_point["tags"]
+                han = tags["ieee"]
+                endpoint = tags["endpoint"]
+                timestamp = each_point["time"]
+                for name, value in each_point["fields"].iteritems():
+                    if type(value) not in NUMERIC_VALUE_TYPES:
+                        continue
+                    key = (han, endpoint, name)
+                    row = rows_get(key)
+                    if row is None:
+                        row = new_row(key)
+                        if row is None:
+                            # More new series in this batch than the store holds
+                            continue
+                        new_rows.append(row)
+                    rows.append(row)
+                    times.append(timestamp)
+                    values.append(value)
+                    hans.add(han)
+            if rows:
+                self._add(np.array(rows, dtype=np.int64), np.array(times, dtype=np.int64),
+                          np.array(values, dtype=np.float64), now)
+            # Unpin them, including any whose readings were all skipped
+            self.last_update[new_rows] = now
+            if esbox_id is not None:
+                for each_han in hans:
+                    self._set_esbox(each_han, esbox_id)
+
+    def _add(self, rows, times, values, now):
+        # Caller holds the lock. Writes a batch of readings into their rings in one go.
+        depth = self.depth
+
+        # Sort by series then time, and only keep readings newer than the one before them
+        order = np.lexsort((times, rows))
+        rows = rows[order]
+        times = times[order]
+        values = values[order]
+        newer = times > self.times[rows, (self.head[rows] - 1) % depth]
+        newer[1:] &= (rows[1:] != rows[:-1]) | (times[1:] != times[:-1])
+        rows = rows[newer]
+        times = times[newer]
+        values = values[newer]
+        if not len(rows):
+            return
+
+        # Each reading's place among its series' new readings
+        starts = np.empty(len(rows), dtype=bool)
+        starts[0] = True
+        starts[1:] = rows[1:] != rows[:-1]
+        start_index = np.flatnonzero(starts)
+        counts = np.diff(np.append(start_index, len(rows)))
+        rank = np.arange(len(rows)) - np.repeat(start_index, counts)
+
+        # Only the last depth readings of a series fit in its ring
+        keep = rank >= np.repeat(counts, counts) - depth
+        series = rows[start_index]
+        positions = (self.head[rows] + rank) % depth
+        self.times[rows[keep], positions[keep]] = times[keep]
+        self.values[rows[keep], positions[keep]] = values[keep]
+        self.head[series] = (self.head[series] + counts) % depth
+        self.last_update[series] = now
+
+    #---------------------------------------------------------------------------#
+    # Queries
+    #---------------------------------------------------------------------------#
+
+    def latest(self, han, endpoint, name):
+        # Returns (time, value) of the last reading of one attribute, or None
+        with self.lock:
+            row = self.rows.get((han, str(endpoint), name))
+            if row is None:
+                return None
+            position = (self.head[row] - 1) % self.depth
+            return int(self.times[row, position]), float(self.values[row, position])
+
+    def meter_latest(self, han):
+        # Returns {(endpoint, attribute name): (time, value)} for everything held for a HAN
+        with self.lock:
+            series = self.series_by_han.get(han)
+            if not series:
+                return {}
+            keys = sorted(series)
+            rows = np.array([self.rows[(han, endpoint, name)] for endpoint, name in keys], dtype=np.int64)
+            positions = (self.head[rows] - 1) % self.depth
+            times = self.times[rows, positions].tolist()
+            values = self.values[rows, positions].tolist()
+        return dict(zip(keys, zip(times, values)))
+
+    def hans(self):
+        # The HANs we hold readings for
+        with self.lock:
+            return self.series_by_han.keys()
+
+    def esbox_meters(self, esbox_id):
+        # The HANs we hold readings for that were last reported by an ESBox
+        with self.lock:
+            return sorted(self.meters_by_esbox.get(esbox_id, ()))
+
+    def window(self, han, endpoint, name, start=None, end=None):
+        # Returns (times, values) arrays of the readings held for one attribute between
+        # start and end (inclusive), oldest first
+        with self.lock:
+            row = self.rows.get((han, str(endpoint), name))
+            if row is None:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+            times = np.roll(self.times[row], -self.head[row])
+            values = np.roll(self.values[row], -self.head[row])
+        selected = self._in_window(times, start, end)
+        return times[selected], values[selected]
+
+    def window_stats(self, name, start=None, end=None, han=None):
+        # Aggregates every series of an attribute (just those of one HAN if it's given) over
+        # a window, all at once. Returns (keys, stats), where keys are the (HAN, endpoint) of
+        # each series and stats maps count/min/max/mean/last to an array in the same order.
+        with self.lock:
+            if han is None:
+                keys = [(key[0], key[1]) for key in self.rows if key[2] == name]
+            else:
+                keys = [(han, endpoint) for endpoint, series_name in self.series_by_han.get(han, ()) if series_name == name]
+            keys.sort()
+            rows = np.array([self.rows[(each_han, endpoint, name)] for each_han, endpoint in keys], dtype=np.int64)
+            times = self.times[rows]
+            values = self.values[rows]
+
+        selected = self._in_window(times, start, end)
+        count = selected.sum(axis=1)
+        last_position = np.where(selected, times, MISSING_TIME).argmax(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            stats = {
+                "count": count,
+                "min": np.where(selected, values, np.inf).min(axis=1),
+                "max": np.where(selected, values, -np.inf).max(axis=1),
+                "mean": np.where(selected, values, 0).sum(axis=1) / count,
+                "last": values[np.arange(len(rows)), last_position],
+            }
+        # Series with nothing in the window
+        for each_stat in ("min", "max", "last"):
+            stats[each_stat][count == 0] = np.nan
+        return keys, stats
+
+    def _in_window(self, times, start, end):
+        selected = times > MISSING_TIME
+        if start is not None:
+            selected &= times >= start
+        if end is not None:
+            selected &= times <= end
+        return selected
+
+    def memory_used(self):
+        # Bytes preallocated for readings
+        return self.times.nbytes + self.values.nbytes
@@ -0,0 +1,114 @@
+'''
+Replays captured ESBox traffic through the server
+
+Feeds the requests captured by the server (see capture.py) back through
+writetodb.py in this process: each one is made as an HTTP PUT on a new
+connection, as the ESBox made it, so it goes through twisted.web, decoding,
+routing, point building and the write pipeline to the configured storage
+backend (or an embedded store in --store instead). Requests are replayed one
+after another, in the order they were captured, either as fast as possible
+or (with --pace) at the pace they were received, sped up by --speed.
+
+At the end it prints the throughput and how many responses differ from the
+captured ones. Anything that depends on how much time has passed, like when
+an ESBox is next asked for its readings, will differ when replaying faster
+than the traffic was captured.
+
+writetodb.py's spool, command queue and so on are kept in the current
+directory as usual, so run it somewhere other than the live server's.
+
+Usage:
+
+    python replay.py [--pace] [--speed N] [--limit N] [--store DIRECTORY] capture/ [more captures...]
+
+'''
+
+import argparse
+import time
+
+from twisted.internet import address
+from twisted.internet.error import ConnectionDone
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.web import server
+
+from capture import read_captures
+
+import writetodb
+from embeddedstore import EmbeddedStore
+
+CLIENT_ADDRESS = address.IPv4Address("TCP", "127.0.0.1", 40000)
+
+def put_request(site, data):
+    # Returns the body of the response to a PUT of data on a new connection
+    transport = proto_helpers.StringTransport()
+    protocol = site.buildProtocol(CLIENT_ADDRESS)
+    protocol.makeConnection(transport)
+    protocol.dataReceived("PUT / HTTP/1.1\r\nHost: esco\r\nContent-Length: %d\r\n\r\n%s" % (len(data), data))
+    protocol.connectionLost(failure.Failure(ConnectionDone()))
+    return transport.value().partition("\r\n\r\n")[2]
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured ESBox traffic through the server")
+    parser.add_argument("captures", nargs="+", help="capture directories or segment files")
+    parser.add_argument("--pace", action="store_true", help="replay at the pace the requests were received")
+    parser.add_argument("--speed", type=float, default=1.0, help="speed up --pace by this much")
+    parser.add_argument("--limit", type=int, help="stop after this many requests")
+    parser.add_argument("--store", help="store the readings in an embedded store in this directory instead")
+    args = parser.parse_args()
+
+    # Don't capture the replay
+    writetodb.traffic_capture = None
+    if args.store:
+        writetodb.write_buffer.backend = EmbeddedStore(args.store)
+    writetodb.write_pipeline.start()
+    site = server.Site(writetodb.TestServer(), requestFactory=writetodb.ESBoxRequest)
+
+    num_requests = 0
+    num_bytes = 0
+    num_different = 0
+    request_times = []
+    first_received = None
+    start = time.time()
+    for each_request in read_captures(args.captures):
+        if args.limit is not None and num_requests >= args.limit:
+            break
+        if first_received is None:
+            first_received = each_request.received
+        if args.pace:
+            delay = start + (each_request.received - first_received) / args.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        request_start = time.time()
+        response = put_request(site, each_request.request)
+        request_times.append(time.time() - request_start)
+        num_requests += 1
+        num_bytes += len(each_request.request)
+        if response != each_request.response:
+            num_different += 1
+    replay_seconds = time.time() - start
+
+    # Wait for everything to reach the storage backend
+    writetodb.write_pipeline.stop()
+    write_seconds = time.time() - start
+    writetodb.write_buffer.backend.close()
+
+    request_times.sort()
+    print "Replayed %d requests (%d bytes) in %.2f s: %.0f requests/s" % (
+        num_requests, num_bytes, replay_seconds, num_requests / max(replay_seconds, 1e-6))
+    if request_times:
+        print "\tper request: median %.2f ms, 99th percentile %.2f ms, max %.2f ms" % (
+            1000 * percentile(request_times, 0.5), 1000 * percentile(request_times, 0.99), 1000 * request_times[-1])
+    print "\tpoints: %d built, %d written, %d failed (all written after %.2f s)" % (
+        writetodb.points_built.values[()], writetodb.write_pipeline.num_written_points,
+        writetodb.write_pipeline.num_failed_points, write_seconds)
+    print "\tresponses different from the captured ones: %d" % num_different
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+'''
+Pre-serialised responses to ESBoxes
+
+Most check-ins are answered with one of a handful of containers that never
+change - CloseConnection, or a GetData for the latest readings - so there's
+no point building and encoding them again for every request. ResponseBuilder
+encodes each static message once, along with the whole container for when
+it's sent on its own, and renders containers by joining already encoded
+messages between a fixed prefix and suffix. Only per-box commands (switching
+a relay, setting options and so on) are encoded as they're sent.
+
+'''
+
+import jsoncodec
+import SSMessages_8834 as M
+
+class ResponseBuilder():
+
+    def __init__(self, protocol_version, version_key=M.F.Gen.ProtocolVersion_1_1, messages_key=M.F.Gen.Messages_1_1):
+        # '{"PVer":"1.1","Msgs":[' ... ']}', or the 1.0 field names for 1.0 containers
+        self.prefix = "{%s:%s,%s:[" % (jsoncodec.dumps(version_key), jsoncodec.dumps(protocol_version),
+                                       jsoncodec.dumps(messages_key))
+        self.suffix = "]}"
+        # Complete containers for static messages sent on their own, by encoded message
+        self.containers = {}
+        # Static messages encoded by cached(), by key
+        self.messages = {}
+
+    def static_message(self, message):
+        # Encode a message that never changes, once. Returns the encoded message.
+        encoded = jsoncodec.dumps(message)
+        self.containers[encoded] = self.prefix + encoded + self.suffix
+        return encoded
+
+    def cached(self, key, build, *args):
+        # Returns the encoded message for key, building it with build(*args) the first time
+        encoded = self.messages.get(key)
+        if encoded is None:
+            encoded = self.messages[key] = self.static_message(build(*args))
+        return encoded
+
+    def encode(self, message):
+        # Encode a message that's only sent once
+        return jsoncodec.dumps(message)
+
+    def container(self, encoded_messages):
+        # Render a container from encoded messages
+        if len(encoded_messages) == 1:
+            container = self.containers.get(encoded_messages[0])
+            if container is not None:
+                return container
+        return self.prefix + ",".join(encoded_messages) + self.suffix
@@ -0,0 +1,103 @@
+'''
+Dispatch table for ESBox messages
+
+Handlers are registered against (protocol version, message id, cluster id,
+cluster manufacturer). Each message in a container is normalised to that key
+and routed with a single dict lookup, whichever protocol version it uses.
+
+Example:
+
+    router = MessageRouter()
+
+    @router.handler("1.1", M.SS_ESB.E.SendStatus_1_1, M.ClusterParts.SS_ESB)
+    def handle_status(message, container):
+        ...
+
+'''
+
+import SSMessages_8834 as M
+import metrics
+
+class ProtocolKeys():
+    # The field names used by one protocol version
+
+    def __init__(self, version, version_key, esbox_version_key, messages_key, msg_id_key,
+                 cluster_key, cluster_id_key, manufacturer_key):
+        self.version = version
+        self.version_key = version_key
+        self.esbox_version_key = esbox_version_key
+        self.messages_key = messages_key
+        self.msg_id_key = msg_id_key
+        self.cluster_key = cluster_key
+        self.cluster_id_key = cluster_id_key
+        self.manufacturer_key = manufacturer_key
+
+PROTOCOL_1_0 = ProtocolKeys("1.0", M.F.Gen.ProtocolVersion, M.F.Gen.ESBoxVersion, M.F.Gen.Messages, M.F.Gen.MsgID,
+                            M.F.Gen.Cluster, M.F.Gen.ClusterID, M.F.Gen.ClusterManufacturer)
+PROTOCOL_1_1 = ProtocolKeys("1.1", M.F.Gen.ProtocolVersion_1_1, M.F.Gen.ESBoxVersion_1_1, M.F.Gen.Messages_1_1, M.F.Gen.MsgID_1_1,
+                            M.F.Gen.Cluster_1_1, M.F.Gen.ClusterID_1_1, M.F.Gen.ClusterManufacturer_1_1)
+
+PROTOCOLS = {
+    PROTOCOL_1_0.version: PROTOCOL_1_0,
+    PROTOCOL_1_1.version: PROTOCOL_1_1,
+}
+
+# Matches a message from any cluster
+ANY_CLUSTER = M.ClusterParts.Common
+
+# Messages without a handler are counted together, so an ESBox can't make up new label values
+UNRECOGNISED = "unrecognised"
+messages_received = metrics.counter("esco_messages_total", "Messages received from ESBoxes", ("protocol", "msg_id"))
+
+def get_protocol(json_data):
+    # Returns the ProtocolKeys for a container, or None if it doesn't say which version it is
+    for each_protocol in (PROTOCOL_1_1, PROTOCOL_1_0):
+        if each_protocol.version_key in json_data:
+            return PROTOCOLS.get(json_data[each_protocol.version_key])
+    return None
+
+class MessageRouter():
+
+    def __init__(self):
+        self.handlers = {}
+        self.unrecognised_handler = None
+
+    def register(self, version, msg_id, cluster_parts, handler):
+        key = (version, msg_id, cluster_parts.ClusterId, cluster_parts.ClusterManufacturer)
+        self.handlers[key] = handler
+
+    def handler(self, version, msg_id, cluster_parts=ANY_CLUSTER):
+        # Decorator version of register()
+        def decorator(handler):
+            self.register(version, msg_id, cluster_parts, handler)
+            return handler
+        return decorator
+
+    def lookup(self, protocol, message):
+        cluster = message.get(protocol.cluster_key)
+        if cluster is None:
+            cluster_id = manufacturer = ANY_CLUSTER.ClusterId
+        else:
+            cluster_id = cluster.get(protocol.cluster_id_key)
+            manufacturer = cluster.get(protocol.manufacturer_key)
+        msg_id = message.get(protocol.msg_id_key)
+        handler = self.handlers.get((protocol.version, msg_id, cluster_id, manufacturer))
+        if handler is None:
+            handler = self.handlers.get((protocol.version, msg_id, ANY_CLUSTER.ClusterId, ANY_CLUSTER.ClusterManufacturer))
+        return handler
+
+    def route(self, protocol, messages, container):
+        # Dispatch each message in a container. Returns the number that had no handler.
+        num_unrecognised = 0
+        count_message = messages_received.inc
+        for each_message in messages:
+            handler = self.lookup(protocol, each_message)
+            if handler is None:
+                count_message((protocol.version, UNRECOGNISED))
+                num_unrecognised += 1
+                if self.unrecognised_handler is not None:
+                    self.unrecognised_handler(each_message, container)
+                continue
+            count_message((protocol.version, each_message.get(protocol.msg_id_key)))
+            handler(each_message, container)
+        return num_unrecognised
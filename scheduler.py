@@ -0,0 +1,77 @@
+'''
+Per-ESBox poll scheduler
+
+Keeps track of when we last fetched readings from each ESBox (identified by the
+ESBox IEEE in the container's Auth field) and how often we want readings from
+it. Commands for the boxes are queued separately (see commandqueue.py).
+
+Each check-in costs a dict lookup and a comparison with when the box is next
+due.
+
+SharedPollScheduler does the same with the schedule held in shared memory,
+for when the ESCo runs as several worker processes (see supervisor.py).
+
+'''
+
+import threading
+import time
+
+DEFAULT_POLL_INTERVAL = 10 # sec
+
+class BoxSchedule():
+
+    def __init__(self, esbox_id, interval):
+        self.esbox_id = esbox_id
+        self.interval = interval
+        self.last_fetch = None
+        self.last_check_in = None
+        self.next_due = 0
+
+class PollScheduler():
+
+    def __init__(self, default_interval=DEFAULT_POLL_INTERVAL):
+        self.default_interval = default_interval
+        self.boxes = {}
+        self.lock = threading.Lock()
+
+    def _get_box(self, esbox_id):
+        # Caller holds the lock
+        box = self.boxes.get(esbox_id)
+        if box is None:
+            box = self.boxes[esbox_id] = BoxSchedule(esbox_id, self.default_interval)
+        return box
+
+    def check_in(self, esbox_id, now=None):
+        # Called each time an ESBox sends us a container. Returns True if it's time to ask
+        # the box for its readings again.
+        if now is None:
+            now = time.time()
+        with self.lock:
+            box = self._get_box(esbox_id)
+            box.last_check_in = now
+            if now < box.next_due:
+                return False
+            box.last_fetch = now
+            box.next_due = now + box.interval
+            return True
+
+class SharedPollScheduler():
+    # A PollScheduler whose schedule lives in a sharedstate.SharedBoxTable, so all of the
+    # workers agree on when each box is next due
+
+    def __init__(self, table, default_interval=DEFAULT_POLL_INTERVAL):
+        self.table = table
+        self.default_interval = default_interval
+
+    def check_in(self, esbox_id, now=None):
+        if now is None:
+            now = time.time()
+        boxes = self.table.boxes
+        slot = self.table.slot(esbox_id)
+        with self.table.lock(slot):
+            boxes["last_check_in"][slot] = now
+            if now < boxes["next_due"][slot]:
+                return False
+            boxes["last_fetch"][slot] = now
+            boxes["next_due"][slot] = now + self.default_interval
+            return True
@@ -0,0 +1,218 @@
+'''
+Stream database (Sdb) support
+
+The ESBox logs every attribute report it receives into its stream database,
+and the ESCo can drain it through one of the FIFOs with GetData messages (see
+ExampleMessages_8447.ex_1_1__Sdb__SS_ESB_E_SendData_1_1). Unlike the latest
+readings buffer this gives us everything a meter reported between check-ins.
+
+Cells are delta encoded: the HAN, endpoint, cluster and time are only sent
+when they change from the previous cell, and later times are sent as a delta
+from the previous cell. decode_cells() undoes this in one pass and lays the
+attributes out in columns, one row per attribute.
+
+SdbDrain sizes each request (NCells) to the box's backlog: a full reply means
+there is more waiting, so the next request asks for more cells straight away.
+SharedSdbDrain does the same with the drain state held in shared memory, for
+when the ESCo runs as several worker processes (see supervisor.py) and a box's
+reply can reach a different worker from the one that asked for it.
+
+'''
+
+from array import array
+import threading
+
+import SSMessages_8834 as M
+from sharedstate import MISSING_INT
+
+# The FIFO we read from (0: ESCo, 1: web-app, 2: user-1, 3: user-2)
+ESCO_FIFO = 0
+
+MIN_CELLS = 10
+MAX_CELLS = 500
+
+class SdbColumns():
+
+    def __init__(self):
+        self.han = []
+        self.endpoint = array('l')
+        self.cluster_id = array('l')
+        self.manufacturer = array('l')
+        self.time = array('l')
+        self.attr_id = array('l')
+        self.attr_type = []
+        self.value = []
+        self.num_cells = 0
+
+    def __len__(self):
+        return len(self.attr_id)
+
+def decode_cells(cells, columns=None):
+    # Expand a list of (possibly delta encoded) v1.1 cells into columns
+    if columns is None:
+        columns = SdbColumns()
+
+    # Bind everything used in the loop to locals
+    han_key = M.F.Nwk.HAN_1_1
+    endpoint_key = M.F.Nwk.EndpointID_1_1
+    cluster_key = M.F.Gen.Cluster_1_1
+    cluster_id_key = M.F.Gen.ClusterID_1_1
+    manufacturer_key = M.F.Gen.ClusterManufacturer_1_1
+    time_key = M.F.Dat.Time_1_1
+    delta_time_key = M.F.Dat.DeltaTime_1_1
+    attributes_key = M.F.Dat.Attributes_1_1
+    attr_id_key = M.F.Dat.AttributeID_1_1
+    type_key = M.F.Dat.Type_1_1
+    value_key = M.F.Dat.Value_1_1
+    default_type = M.V.Dat.Type.Int
+
+    append_han = columns.han.append
+    append_endpoint = columns.endpoint.append
+    append_cluster_id = columns.cluster_id.append
+    append_manufacturer = columns.manufacturer.append
+    append_time = columns.time.append
+    append_attr_id = columns.attr_id.append
+    append_type = columns.attr_type.append
+    append_value = columns.value.append
+
+    han = None
+    endpoint = 0
+    cluster_id = 0
+    manufacturer = 0
+    cell_time = 0
+    for each_cell in cells:
+        if han_key in each_cell:
+            han = each_cell[han_key]
+        if endpoint_key in each_cell:
+            endpoint = each_cell[endpoint_key]
+        if cluster_key in each_cell:
+            cluster = each_cell[cluster_key]
+            cluster_id = cluster[cluster_id_key]
+            manufacturer = cluster[manufacturer_key]
+        if time_key in each_cell:
+            cell_time = each_cell[time_key]
+        elif delta_time_key in each_cell:
+            cell_time += each_cell[delta_time_key]
+        # (no time at all means the same time as the previous cell)
+
+        for each_attr in each_cell.get(attributes_key, ()):
+            append_han(han)
+            append_endpoint(endpoint)
+            append_cluster_id(cluster_id)
+            append_manufacturer(manufacturer)
+            append_time(cell_time)
+            append_attr_id(each_attr[attr_id_key])
+            append_type(each_attr.get(type_key, default_type))
+            append_value(each_attr[value_key])
+        columns.num_cells += 1
+    return columns
+
+def generate_get_data(num_cells, fifo=ESCO_FIFO):
+    new_message = {}
+    new_message[M.F.Gen.Cluster_1_1] = M.Clusters_1_1.SS_ESB
+    new_message[M.F.Gen.MsgID_1_1] = M.SS_ESB.E.GetData_1_1
+    new_message[M.F.Dat.Source] = M.V.Dat.Source.Sdb
+    new_message[M.F.Dat.Sdb.NCells] = num_cells
+    new_message[M.F.Dat.Sdb.Fifo] = fifo
+    new_message[M.F.Dat.Sdb.DelIeee] = 1
+    new_message[M.F.Dat.Sdb.DelEP] = 1
+    new_message[M.F.Dat.Sdb.DelClu] = 1
+    new_message[M.F.Dat.Sdb.DelTime] = 1
+    return new_message
+
+class DrainState():
+
+    def __init__(self, num_cells):
+        self.num_cells = num_cells
+        self.requested_cells = 0
+        self.backlog = False
+
+class SdbDrain():
+
+    def __init__(self, fifo=ESCO_FIFO, min_cells=MIN_CELLS, max_cells=MAX_CELLS):
+        self.fifo = fifo
+        self.min_cells = min_cells
+        self.max_cells = max_cells
+        self.boxes = {}
+        self.lock = threading.Lock()
+
+    def _get_state(self, esbox_id):
+        # Caller holds the lock
+        state = self.boxes.get(esbox_id)
+        if state is None:
+            state = self.boxes[esbox_id] = DrainState(self.min_cells)
+        return state
+
+    def request_cells(self, esbox_id):
+        # Returns how many cells to ask this ESBox for next, and records that we've asked
+        with self.lock:
+            state = self._get_state(esbox_id)
+            state.requested_cells = state.num_cells
+            state.backlog = False
+            return state.num_cells
+
+    def received(self, esbox_id, num_cells):
+        # Record how many cells a SendData reply held, and resize the next request to match
+        with self.lock:
+            state = self._get_state(esbox_id)
+            if state.requested_cells and num_cells >= state.requested_cells:
+                # Filled the request, so there's probably more waiting
+                state.backlog = True
+                state.num_cells = min(state.num_cells * 2, self.max_cells)
+            else:
+                state.backlog = False
+                if num_cells < state.num_cells // 2:
+                    state.num_cells = max(state.num_cells // 2, self.min_cells)
+            state.requested_cells = 0
+
+    def has_backlog(self, esbox_id):
+        with self.lock:
+            state = self.boxes.get(esbox_id)
+            return state is not None and state.backlog
+
+class SharedSdbDrain():
+    # An SdbDrain whose state lives in a sharedstate.SharedBoxTable
+
+    def __init__(self, table, fifo=ESCO_FIFO, min_cells=MIN_CELLS, max_cells=MAX_CELLS):
+        self.table = table
+        self.fifo = fifo
+        self.min_cells = min_cells
+        self.max_cells = max_cells
+
+    def _num_cells(self, slot):
+        # Caller holds the slot's lock
+        num_cells = int(self.table.boxes["sdb_cells"][slot])
+        if num_cells == MISSING_INT:
+            return self.min_cells
+        return num_cells
+
+    def request_cells(self, esbox_id):
+        boxes = self.table.boxes
+        slot = self.table.slot(esbox_id)
+        with self.table.lock(slot):
+            num_cells = self._num_cells(slot)
+            boxes["sdb_cells"][slot] = num_cells
+            boxes["sdb_requested"][slot] = num_cells
+            boxes["sdb_backlog"][slot] = 0
+            return num_cells
+
+    def received(self, esbox_id, num_cells):
+        if esbox_id is None:
+            return
+        boxes = self.table.boxes
+        slot = self.table.slot(esbox_id)
+        with self.table.lock(slot):
+            state_cells = self._num_cells(slot)
+            requested_cells = int(boxes["sdb_requested"][slot])
+            if requested_cells != MISSING_INT and requested_cells and num_cells >= requested_cells:
+                boxes["sdb_backlog"][slot] = 1
+                boxes["sdb_cells"][slot] = min(state_cells * 2, self.max_cells)
+            else:
+                boxes["sdb_backlog"][slot] = 0
+                if num_cells < state_cells // 2:
+                    boxes["sdb_cells"][slot] = max(state_cells // 2, self.min_cells)
+            boxes["sdb_requested"][slot] = 0
+
+    def has_backlog(self, esbox_id):
+        slot = self.table.lookup(esbox_id)
+        return slot is not None and self.table.boxes["sdb_backlog"][slot] == 1
@@ -0,0 +1,244 @@
+'''
+Per-ESBox state shared between worker processes
+
+When the ESCo runs as several worker processes (see supervisor.py) an ESBox's
+connections can land on any of them, so the per-ESBox state that decides what
+we send it - when its readings were last fetched, its clock offset, the
+protocol versions it supports and how its stream database is being drained -
+is kept in a table in shared memory rather
+than in each worker.
+
+The table is a NumPy structured array over an anonymous shared mmap, created
+by the supervisor before it forks the workers. Each ESBox gets a slot, found
+by open addressing on its IEEE, the first time something is stored for it;
+looking a box up never adds it. Slots are never moved, so each worker can
+cache where a box lives, checking the slot still holds the box before using
+it. Updates to a slot are made under one of a set of striped locks.
+
+Once the table is MAX_LOAD full, adding a box first evicts every box that
+hasn't checked in for IDLE_TIMEOUT, leaving tombstones that later boxes reuse.
+
+'''
+
+import mmap
+import multiprocessing
+import os
+import time
+import zlib
+
+import numpy as np
+
+DEFAULT_CAPACITY = 1 << 16
+NUM_LOCKS = 64
+# How full the table gets before idle boxes are evicted
+MAX_LOAD = 0.9
+IDLE_TIMEOUT = 24 * 3600 # sec
+
+# Keys of empty slots, and of slots whose box was evicted (box_key never makes either)
+EMPTY = 0
+TOMBSTONE = (1 << 64) - 1
+
+# Marks an int field that hasn't been set (float fields use NaN)
+MISSING_INT = np.iinfo(np.int64).min
+
+BOX_FIELDS = [
+    ("key", np.uint64),
+    ("last_fetch", np.float64),
+    ("last_check_in", np.float64),
+    ("next_due", np.float64),
+    ("offset", np.int64),
+    ("protocols", np.int64),
+    ("container_protocol", np.int64),
+    ("firmware", np.int64),
+    ("asked", np.float64),
+    ("sdb_cells", np.int64),
+    ("sdb_requested", np.int64),
+    ("sdb_backlog", np.int64),
+]
+
+# Set in each worker process by the supervisor before writetodb is imported
+current_worker = None
+
+class Worker():
+
+    def __init__(self, worker_id, table):
+        self.worker_id = worker_id
+        self.table = table
+
+def worker_directory(directory):
+    # Workers each get their own subdirectory for anything that only one process can write to
+    if current_worker is None:
+        return directory
+    return os.path.join(directory, "worker-%d" % current_worker.worker_id)
+
+def box_key(esbox_id):
+    # ESBoxes are identified by their IEEE, which fits in 63 bits. Anything else is hashed
+    # into the top half of the key space.
+    try:
+        key = int(esbox_id, 16)
+    except (TypeError, ValueError):
+        key = None
+    if key is None or key <= 0 or key >= 1 << 63:
+        key = (1 << 63) | (zlib.crc32(repr(esbox_id)) & 0xffffffff)
+    return key
+
+class SharedBoxTable():
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, num_locks=NUM_LOCKS):
+        self.capacity = capacity
+        dtype = np.dtype(BOX_FIELDS)
+        # An anonymous mmap is shared with any processes forked after it's created
+        self.memory = mmap.mmap(-1, capacity * dtype.itemsize)
+        self.boxes = np.frombuffer(self.memory, dtype=dtype)
+        self.boxes["key"] = EMPTY
+        self._clear(slice(None))
+
+        self.insert_lock = multiprocessing.Lock()
+        self.locks = [multiprocessing.Lock() for i in range(num_locks)]
+        # Boxes in the table, changed under insert_lock
+        self.num_boxes = multiprocessing.Value("l", 0, lock=False)
+
+        # Per process caches of where each box lives
+        self.slots = {}
+        self.ids = {}
+
+    def _clear(self, slots):
+        for name, field_type in BOX_FIELDS:
+            if name == "key":
+                continue
+            elif field_type == np.float64:
+                self.boxes[name][slots] = np.nan
+            else:
+                self.boxes[name][slots] = MISSING_INT
+
+    def _find(self, key):
+        # Returns (the slot holding key or None, the first free slot it could go in or None)
+        keys = self.boxes["key"]
+        index = (key ^ (key >> 29)) % self.capacity
+        free_slot = None
+        for i in xrange(self.capacity):
+            slot_key = int(keys[index])
+            if slot_key == key:
+                return index, None
+            if slot_key == EMPTY:
+                return None, index if free_slot is None else free_slot
+            if slot_key == TOMBSTONE and free_slot is None:
+                free_slot = index
+            index = (index + 1) % self.capacity
+        return None, free_slot
+
+    def lookup(self, esbox_id):
+        # Returns the slot for an ESBox, or None if it's not in the table
+        key = box_key(esbox_id)
+        slot = self.slots.get(esbox_id)
+        if slot is not None:
+            if int(self.boxes["key"][slot]) == key:
+                return slot
+            # Evicted by another worker
+            del self.slots[esbox_id]
+            self.ids.pop(slot, None)
+        slot, free_slot = self._find(key)
+        if slot is not None:
+            self._cache(esbox_id, slot)
+        return slot
+
+    def slot(self, esbox_id, now=None):
+        # Returns the slot for an ESBox, adding it to the table if it's not there yet. Only
+        # call this to store something for a box that's known to be genuine.
+        slot = self.lookup(esbox_id)
+        if slot is not None:
+            return slot
+        key = box_key(esbox_id)
+        if now is None:
+            now = time.time()
+        with self.insert_lock:
+            # Another process may have added it (or taken the slot) in the meantime
+            slot, free_slot = self._find(key)
+            if slot is None:
+                if self.num_boxes.value >= MAX_LOAD * self.capacity:
+                    self._evict_idle(now, IDLE_TIMEOUT)
+                    slot, free_slot = self._find(key)
+                if free_slot is None:
+                    raise RuntimeError("The shared ESBox table is full (%d boxes)" % self.capacity)
+                slot = free_slot
+                self._clear(slot)
+                # Counts as a check-in, so a box isn't evicted before it's had a chance to check in
+                self.boxes["last_check_in"][slot] = now
+                self.boxes["key"][slot] = key
+                self.num_boxes.value += 1
+        self._cache(esbox_id, slot)
+        return slot
+
+    def _cache(self, esbox_id, slot):
+        self.slots[esbox_id] = slot
+        self.ids[slot] = esbox_id
+
+    def evict_idle(self, now=None, idle_timeout=IDLE_TIMEOUT):
+        # Frees the slots of boxes that haven't checked in for idle_timeout. Returns how many.
+        if now is None:
+            now = time.time()
+        with self.insert_lock:
+            return self._evict_idle(now, idle_timeout)
+
+    def _evict_idle(self, now, idle_timeout):
+        # Caller holds insert_lock
+        keys = self.boxes["key"]
+        with np.errstate(invalid="ignore"):
+            idle = ~(self.boxes["last_check_in"] >= now - idle_timeout) & (keys != EMPTY) & (keys != TOMBSTONE)
+        slots = np.flatnonzero(idle)
+        for slot in slots:
+            with self.lock(slot):
+                self._clear(slot)
+                keys[slot] = TOMBSTONE
+        self.num_boxes.value -= len(slots)
+        return len(slots)
+
+    def lock(self, slot):
+        return self.locks[slot % len(self.locks)]
+
+    def esbox_id(self, slot):
+        esbox_id = self.ids.get(slot)
+        key = int(self.boxes["key"][slot])
+        if esbox_id is None or box_key(esbox_id) != key:
+            # Added by another worker
+            esbox_id = "%016X" % key if key < 1 << 63 else str(key)
+        return esbox_id
+
+    def field(self, name):
+        return SharedField(self, name)
+
+class SharedField():
+    # A dict-like view of one field of the table, keyed by ESBox id
+
+    def __init__(self, table, name):
+        self.table = table
+        self.name = name
+        self.values = table.boxes[name]
+        self.is_float = self.values.dtype == np.float64
+
+    def _is_missing(self, value):
+        if self.is_float:
+            return np.isnan(value)
+        return value == MISSING_INT
+
+    def get(self, esbox_id, default=None):
+        slot = self.table.lookup(esbox_id)
+        if slot is None:
+            return default
+        value = self.values[slot]
+        if self._is_missing(value):
+            return default
+        return value.item()
+
+    def __setitem__(self, esbox_id, value):
+        self.values[self.table.slot(esbox_id)] = value
+
+    def pop(self, esbox_id, default=None):
+        slot = self.table.lookup(esbox_id)
+        if slot is None:
+            return default
+        value = self.values[slot]
+        self.values[slot] = np.nan if self.is_float else MISSING_INT
+        if self._is_missing(value):
+            return default
+        return value.item()
@@ -0,0 +1,240 @@
+'''
+Durable write-ahead spool for readings
+
+Every batch of points is appended to the spool before it is queued for the
+database, so nothing is lost when the database is unavailable or the server
+is restarted. Once a batch has been written to the database the spool is told
+(acknowledge()) and the position is recorded in a checkpoint file. After an
+outage everything past the checkpoint is replayed from disk.
+
+On disk the spool is a directory of numbered segment files, each holding
+length-prefixed records:
+
+    [length: uint32][crc32: uint32][payload: JSON list of points]
+
+Appends are buffered and fsync()ed in batches (see sync_if_due()), so a crash
+loses at most fsync_interval seconds of readings. append() is called from the
+reactor thread, so it never waits for the disk: fsyncs happen outside the lock
+it takes, and a full segment is only rolled over to the next one by
+roll_if_due(), from the writer thread. Segments are read back with mmap, and
+deleted once everything in them has been acknowledged. The end of one segment
+and the start of the next are the same position, so positions are normalised
+to the latter before being compared with the end of the spool.
+
+'''
+
+import jsoncodec
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_FSYNC_INTERVAL = 1 # sec
+
+RECORD_HEADER = struct.Struct(">II")
+SEGMENT_SUFFIX = ".seg"
+CHECKPOINT_FILENAME = "checkpoint"
+
+def segment_filename(segment_no):
+    return "%010d%s" % (segment_no, SEGMENT_SUFFIX)
+
+def read_records(data, offset, end):
+    # Yields (offset after record, payload) for each intact record in data[offset:end]
+    header_size = RECORD_HEADER.size
+    while offset + header_size <= end:
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + header_size
+        if start + length > end:
+            return
+        payload = data[start:start + length]
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            return
+        offset = start + length
+        yield offset, payload
+
+class Spool():
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE, fsync_interval=DEFAULT_FSYNC_INTERVAL):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        # lock guards the spool's state and is taken by append(). sync_lock is held
+        # around the fsyncs (and the file writes and removals that go with them),
+        # which are done without lock.
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.checkpoint = self._read_checkpoint()
+        segments = self._segment_numbers()
+        if segments:
+            self.segment_no = max(segments[-1], self.checkpoint[0])
+        else:
+            self.segment_no = self.checkpoint[0]
+        self._open_segment()
+        self.dirty = False
+        self.time_of_last_sync = time.time()
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def _segment_numbers(self):
+        numbers = []
+        for each_filename in os.listdir(self.directory):
+            if each_filename.endswith(SEGMENT_SUFFIX):
+                numbers.append(int(each_filename[:-len(SEGMENT_SUFFIX)]))
+        numbers.sort()
+        return numbers
+
+    def _read_checkpoint(self):
+        try:
+            with open(self._path(CHECKPOINT_FILENAME)) as checkpoint_file:
+                segment_no, offset = checkpoint_file.read().split()
+                return (int(segment_no), int(offset))
+        except (IOError, ValueError):
+            return (0, 0)
+
+    def _open_segment(self):
+        # Opens the newest segment for appending, cutting off any partly written
+        # record left at the end of it by a crash
+        path = self._path(segment_filename(self.segment_no))
+        valid_end = 0
+        if os.path.exists(path):
+            with open(path, "rb") as segment_file:
+                data = segment_file.read()
+            for valid_end, payload in read_records(data, 0, len(data)):
+                pass
+        self.segment_file = open(path, "ab")
+        self.segment_file.truncate(valid_end)
+        self.segment_file.seek(valid_end)
+        self.segment_offset = valid_end
+
+    def append(self, points):
+        # Adds a batch of points to the spool and returns its position, which is the
+        # position replay() yields for it
+        payload = jsoncodec.dumps(points)
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+        with self.lock:
+            self.segment_file.write(record)
+            self.segment_offset += len(record)
+            self.dirty = True
+            return (self.segment_no, self.segment_offset)
+
+    def roll_if_due(self):
+        # Starts a new segment once the current one is full
+        if self.segment_offset < self.segment_size:
+            return
+        with self.sync_lock:
+            with self.lock:
+                if self.segment_offset < self.segment_size:
+                    return
+                full_file = self.segment_file
+                full_file.flush()
+                self.segment_no += 1
+                self.segment_file = open(self._path(segment_filename(self.segment_no)), "ab")
+                self.segment_offset = 0
+                self.dirty = False
+            os.fsync(full_file.fileno())
+            full_file.close()
+
+    def sync(self):
+        with self.sync_lock:
+            with self.lock:
+                segment_file = self.segment_file if self.dirty else None
+                if segment_file is not None:
+                    segment_file.flush()
+                    self.dirty = False
+                self.time_of_last_sync = time.time()
+            if segment_file is not None:
+                os.fsync(segment_file.fileno())
+
+    def sync_if_due(self):
+        if self.dirty and time.time() - self.time_of_last_sync >= self.fsync_interval:
+            self.sync()
+
+    def end_position(self):
+        with self.lock:
+            return (self.segment_no, self.segment_offset)
+
+    def _normalise(self, position):
+        # Caller holds the lock. Moves a position at the end of a finished segment (or in
+        # one that's gone) to the start of the next.
+        segment_no, offset = position
+        while segment_no < self.segment_no:
+            try:
+                size = os.path.getsize(self._path(segment_filename(segment_no)))
+            except OSError:
+                size = 0
+            if offset < size:
+                break
+            segment_no += 1
+            offset = 0
+        return (segment_no, offset)
+
+    def has_backlog(self):
+        with self.lock:
+            return (self.segment_no, self.segment_offset) > self._normalise(self.checkpoint)
+
+    def acknowledge(self, position):
+        # Everything up to position is safely in the database
+        with self.sync_lock:
+            with self.lock:
+                position = self._normalise(position)
+                if position <= self.checkpoint:
+                    return
+                self.checkpoint = position
+            checkpoint_path = self._path(CHECKPOINT_FILENAME)
+            with open(checkpoint_path + ".tmp", "w") as checkpoint_file:
+                checkpoint_file.write("%d %d" % position)
+                checkpoint_file.flush()
+                os.fsync(checkpoint_file.fileno())
+            os.rename(checkpoint_path + ".tmp", checkpoint_path)
+
+            for each_segment_no in self._segment_numbers():
+                if each_segment_no >= position[0]:
+                    break
+                os.remove(self._path(segment_filename(each_segment_no)))
+
+    def replay(self, start=None):
+        # Yields (position, points) for every batch after start (by default the checkpoint),
+        # up to the end of the spool as it was when each segment is reached
+        if start is None:
+            start = self.checkpoint
+        segment_no, offset = start
+        while True:
+            with self.lock:
+                if segment_no == self.segment_no:
+                    self.segment_file.flush()
+                    end = self.segment_offset
+                elif segment_no > self.segment_no:
+                    return
+                else:
+                    end = None
+            path = self._path(segment_filename(segment_no))
+            if os.path.exists(path):
+                with open(path, "rb") as segment_file:
+                    if end is None:
+                        end = os.fstat(segment_file.fileno()).st_size
+                    if end > offset:
+                        data = mmap.mmap(segment_file.fileno(), end, access=mmap.ACCESS_READ)
+                        try:
+                            for offset, payload in read_records(data, offset, end):
+                                yield (segment_no, offset), jsoncodec.loads(payload)
+                        finally:
+                            data.close()
+            with self.lock:
+                if segment_no >= self.segment_no:
+                    return
+            segment_no += 1
+            offset = 0
+
+    def close(self):
+        self.sync()
+        with self.sync_lock:
+            with self.lock:
+                self.segment_file.close()
@@ -0,0 +1,83 @@
+'''
+Storage backends for readings
+
+Everything that stores readings goes through a StorageBackend, which takes
+points in the InfluxDB client's format (see points.py):
+
+    {"measurement": ..., "tags": {...}, "time": ..., "fields": {...}}
+
+The WriteBuffer hands each batch to write_points(), and range queries go
+through query_range(). Two backends are provided:
+  - InfluxBackend: an InfluxDB server
+  - EmbeddedStore: a store kept in a local directory, for development,
+    testing and small single-site installs (see embeddedstore.py)
+
+'''
+
+try:
+    from influxdb import InfluxDBClient
+except ImportError:
+    InfluxDBClient = None
+
+class StorageBackend():
+
+    def write_points(self, points, time_precision='s'):
+        # Store a batch of points. Raises an exception if they couldn't all be stored.
+        raise NotImplementedError
+
+    def query_range(self, measurement, tags=None, start=None, end=None, fields=None):
+        # Returns the points in a measurement whose tags include tags, with times from start
+        # to end inclusive (either may be None), sorted by time within each series.
+        # fields limits which fields are returned.
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+def quote_identifier(name):
+    return '"%s"' % name.replace('"', '\\"')
+
+def quote_string(value):
+    return "'%s'" % str(value).replace("'", "\\'")
+
+class InfluxBackend(StorageBackend):
+
+    def __init__(self, host, port, username, password, database):
+        if InfluxDBClient is None:
+            raise RuntimeError("The influxdb package is needed for the InfluxDB storage backend")
+        self.client = InfluxDBClient(host, port, username, password, database)
+
+    def write_points(self, points, time_precision='s'):
+        self.client.write_points(points, time_precision=time_precision)
+
+    def query_range(self, measurement, tags=None, start=None, end=None, fields=None):
+        conditions = []
+        for key, value in sorted((tags or {}).iteritems()):
+            conditions.append("%s = %s" % (quote_identifier(key), quote_string(value)))
+        if start is not None:
+            conditions.append("time >= %ds" % start)
+        if end is not None:
+            conditions.append("time <= %ds" % end)
+        if fields:
+            selection = ", ".join(quote_identifier(each_field) for each_field in fields)
+        else:
+            selection = "*"
+        query = "SELECT %s FROM %s" % (selection, quote_identifier(measurement))
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " GROUP BY *"
+
+        points = []
+        for (series_measurement, series_tags), rows in self.client.query(query, epoch='s').items():
+            for each_row in rows:
+                timestamp = each_row.pop("time")
+                points.append({
+                    "measurement": series_measurement,
+                    "tags": series_tags,
+                    "time": timestamp,
+                    "fields": dict((key, value) for key, value in each_row.iteritems() if value is not None)
+                })
+        return points
+
+    def close(self):
+        self.client.close()
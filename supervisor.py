@@ -0,0 +1,152 @@
+'''
+Runs the ESCo as several worker processes
+
+A single Twisted reactor decodes JSON and builds points on one core. The
+supervisor forks NUM_WORKERS copies of writetodb.py, each with its own
+reactor, spool and write pipeline, all serving the same port:
+  - "reuseport": each worker binds its own socket with SO_REUSEPORT and the
+    kernel spreads incoming connections across them (Linux 3.9+)
+  - "inherit":   the supervisor binds one socket and every worker accepts
+    from it
+
+The per-ESBox scheduling state (when readings were last fetched, clock
+offsets) is kept in a sharedstate.SharedBoxTable created before the fork, so
+it doesn't matter which worker an ESBox's connection lands on.
+
+Workers that die are restarted. SIGTERM or SIGINT stops them all; each one
+flushes its write pipeline on the way out and anything it couldn't write is
+replayed from its spool next time.
+
+Usage:
+
+    python supervisor.py [--workers N] [--port PORT] [--socket reuseport|inherit]
+
+Twisted isn't imported here until after the fork, so every worker gets a
+fresh reactor.
+
+'''
+
+import argparse
+import errno
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+import logs
+import sharedstate
+
+log = logging.getLogger("supervisor")
+
+NUM_WORKERS = 16
+SERVER_PORT = 8081 # the same as writetodb.SERVER_PORT
+LISTEN_BACKLOG = 1024
+
+REUSEPORT = "reuseport"
+INHERIT = "inherit"
+
+# Python 2 doesn't name this one
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15 if sys.platform.startswith("linux") else None)
+
+# Don't restart a worker more often than this if it keeps dying
+RESTART_DELAY = 1 # sec
+
+def create_listening_socket(port, reuse_port):
+    listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        listening_socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    listening_socket.bind(("", port))
+    listening_socket.listen(LISTEN_BACKLOG)
+    listening_socket.setblocking(False)
+    return listening_socket
+
+def run_worker(worker_id, table, port, listening_socket):
+    # Runs in the child process and never returns
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    exit_code = 0
+    try:
+        if listening_socket is None:
+            listening_socket = create_listening_socket(port, True)
+        sharedstate.current_worker = sharedstate.Worker(worker_id, table)
+        import writetodb
+        writetodb.run_server(listening_socket)
+    except:
+        import traceback
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code)
+
+class Supervisor():
+
+    def __init__(self, num_workers=NUM_WORKERS, port=SERVER_PORT, socket_mode=REUSEPORT):
+        if socket_mode == REUSEPORT and SO_REUSEPORT is None:
+            log.warning("SO_REUSEPORT isn't available here, workers will share one inherited socket")
+            socket_mode = INHERIT
+        self.num_workers = num_workers
+        self.port = port
+        self.socket_mode = socket_mode
+        self.table = sharedstate.SharedBoxTable()
+        self.listening_socket = None
+        self.workers = {}
+        self.stopping = False
+
+    def start_worker(self, worker_id):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(worker_id, self.table, self.port, self.listening_socket)
+        self.workers[pid] = worker_id
+        log.info("Started worker %d (pid %d)", worker_id, pid)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        if self.socket_mode == INHERIT:
+            self.listening_socket = create_listening_socket(self.port, False)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for worker_id in range(self.num_workers):
+            self.start_worker(worker_id)
+        log.info("Serving ESBoxes on port %d with %d workers (%s)", self.port, self.num_workers, self.socket_mode)
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            worker_id = self.workers.pop(pid, None)
+            if worker_id is None:
+                continue
+            if self.stopping:
+                log.info("Worker %d stopped", worker_id)
+            else:
+                log.error("Worker %d (pid %d) died with status %d, restarting it", worker_id, pid, status)
+                time.sleep(RESTART_DELAY)
+                self.start_worker(worker_id)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the ESCo as several worker processes")
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--socket", choices=(REUSEPORT, INHERIT), default=REUSEPORT)
+    args = parser.parse_args()
+    logs.configure()
+    Supervisor(args.workers, args.port, args.socket).run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''
+Tests for auth.py
+
+Run with:
+
+    python -m unittest discover -p "test_*.py"
+
+'''
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import auth
+
+ESBOX_ID = "001BC50000000001"
+LINK_KEY = "5A6967426565416C6C69616E63653039"
+
+class AuthenticatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = auth.CredentialStore(os.path.join(self.directory, "credentials"))
+        self.store.set(ESBOX_ID, LINK_KEY, iterations=10)
+        self.authenticator = auth.Authenticator(self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_verifies_auth_decoded_from_json(self):
+        # Containers' Auth fields are decoded as unicode
+        decoded = json.loads(json.dumps({"Auth": [ESBOX_ID, LINK_KEY.lower()]}))["Auth"]
+        self.assertIsInstance(decoded[1], unicode)
+        self.assertTrue(self.authenticator.verify(decoded))
+
+    def test_verifies_after_reloading_the_store(self):
+        authenticator = auth.Authenticator(auth.CredentialStore(self.store.path))
+        self.assertTrue(authenticator.verify(json.loads(json.dumps([ESBOX_ID.lower(), LINK_KEY]))))
+
+    def test_rejects_wrong_key(self):
+        self.assertFalse(self.authenticator.verify([ESBOX_ID, u"00" * 16]))
+
+    def test_rejects_non_ascii_key(self):
+        self.assertFalse(self.authenticator.verify([ESBOX_ID, u"5A69\u00e9"]))
+        self.assertFalse(self.authenticator.verify([u"001BC5\u00e9", LINK_KEY]))
+
+    def test_rejects_malformed_auth(self):
+        for each_auth in (None, [], [ESBOX_ID], [ESBOX_ID, 1], {"a": 1}):
+            self.assertFalse(self.authenticator.verify(each_auth))
+
+class FailureLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = auth.CredentialStore(os.path.join(self.directory, "credentials"))
+        self.store.set(ESBOX_ID, LINK_KEY, iterations=10)
+        self.authenticator = auth.Authenticator(self.store, cache_size=4, max_failures=3, failure_window=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_wrong_keys_dont_push_out_verified_ones(self):
+        self.assertTrue(self.authenticator.verify([ESBOX_ID, LINK_KEY], now=1000))
+        for i in range(10):
+            self.assertFalse(self.authenticator.verify([ESBOX_ID, u"%032X" % i], now=1000))
+        self.assertTrue(self.authenticator.cached([ESBOX_ID, LINK_KEY], now=1000))
+
+    def test_wrong_keys_are_limited_per_esbox(self):
+        for i in range(3):
+            self.assertEqual(self.authenticator.cached([ESBOX_ID, u"%032X" % i], now=1000), None)
+            self.assertFalse(self.authenticator.verify([ESBOX_ID, u"%032X" % i], now=1000))
+        # Over the limit, even the right key (differently cased, so not hashed) is refused until the window is up
+        self.assertFalse(self.authenticator.cached([ESBOX_ID.lower(), LINK_KEY], now=1030))
+        self.assertFalse(self.authenticator.verify([ESBOX_ID.lower(), LINK_KEY], now=1030))
+        self.assertEqual(self.authenticator.cached([ESBOX_ID, LINK_KEY], now=1061), None)
+        self.assertTrue(self.authenticator.verify([ESBOX_ID, LINK_KEY], now=1061))
+
+    def test_unknown_esboxes_arent_counted(self):
+        for i in range(10):
+            self.assertFalse(self.authenticator.verify([u"%016X" % i, LINK_KEY], now=1000))
+        self.assertEqual(self.authenticator.failures, {})
+
+if __name__ == '__main__':
+    unittest.main()
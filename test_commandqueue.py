@@ -0,0 +1,74 @@
+'''
+Tests for commandqueue.py
+
+Run with:
+
+    python -m unittest discover -p "test_*.py"
+
+'''
+
+import shutil
+import tempfile
+import unittest
+
+import commandqueue
+from commandqueue import CommandQueue
+
+ESBOX_ID = "001BC50000000001"
+
+class LeaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # Two workers sharing the queue directory
+        self.first = CommandQueue(self.directory)
+        self.second = CommandQueue(self.directory)
+        self.command_ids = [self.first.enqueue(ESBOX_ID, commandqueue.generate_get_device_list()) for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_taken_commands_arent_taken_by_another_worker(self):
+        taken = self.first.take(ESBOX_ID, 2, 10000, now=1000)
+        self.assertEqual([command_id for command_id, encoded in taken], self.command_ids[:2])
+        taken = self.second.take(ESBOX_ID, 2, 10000, now=1001)
+        self.assertEqual([command_id for command_id, encoded in taken], self.command_ids[2:])
+        self.assertEqual(self.second.take(ESBOX_ID, 2, 10000, now=1002), [])
+
+    def test_acknowledge_and_release(self):
+        taken = [command_id for command_id, encoded in self.first.take(ESBOX_ID, 3, 10000, now=1000)]
+        self.first.acknowledge(ESBOX_ID, taken[:1])
+        self.first.release(ESBOX_ID, taken[1:2])
+        taken = self.second.take(ESBOX_ID, 3, 10000, now=1001)
+        self.assertEqual([command_id for command_id, encoded in taken], self.command_ids[1:2])
+        self.assertEqual([command_id for command_id, message in self.second.pending(ESBOX_ID)], self.command_ids[1:])
+
+    def test_lease_runs_out(self):
+        self.first.take(ESBOX_ID, 3, 10000, now=1000)
+        # The first worker died before the reply finished
+        taken = self.second.take(ESBOX_ID, 3, 10000, now=1000 + commandqueue.LEASE_TIMEOUT + 1)
+        self.assertEqual([command_id for command_id, encoded in taken], self.command_ids)
+
+class SizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.queue = CommandQueue(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_a_big_command_doesnt_hold_up_the_rest(self):
+        big = self.queue.enqueue(ESBOX_ID, commandqueue.generate_set_esbox_options({"Name": "x" * 1000}))
+        small = self.queue.enqueue(ESBOX_ID, commandqueue.generate_get_device_list())
+        # The big one goes alone even though it's over the budget, then the small one
+        self.assertEqual([command_id for command_id, encoded in self.queue.take(ESBOX_ID, 32, 500, now=1000)], [big])
+        self.assertEqual([command_id for command_id, encoded in self.queue.take(ESBOX_ID, 32, 500, now=1000)], [small])
+
+    def test_commands_over_the_limit_are_refused(self):
+        message = commandqueue.generate_set_esbox_options({"Name": "x" * commandqueue.MAX_COMMAND_BYTES})
+        self.assertRaises(ValueError, self.queue.enqueue, ESBOX_ID, message)
+        self.assertFalse(self.queue.has_commands(ESBOX_ID))
+
+if __name__ == "__main__":
+    unittest.main()
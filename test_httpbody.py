@@ -0,0 +1,50 @@
+'''
+Tests for httpbody.py
+
+Run with:
+
+    python -m unittest discover -p "test_*.py"
+
+'''
+
+import json
+import unittest
+
+from httpbody import ContainerParser
+
+CONTAINERS = [
+    '{"a": [1, -2.5]}',
+    '{"a": [1, 1e10, -3.25E-7, 0, -0.5]}',
+    '{"a": {"b": 1.5}}',
+    '{"PVer": "1.1", "Msgs": [{"M": "SD", "Src": "S", "Dat": {"C": [[1, 2.75, -3], [4e2, 5, 6]]}}, '
+    '{"M": "NFM", "n": null, "t": true, "f": false, "s": "1.5e"}], "Auth": ["001BC502B0100359", "11"]}',
+    ' [ 12345 , -67.890e+12 , "x" , { } , [ ] ] ',
+    '-1.5',
+]
+
+class ContainerParserTest(unittest.TestCase):
+
+    def parse(self, chunks, split_depth):
+        parser = ContainerParser(split_depth)
+        for each_chunk in chunks:
+            parser.feed(each_chunk)
+        return parser.close()
+
+    def test_split_at_every_offset(self):
+        for each_container in CONTAINERS:
+            expected = json.loads(each_container)
+            for split_depth in (1, 5):
+                for offset in range(len(each_container) + 1):
+                    chunks = [each_container[:offset], each_container[offset:]]
+                    self.assertEqual(self.parse(chunks, split_depth), expected,
+                                     "%r split at %d" % (each_container, offset))
+
+    def test_one_byte_at_a_time(self):
+        for each_container in CONTAINERS:
+            self.assertEqual(self.parse(list(each_container), 5), json.loads(each_container))
+
+    def test_invalid_number(self):
+        self.assertRaises(ValueError, self.parse, ['{"a": [1.', 'x]}'], 5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+'''
+Tests for recentreadings.py
+
+Run with:
+
+    python -m unittest discover -p "test_*.py"
+
+'''
+
+import unittest
+
+from recentreadings import RecentReadings
+
+def reading_point(han, timestamp, value):
+    return {"tags": {"ieee": han, "endpoint": "1"}, "time": timestamp, "fields": {"power": value}}
+
+class EvictionTest(unittest.TestCase):
+
+    def test_batch_that_overflows_the_store(self):
+        readings = RecentReadings(64, 64 * 16 * 4)
+        readings.add_points([reading_point("O%d" % i, 100, float(i)) for i in range(60)], now=1)
+        readings.add_points([reading_point("N%d" % i, 200, 1000.0 + i) for i in range(10)], now=2)
+        for i in range(10):
+            self.assertEqual(readings.latest("N%d" % i, 1, "power"), (200, 1000.0 + i))
+        # Room was made by dropping old series
+        self.assertEqual(len(readings.hans()), 64)
+
+    def test_batch_bigger_than_the_store(self):
+        readings = RecentReadings(16, 16 * 16 * 4)
+        readings.add_points([reading_point("N%d" % i, 200, float(i)) for i in range(20)], now=1)
+        self.assertEqual(len(readings.hans()), 16)
+        for each_han in readings.hans():
+            self.assertEqual(readings.latest(each_han, 1, "power"), (200, float(each_han[1:])))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+'''
+Tests for sharedstate.py
+
+Run with:
+
+    python -m unittest discover -p "test_*.py"
+
+'''
+
+import unittest
+
+import capabilities
+from capabilities import CapabilityCache
+from router import PROTOCOL_1_1
+import sdb
+import sharedstate
+from sharedstate import SharedBoxTable
+
+ESBOX_ID = "001BC50000000001"
+
+class SharedBoxTableTest(unittest.TestCase):
+
+    def test_lookups_dont_add_boxes(self):
+        table = SharedBoxTable(capacity=16, num_locks=4)
+        offsets = table.field("offset")
+        for i in range(100):
+            self.assertEqual(offsets.get("%016X" % i, 7), 7)
+            self.assertEqual(offsets.pop("%016X" % i), None)
+        self.assertEqual(table.num_boxes.value, 0)
+
+        offsets["001BC50000000001"] = 5
+        self.assertEqual(offsets.get("001BC50000000001"), 5)
+        self.assertEqual(table.num_boxes.value, 1)
+
+    def test_idle_boxes_are_evicted_when_the_table_fills(self):
+        table = SharedBoxTable(capacity=16, num_locks=4)
+        offsets = table.field("offset")
+        for i in range(14):
+            table.slot("%016X" % (i + 1), now=0)
+        # Past MAX_LOAD, so adding another evicts the idle ones
+        now = sharedstate.IDLE_TIMEOUT + 1
+        for i in range(10):
+            esbox_id = "%016X" % (i + 100)
+            table.slot(esbox_id, now=now)
+            offsets[esbox_id] = i
+        self.assertEqual(table.num_boxes.value, 10)
+        self.assertEqual(table.lookup("%016X" % 1), None)
+        for i in range(10):
+            self.assertEqual(offsets.get("%016X" % (i + 100)), i)
+
+    def test_full_table_of_active_boxes(self):
+        table = SharedBoxTable(capacity=8, num_locks=4)
+        for i in range(8):
+            table.slot("%016X" % (i + 1), now=100)
+        self.assertRaises(RuntimeError, table.slot, "%016X" % 9, 100)
+
+    def test_cached_slot_of_an_evicted_box_isnt_used(self):
+        table = SharedBoxTable(capacity=16, num_locks=4)
+        offsets = table.field("offset")
+        offsets["0000000000000001"] = 3
+        table.boxes["last_check_in"][table.lookup("0000000000000001")] = 0
+        self.assertEqual(table.evict_idle(now=sharedstate.IDLE_TIMEOUT + 1), 1)
+        self.assertEqual(offsets.get("0000000000000001"), None)
+        self.assertEqual(table.num_boxes.value, 0)
+
+class SharedSdbDrainTest(unittest.TestCase):
+
+    def test_reply_to_another_worker_continues_the_drain(self):
+        table = SharedBoxTable(capacity=16, num_locks=4)
+        asking_worker = sdb.SharedSdbDrain(table)
+        replying_worker = sdb.SharedSdbDrain(table)
+        num_cells = asking_worker.request_cells("001BC50000000001")
+        replying_worker.received("001BC50000000001", num_cells)
+        self.assertTrue(asking_worker.has_backlog("001BC50000000001"))
+        self.assertEqual(asking_worker.request_cells("001BC50000000001"), 2 * num_cells)
+        self.assertFalse(replying_worker.has_backlog("001BC50000000002"))
+
+class SharedCapabilitiesTest(unittest.TestCase):
+
+    def make_worker(self, table):
+        return CapabilityCache(protocols=table.field("protocols"),
+                               container_protocols=table.field("container_protocol"),
+                               firmware=table.field("firmware"),
+                               asked=table.field("asked"))
+
+    def test_workers_share_the_negotiation(self):
+        table = SharedBoxTable(capacity=16, num_locks=4)
+        first = self.make_worker(table)
+        second = self.make_worker(table)
+        container = {"PVer": "1.1", "EVer": "2.0"}
+        self.assertIs(first.container_protocol(ESBOX_ID, container), PROTOCOL_1_1)
+        first.check_firmware(ESBOX_ID, "2.0")
+        self.assertTrue(first.should_ask(ESBOX_ID, now=100))
+        # Asked once, whichever worker the box reaches next
+        self.assertFalse(second.should_ask(ESBOX_ID, now=101))
+        # No answer, so both take it to support what it speaks
+        self.assertEqual(second.supported_versions(ESBOX_ID, now=100 + capabilities.NEGOTIATION_TIMEOUT),
+                         frozenset(["1.1"]))
+        self.assertEqual(first.supported_versions(ESBOX_ID), frozenset(["1.1"]))
+
+        # New firmware starts the negotiation again everywhere
+        second.check_firmware(ESBOX_ID, "2.1")
+        self.assertEqual(first.supported_versions(ESBOX_ID), None)
+        self.assertTrue(first.should_ask(ESBOX_ID, now=200))
+        second.received_versions(ESBOX_ID, ["1.0", "1.1"])
+        self.assertEqual(first.supported_versions(ESBOX_ID), frozenset(["1.0", "1.1"]))
+
+if __name__ == '__main__':
+    unittest.main()
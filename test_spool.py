@@ -0,0 +1,140 @@
+'''
+Tests for spool.py and the replay in writepipeline.py
+
+Run with:
+
+    python -m unittest discover -p "test_*.py"
+
+'''
+
+import shutil
+import tempfile
+import time
+import unittest
+
+from spool import Spool
+from writebuffer import WriteBuffer
+import writepipeline
+
+POINT = {"measurement": "readings", "tags": {"ieee": "001BC502B0300000"}, "fields": {"v": 1}, "time": 1}
+
+class MemoryBackend():
+
+    def __init__(self):
+        self.points = []
+        self.fail = False
+
+    def write_points(self, points, time_precision='s'):
+        if self.fail:
+            raise IOError("database down")
+        self.points.extend(points)
+
+    def close(self):
+        pass
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_no_backlog_after_acknowledging_a_filled_segment(self):
+        # Every append fills a segment, which the writer then rolls over to a new one
+        spool = Spool(self.directory, segment_size=30)
+        appended = []
+        for i in range(3):
+            appended.append(spool.append([POINT]))
+            spool.roll_if_due()
+        self.assertEqual(spool.end_position(), (3, 0))
+        replayed = list(spool.replay())
+        self.assertEqual([position for position, points in replayed], appended)
+
+        spool.acknowledge(replayed[-1][0])
+        self.assertFalse(spool.has_backlog())
+        self.assertEqual(list(spool.replay()), [])
+        self.assertEqual(spool.checkpoint, (3, 0))
+        spool.close()
+
+    def test_checkpoint_at_a_segment_end_survives_a_restart(self):
+        spool = Spool(self.directory, segment_size=30)
+        position = spool.append([POINT])
+        spool.roll_if_due()
+        spool.acknowledge(position)
+        spool.close()
+        spool = Spool(self.directory, segment_size=30)
+        self.assertFalse(spool.has_backlog())
+        position = spool.append([POINT])
+        self.assertEqual([each_position for each_position, points in spool.replay()], [position])
+        spool.close()
+
+    def test_append_leaves_rolling_to_the_writer(self):
+        spool = Spool(self.directory, segment_size=30)
+        first = spool.append([POINT])
+        second = spool.append([POINT])
+        self.assertEqual(first[0], 0)
+        self.assertEqual(second[0], 0)
+        spool.roll_if_due()
+        self.assertEqual(spool.end_position(), (1, 0))
+        self.assertEqual([position for position, points in spool.replay()], [first, second])
+        spool.close()
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replay_catches_up_across_a_segment_roll_without_spinning(self):
+        backend = MemoryBackend()
+        spool = Spool(self.directory, segment_size=30)
+        pipeline = writepipeline.WritePipeline(WriteBuffer(backend, max_points=1), spool=spool, retry_interval=0.1)
+        num_replays = [0]
+        replay = pipeline._replay
+        def counting_replay():
+            num_replays[0] += 1
+            return replay()
+        pipeline._replay = counting_replay
+
+        backend.fail = True
+        pipeline.start()
+        pipeline.put([POINT])
+        time.sleep(0.3)
+        self.assertTrue(pipeline.replaying)
+        backend.fail = False
+        time.sleep(1)
+        num_replays[0] = 0
+        time.sleep(1)
+
+        self.assertFalse(pipeline.replaying)
+        self.assertFalse(spool.has_backlog())
+        self.assertEqual(num_replays[0], 0)
+        self.assertEqual(len(backend.points), 1)
+        pipeline.stop()
+        spool.close()
+
+    def test_retries_of_a_failed_batch_are_counted_once(self):
+        backend = MemoryBackend()
+        spool = Spool(self.directory)
+        pipeline = writepipeline.WritePipeline(WriteBuffer(backend, max_points=1), spool=spool, retry_interval=0.05)
+        backend.fail = True
+        pipeline.start()
+        pipeline.put([POINT, POINT])
+        time.sleep(0.5)
+        pipeline.put([POINT])
+        time.sleep(0.5)
+        backend.fail = False
+        time.sleep(0.5)
+        pipeline.stop()
+        spool.close()
+
+        # The second batch waits behind the first while it's retried, so it never fails
+        self.assertEqual(pipeline.num_failed_points, 2)
+        self.assertTrue(pipeline.num_retried_points > 0)
+        self.assertEqual(len(backend.points), 3)
+
+if __name__ == '__main__':
+    unittest.main()
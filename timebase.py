@@ -0,0 +1,53 @@
+'''
+Converts ESBox timestamps to UTC
+
+The ESBox stamps every container (wrapper-level Tm) and every attribute (Tm)
+with its own clock, which isn't necessarily right - see Raw_data, where the
+box reports times around 2961722568. The offset between the box's clock and
+ours is worked out once per container from the wrapper Tm and applied to all
+of the attribute times in it.
+
+The offset is remembered per ESBox and only replaced when it drifts by more
+than OFFSET_TOLERANCE, so the same reading always maps to the same UTC time.
+That way a retried or duplicated upload overwrites the points it already
+wrote instead of creating new ones.
+
+'''
+
+import threading
+
+# Largest difference (in seconds) between two offsets that we treat as the same
+# clock. This has to cover network and processing delays between the ESBox
+# stamping a container and us receiving it.
+OFFSET_TOLERANCE = 120 # sec
+
+class TimebaseNormaliser():
+
+    def __init__(self, tolerance=OFFSET_TOLERANCE, offsets=None):
+        # offsets can be shared between processes (see sharedstate.SharedField)
+        self.tolerance = tolerance
+        self.offsets = {} if offsets is None else offsets
+        self.lock = threading.Lock()
+
+    def container_offset(self, esbox_id, esbox_time, receive_time):
+        # Returns the number of seconds to add to this ESBox's timestamps to get UTC
+        if esbox_time is None:
+            return 0
+        offset = int(receive_time) - int(esbox_time)
+        if abs(offset) <= self.tolerance:
+            # The ESBox clock is good enough to be used as-is
+            offset = 0
+
+        with self.lock:
+            previous_offset = self.offsets.get(esbox_id)
+            if previous_offset is not None and abs(offset - previous_offset) <= self.tolerance:
+                return previous_offset
+            self.offsets[esbox_id] = offset
+        return offset
+
+    def forget(self, esbox_id):
+        with self.lock:
+            self.offsets.pop(esbox_id, None)
+
+def to_utc(esbox_time, offset):
+    return int(esbox_time) + offset
@@ -0,0 +1,88 @@
+'''
+Buffered writer for a storage backend
+
+Points are accumulated across messages (and ESBoxes) and sent to the
+storage backend (see storage.py) with a single bulk write_points() call once
+the buffer holds enough points or bytes, or once the oldest buffered point
+is old enough.
+
+'''
+
+import time
+
+import metrics
+
+DEFAULT_MAX_POINTS = 5000
+DEFAULT_MAX_BYTES = 1024 * 1024
+DEFAULT_MAX_AGE = 5 # sec
+
+flush_seconds = metrics.histogram("esco_storage_flush_seconds", "Time taken by each bulk write to the storage backend")
+flush_points = metrics.histogram("esco_storage_flush_points", "Points in each bulk write to the storage backend",
+                                 buckets=(10, 100, 500, 1000, 2500, 5000, 10000, 50000))
+
+def estimate_point_size(point):
+    # Rough size of the point once rendered as line protocol. It doesn't need
+    # to be exact, only good enough to stop a single flush getting too large.
+    size = len(point["measurement"]) + 12
+    for key, value in point.get("tags", {}).iteritems():
+        size += len(key) + len(str(value)) + 2
+    for key, value in point["fields"].iteritems():
+        size += len(key) + len(str(value)) + 2
+    return size
+
+class WriteBuffer():
+
+    def __init__(self, backend, max_points=DEFAULT_MAX_POINTS, max_bytes=DEFAULT_MAX_BYTES,
+                 max_age=DEFAULT_MAX_AGE, time_precision='s'):
+        self.backend = backend
+        self.max_points = max_points
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.time_precision = time_precision
+
+        self.points = []
+        self.num_bytes = 0
+        self.time_of_first_point = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def add(self, points):
+        # Buffer some points. Returns True if the buffer is now due to be flushed.
+        if not points:
+            return self.is_full()
+        if self.time_of_first_point is None:
+            self.time_of_first_point = time.time()
+        self.points.extend(points)
+        for each_point in points:
+            self.num_bytes += estimate_point_size(each_point)
+        return self.is_full()
+
+    def is_full(self):
+        return len(self.points) >= self.max_points or self.num_bytes >= self.max_bytes
+
+    def is_stale(self):
+        if self.time_of_first_point is None:
+            return False
+        return time.time() - self.time_of_first_point >= self.max_age
+
+    def flush_if_due(self):
+        if self.is_full() or self.is_stale():
+            return self.flush()
+        return 0
+
+    def flush(self):
+        # Send everything buffered so far in one bulk write. The buffer is emptied
+        # before writing so that a failing database doesn't make it grow forever.
+        if not self.points:
+            return 0
+        points = self.points
+        self.points = []
+        self.num_bytes = 0
+        self.time_of_first_point = None
+
+        start = time.time()
+        self.backend.write_points(points, time_precision=self.time_precision)
+        flush_seconds.observe(time.time() - start)
+        flush_points.observe(len(points))
+        return len(points)
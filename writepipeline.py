@@ -0,0 +1,242 @@
+'''
+Bounded write pipeline between the Twisted reactor and the database
+
+The reactor thread only ever calls put(), which queues the points built from
+one container and returns straight away. A dedicated writer thread drains the
+queue into a WriteBuffer and does the (blocking) database writes, so a slow
+database no longer holds up the ESBox connections.
+
+If a spool is given (see spool.py) every batch is appended to it before being
+queued, and acknowledged once it has been written to the database. Whenever
+the database can't keep up or is unavailable, the writer stops using the queue
+and replays the spool from its checkpoint instead, retrying until it's caught
+up. Writes are idempotent (points are stamped with the reading time), so any
+batch that gets written twice along the way just overwrites itself.
+
+When the queue is full one of the following policies applies:
+  - BLOCK:       wait (up to block_timeout seconds) for the writer to catch up,
+                 then fall back to dropping the oldest points
+  - DROP_OLDEST: throw away the oldest queued points to make room
+  - SPILL:       leave the points in the spool only, and have the writer catch
+                 up by replaying it (needs a spool)
+
+'''
+
+from collections import deque
+import logging
+import threading
+import time
+
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+SPILL = "spill"
+
+DEFAULT_MAX_QUEUED_POINTS = 100000
+DEFAULT_BLOCK_TIMEOUT = 1 # sec
+DEFAULT_RETRY_INTERVAL = 5 # sec
+
+log = logging.getLogger(__name__)
+
+# How often the writer thread wakes up to check for stale points in the buffer
+WRITER_POLL_INTERVAL = 0.5 # sec
+
+class WritePipeline():
+
+    def __init__(self, write_buffer, spool=None, max_queued_points=DEFAULT_MAX_QUEUED_POINTS, policy=SPILL,
+                 block_timeout=DEFAULT_BLOCK_TIMEOUT, retry_interval=DEFAULT_RETRY_INTERVAL):
+        if policy not in (BLOCK, DROP_OLDEST, SPILL):
+            raise ValueError("Unknown write pipeline policy: %s" % policy)
+        if policy == SPILL and spool is None:
+            raise ValueError("The %s write pipeline policy needs a spool" % policy)
+        self.write_buffer = write_buffer
+        self.spool = spool
+        self.max_queued_points = max_queued_points
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.retry_interval = retry_interval
+
+        self.queue = deque()
+        self.num_queued_points = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.running = False
+        self.thread = None
+
+        # While replaying, new points only go to the spool
+        self.replaying = spool is not None and spool.has_backlog()
+        # Spool position of the last batch handed to the write buffer, and (position, number
+        # of points) for each batch in it
+        self.buffered_position = None
+        self.buffered_batches = []
+        # Spool position of the last batch whose write failed. Batches up to it that fail
+        # again are retries, and are counted as such rather than as new failures.
+        self.failed_position = None
+
+        self.num_dropped_points = 0
+        self.num_spilled_points = 0
+        self.num_written_points = 0
+        self.num_failed_points = 0
+        self.num_retried_points = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="db-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        # Ask the writer to drain whatever is queued, flush and exit. Anything it
+        # can't write stays in the spool for next time.
+        with self.lock:
+            self.running = False
+            self.not_empty.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+        if self.spool is not None:
+            self.spool.sync()
+
+    def put(self, points):
+        # Called from the reactor thread. Never blocks unless the BLOCK policy is in use.
+        if not points:
+            return
+        with self.lock:
+            position = None
+            if self.spool is not None:
+                position = self.spool.append(points)
+                if self.replaying:
+                    self.num_spilled_points += len(points)
+                    return
+            if self.num_queued_points + len(points) > self.max_queued_points:
+                if self.policy == BLOCK:
+                    deadline = time.time() + self.block_timeout
+                    while self.num_queued_points + len(points) > self.max_queued_points:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self.not_full.wait(remaining)
+                elif self.policy == SPILL:
+                    self.num_spilled_points += len(points)
+                    self._start_replaying()
+                    return
+                self._drop_oldest(len(points))
+            self.queue.append((points, position))
+            self.num_queued_points += len(points)
+            self.not_empty.notify()
+
+    def _drop_oldest(self, num_needed):
+        # Caller holds the lock
+        while self.queue and self.num_queued_points + num_needed > self.max_queued_points:
+            dropped, position = self.queue.popleft()
+            self.num_queued_points -= len(dropped)
+            self.num_dropped_points += len(dropped)
+
+    def _start_replaying(self):
+        # Caller holds the lock. Everything queued is also in the spool, so it can go.
+        self.replaying = True
+        self.queue.clear()
+        self.num_queued_points = 0
+        self.not_full.notify_all()
+
+    def _run(self):
+        while True:
+            if self.spool is not None:
+                self.spool.roll_if_due()
+                self.spool.sync_if_due()
+
+            if self.replaying:
+                num_replayed = self._replay()
+                if num_replayed is None:
+                    with self.lock:
+                        if not self.running:
+                            return
+                        self.not_empty.wait(self.retry_interval)
+                elif not num_replayed and self.replaying:
+                    # Nothing new in the spool yet
+                    with self.lock:
+                        if self.running:
+                            self.not_empty.wait(WRITER_POLL_INTERVAL)
+                continue
+
+            with self.lock:
+                if not self.queue and self.running:
+                    self.not_empty.wait(WRITER_POLL_INTERVAL)
+                batches = list(self.queue)
+                self.queue.clear()
+                self.num_queued_points = 0
+                running = self.running
+                self.not_full.notify_all()
+
+            for points, position in batches:
+                full = self._buffer(points, position)
+                if full and not self._flush(True):
+                    break
+            else:
+                self._flush(not running)
+
+            if not running and not batches and not self.replaying:
+                return
+
+    def _replay(self):
+        # Feed everything in the spool past the checkpoint to the database. Returns
+        # the number of batches replayed, or None if the database is still unavailable.
+        num_replayed = 0
+        for position, points in self.spool.replay():
+            num_replayed += 1
+            full = self._buffer(points, position)
+            if full and not self._flush(True):
+                return None
+            if not self.running:
+                break
+        if not self._flush(True):
+            return None
+
+        with self.lock:
+            if not self.running or not self.spool.has_backlog():
+                # Caught up, so go back to taking batches from the queue
+                self.replaying = False
+        return num_replayed
+
+    def _buffer(self, points, position):
+        # Returns True if the write buffer is now due to be flushed
+        self.buffered_position = position
+        self.buffered_batches.append((position, len(points)))
+        return self.write_buffer.add(points)
+
+    def _count_failure(self):
+        # Each batch counts as failed the first time, and as retried after that
+        num_retried = 0
+        if self.failed_position is not None:
+            num_retried = sum(num_points for position, num_points in self.buffered_batches
+                              if position is not None and position <= self.failed_position)
+        num_failed = sum(num_points for position, num_points in self.buffered_batches) - num_retried
+        self.num_failed_points += num_failed
+        self.num_retried_points += num_retried
+        if self.buffered_position is not None and (self.failed_position is None or
+                                                   self.buffered_position > self.failed_position):
+            self.failed_position = self.buffered_position
+        return num_failed, num_retried
+
+    def _flush(self, force):
+        # Returns False if the write failed
+        try:
+            if force:
+                num_written = self.write_buffer.flush()
+            else:
+                num_written = self.write_buffer.flush_if_due()
+        except Exception as e:
+            num_failed, num_retried = self._count_failure()
+            self.buffered_batches = []
+            log.error("Couldn't write %d readings (%d of them retries) to the database: %s",
+                      num_failed + num_retried, num_retried, e)
+            if self.spool is not None:
+                with self.lock:
+                    self._start_replaying()
+            return False
+        if not len(self.write_buffer):
+            self.buffered_batches = []
+        self.num_written_points += num_written
+        if num_written and self.spool is not None and self.buffered_position is not None:
+            self.spool.acknowledge(self.buffered_position)
+        return True
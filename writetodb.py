@@ -7,40 +7,211 @@ Very simple demonstration of a lightweight ESCo in Python Twisted
 
 '''
 
-from twisted.internet import reactor
+from twisted.internet import reactor, defer, threads
+from twisted.internet.task import LoopingCall
 from twisted.web import server, resource
-from influxdb import InfluxDBClient 
-from datetime import datetime
+import logging
 import time
 import cred as cred
 import SSMessages_8834 as M
-import json
+from keys import AUTH, TIME
 import numpy as np
 import pandas as pd
 import requests
+from storage import InfluxBackend
+from embeddedstore import EmbeddedStore
+from writebuffer import WriteBuffer
+import writepipeline
+from spool import Spool
+from points import PointBuilder
+from timebase import TimebaseNormaliser
+from scheduler import PollScheduler, SharedPollScheduler
+import sharedstate
+import sdb
+from sdb import SdbDrain, SharedSdbDrain
+from router import MessageRouter, PROTOCOL_1_0, PROTOCOL_1_1
+import handlers
+from normalise import normalise_container
+from responses import ResponseBuilder
+from commandqueue import CommandQueue, ESBOX_ID_PATTERN
+from recentreadings import RecentReadings
+from queryapi import QueryAPI
+import metrics
+import logs
+from logs import fields
+from auth import CredentialStore, Authenticator
+from capabilities import CapabilityCache
+from capture import TrafficCapture
+from httpbody import ESBoxRequest, BodyError, encode_response
 
 SERVER_PORT = 8081
 
+# Logging (see logs.py). Repeated messages are rate limited. DEBUG adds per-request
+# detail, including the whole of any container or message we couldn't handle.
+LOG_LEVEL = "INFO"
+logs.configure(LOG_LEVEL)
+log = logging.getLogger("writetodb")
+
+# Set when we're one of several worker processes started by supervisor.py. Each
+# worker has its own spool and write pipeline, and they share the per-ESBox
+# scheduling state.
+worker = sharedstate.current_worker
+
 
 #---------------------------------------------------------------------------# 
-# setup influxdb client
+# setup the storage backend
 #---------------------------------------------------------------------------# 
 
+# Where readings are stored: "influx" for an InfluxDB server, or "embedded" for
+# the built-in store in EMBEDDED_STORE_DIRECTORY (no database server needed).
+STORAGE_BACKEND = "influx"
+EMBEDDED_STORE_DIRECTORY = "tsdb"
 
-
-influx_client = InfluxDBClient('cred.IP', '8086', 'cred.USER', 'cred.PWD', 'cred.DB')
+if STORAGE_BACKEND == "embedded":
+    storage_backend = EmbeddedStore(sharedstate.worker_directory(EMBEDDED_STORE_DIRECTORY))
+else:
+    storage_backend = InfluxBackend('cred.IP', '8086', 'cred.USER', 'cred.PWD', 'cred.DB')
 #influx_client = DataFrameClient('IP', 'port', 'USER', 'PWD', 'DB')
 
-PROTOCOL_VERSION = "1.1"
-VOLTAGE_ATTR_ID = 57610
+# Points are buffered across messages and ESBoxes and written in bulk when the
+# buffer gets big enough, or every WRITE_BUFFER_MAX_AGE seconds otherwise.
+WRITE_BUFFER_MAX_POINTS = 5000
+WRITE_BUFFER_MAX_BYTES = 1024 * 1024
+WRITE_BUFFER_MAX_AGE = 5 # sec
+
+# The buffer is owned by a writer thread, fed through a bounded queue so that
+# render_PUT never waits on the database. See writepipeline.py for the policies.
+WRITE_QUEUE_MAX_POINTS = 100000
+WRITE_QUEUE_POLICY = writepipeline.SPILL
+
+# Every reading is spooled to disk until it's been written to the database, and
+# replayed from there if the database goes away. See spool.py.
+SPOOL_DIRECTORY = "spool"
+SPOOL_SEGMENT_SIZE = 64 * 1024 * 1024
+SPOOL_FSYNC_INTERVAL = 1 # sec
+
+spool = Spool(sharedstate.worker_directory(SPOOL_DIRECTORY), segment_size=SPOOL_SEGMENT_SIZE, fsync_interval=SPOOL_FSYNC_INTERVAL)
+
+write_buffer = WriteBuffer(storage_backend,
+                           max_points=WRITE_BUFFER_MAX_POINTS,
+                           max_bytes=WRITE_BUFFER_MAX_BYTES,
+                           max_age=WRITE_BUFFER_MAX_AGE)
+
+write_pipeline = writepipeline.WritePipeline(write_buffer,
+                                             spool=spool,
+                                             max_queued_points=WRITE_QUEUE_MAX_POINTS,
+                                             policy=WRITE_QUEUE_POLICY)
+
+# Works out (and remembers) how far each ESBox's clock is from ours
+if worker is None:
+    timebase = TimebaseNormaliser()
+else:
+    timebase = TimebaseNormaliser(offsets=worker.table.field("offset"))
+
+# Decides, per ESBox, when to ask for readings again
+POLL_INTERVAL = 10 # sec
+if worker is None:
+    poll_scheduler = PollScheduler(default_interval=POLL_INTERVAL)
+else:
+    poll_scheduler = SharedPollScheduler(worker.table, default_interval=POLL_INTERVAL)
+
+# What each ESBox supports is negotiated the first time it checks in, and
+# remembered (see capabilities.py)
+if worker is None:
+    capabilities = CapabilityCache()
+else:
+    capabilities = CapabilityCache(protocols=worker.table.field("protocols"),
+                                   container_protocols=worker.table.field("container_protocol"),
+                                   firmware=worker.table.field("firmware"),
+                                   asked=worker.table.field("asked"))
+
+# When set, readings are drained from the stream database of every ESBox that
+# supports protocol 1.1, with delta encoding, instead of being fetched from its
+# latest readings buffer, so nothing reported between polls is lost. Boxes with
+# a backlog are asked for more until it's cleared. Boxes that only support 1.0
+# are always asked for their latest readings, in 1.0.
+USE_STREAM_DATABASE = True
+if worker is None:
+    sdb_drain = SdbDrain()
+else:
+    sdb_drain = SharedSdbDrain(worker.table)
+
+# The last few readings of every meter are kept in memory as well, for anything
+# that wants a meter's current state without asking the database
+RECENT_READINGS_MAX_SERIES = 131072
+RECENT_READINGS_MEMORY = 128 * 1024 * 1024 # bytes
+recent_readings = RecentReadings(RECENT_READINGS_MAX_SERIES, RECENT_READINGS_MEMORY)
+
+# GET requests for meters' current readings are answered from them (see queryapi.py)
+query_api = QueryAPI(recent_readings)
+
+# Commands queued for each ESBox (see commandqueue.py) go out with its next reply,
+# as many as fit
+COMMAND_QUEUE_DIRECTORY = "commands"
+MAX_COMMANDS_PER_RESPONSE = 32
+MAX_RESPONSE_BYTES = 8192
+command_queue = CommandQueue(COMMAND_QUEUE_DIRECTORY)
+
+# When set, every container's Auth field must hold the ESBox's IEEE and the link
+# key registered for it in CREDENTIALS_FILE (see auth.py), or nothing in it is
+# processed and the box is told it's not authenticated
+REQUIRE_AUTHENTICATION = False
+CREDENTIALS_FILE = "credentials"
+authenticator = Authenticator(CredentialStore(CREDENTIALS_FILE))
+
+# When set, every ESBox request and our response to it are captured to
+# CAPTURE_DIRECTORY, for replaying offline with replay.py (see capture.py)
+CAPTURE_TRAFFIC = False
+CAPTURE_DIRECTORY = "capture"
+CAPTURE_SEGMENT_SIZE = 256 * 1024 * 1024 # bytes of traffic before compression
+CAPTURE_FLUSH_INTERVAL = 1 # sec
+if CAPTURE_TRAFFIC:
+    traffic_capture = TrafficCapture(sharedstate.worker_directory(CAPTURE_DIRECTORY), segment_size=CAPTURE_SEGMENT_SIZE)
+    # Request bodies are decoded as they arrive, so their text is only kept when it's wanted
+    ESBoxRequest.keep_text = True
+else:
+    traffic_capture = None
 
-VOLTAGE_ATTR_DIVISOR = 100
+# Counters and histograms for the hot paths are served on /metrics (see metrics.py).
+# Worker processes share theirs through snapshots in METRICS_DIRECTORY.
+METRICS_DIRECTORY = "metrics"
+METRICS_SNAPSHOT_INTERVAL = 5 # sec
+UNKNOWN_PROTOCOL = "unknown"
 
-def generate_container(messages):
-    new_container = {}
-    new_container[M.F.Gen.ProtocolVersion_1_1] = PROTOCOL_VERSION
-    new_container[M.F.Gen.Messages_1_1] = messages
-    return new_container
+request_seconds = metrics.histogram("esco_request_seconds", "Time taken to handle each ESBox request", ("protocol",))
+decode_seconds = metrics.histogram("esco_decode_seconds", "Time taken to decode each container")
+process_seconds = metrics.histogram("esco_process_seconds", "Time taken to process the messages in each container", ("protocol",))
+request_bytes = metrics.counter("esco_request_bytes_total", "Bytes received from ESBoxes, as sent")
+request_decoded_bytes = metrics.counter("esco_request_decoded_bytes_total", "Bytes received from ESBoxes, once decompressed")
+decode_errors = metrics.counter("esco_decode_errors_total", "Requests that weren't valid JSON")
+auth_failures = metrics.counter("esco_auth_failures_total", "Containers rejected because they failed authentication")
+points_built = metrics.counter("esco_points_total", "Points built from ESBox readings")
+metrics.callback("esco_write_queue_points", "Points waiting for the writer thread", lambda: write_pipeline.num_queued_points)
+metrics.callback("esco_points_written_total", "Points written to the storage backend",
+                 lambda: write_pipeline.num_written_points, "counter")
+metrics.callback("esco_points_failed_total", "Points whose write to the storage backend failed",
+                 lambda: write_pipeline.num_failed_points, "counter")
+metrics.callback("esco_points_retried_total", "Points whose write to the storage backend failed again on a retry",
+                 lambda: write_pipeline.num_retried_points, "counter")
+metrics.callback("esco_points_dropped_total", "Points dropped because the write queue was full",
+                 lambda: write_pipeline.num_dropped_points, "counter")
+metrics.callback("esco_points_spilled_total", "Points left in the spool because the write queue was full",
+                 lambda: write_pipeline.num_spilled_points, "counter")
+
+def render_metrics():
+    # This process's metrics, plus the latest snapshots from the other workers
+    if worker is None:
+        return metrics.render([((), metrics.registry.collect())])
+    own_directory = sharedstate.worker_directory(METRICS_DIRECTORY)
+    collections = [([("worker", str(worker.worker_id))], metrics.registry.collect())]
+    for directory_name, collected in metrics.read_snapshots(METRICS_DIRECTORY, exclude=own_directory):
+        collections.append(([("worker", directory_name.replace("worker-", ""))], collected))
+    return metrics.render(collections)
+
+def write_metrics_snapshot():
+    metrics.write_snapshot(sharedstate.worker_directory(METRICS_DIRECTORY), metrics.registry.collect())
+
+PROTOCOL_VERSION = "1.1"
 
 def generate_close_connection():
     new_message = {}
@@ -55,115 +226,122 @@ def generate_get_latest_readings():
     new_message[M.F.Dat.Source] = M.V.Dat.Source.LatestReadings_1_1
     return new_message
 
-def toggle_relay():
+def generate_not_authenticated():
     new_message = {}
-    new_message[M.F.Gen.Cluster_1_1] = M.Clusters_1_1.OnOff
-    new_message[M.F.Gen.MsgID_1_1] = M.OnOff.E.SwitchState
-    new_message[M.F.Nwk.DevIEEE]="001BC502B0102AA3"
-    new_message[M.F.Nwk.EndpointID]=1
-    new_message[M.F.OnOff.Action]=M.V.OnOff.Toggle
+    new_message[M.F.Gen.Cluster_1_1] = M.Clusters_1_1.SS_ESB
+    new_message[M.F.Gen.MsgID_1_1] = M.SS_ESB.E.NotAuthenticated_1_1
     return new_message
 
-def process_data(json_data):
-    # Very basic (and silly) data parser to stoke the fires of industry
-    
-    # First sort the wrapper based on the protocol version
-    if M.F.Gen.ProtocolVersion in json_data:
-        if json_data[M.F.Gen.ProtocolVersion] == "1.0":
-            process_protocol_1_0(json_data)
-        else:
-            print "Invalid or unknown protocol version from ESBox: %s" % json_data[M.F.Gen.ProtocolVersion]
-    elif M.F.Gen.ProtocolVersion_1_1 in json_data:
-        if json_data[M.F.Gen.ProtocolVersion_1_1] == "1.1":
-            #process_protocol_1_1(json_data)
-            process_db(json_data)
-        else:
-            print "Invalid or unknown protocol version from ESBox: %s" % json_data[M.F.Gen.ProtocolVersion_1_1]
-    else:
-        print "Malformed ESBox message wrapper received (no protocol version)"
-        
-def process_protocol_1_0(json_data):
-    if M.F.Gen.ESBoxVersion in json_data:
-        if M.F.Gen.Messages in json_data:
-            for each_message in json_data[M.F.Gen.Messages]:
-                if each_message[M.F.Gen.MsgID] == M.SS_ESB.E.NoFurtherMessages:
-                    print "\tNo further messages."
-                    continue
-                print "Received an unrecognised V1.0 message from the ESBox: %s" % json_data
-        else:
-            # Got a message we don't recognise
-            print "Received an invalid V1.0 message from the ESBox: %s" % json_data
-        
-def process_protocol_1_2(json_data):        
-    if M.F.Gen.ESBoxVersion_1_1 in json_data:
-        print(json_data)
+def generate_get_supported_versions():
+    new_message = {}
+    new_message[M.F.Gen.Cluster_1_1] = M.Clusters_1_1.SS_ESB
+    new_message[M.F.Gen.MsgID_1_1] = M.SS_ESB.E.GetSupportedVersions_1_1
+    return new_message
+
+def generate_close_connection_1_0():
+    new_message = {}
+    new_message[M.F.Gen.Cluster] = M.Clusters.SS_ESB
+    new_message[M.F.Gen.MsgID] = M.SS_ESB.E.CloseConnection
+    return new_message
+
+def generate_get_latest_readings_1_0():
+    new_message = {}
+    new_message[M.F.Gen.Cluster] = M.Clusters.SS_ESB
+    new_message[M.F.Gen.MsgID] = M.SS_ESB.E.GetLatestReadings
+    return new_message
 
+# The responses most check-ins get are encoded once, up front
+responses = ResponseBuilder(PROTOCOL_VERSION)
+CLOSE_CONNECTION = responses.static_message(generate_close_connection())
+GET_LATEST_READINGS = responses.static_message(generate_get_latest_readings())
+NOT_AUTHENTICATED = responses.static_message(generate_not_authenticated())
+GET_SUPPORTED_VERSIONS = responses.static_message(generate_get_supported_versions())
+
+# and for ESBoxes that only support protocol 1.0
+responses_1_0 = ResponseBuilder(PROTOCOL_1_0.version, PROTOCOL_1_0.version_key, PROTOCOL_1_0.messages_key)
+CLOSE_CONNECTION_1_0 = responses_1_0.static_message(generate_close_connection_1_0())
+GET_LATEST_READINGS_1_0 = responses_1_0.static_message(generate_get_latest_readings_1_0())
+
+def encoded_sdb_get_data(esbox_id):
+    # Stream database requests only vary by size, so each size is encoded once too
+    num_cells = sdb_drain.request_cells(esbox_id)
+    return responses.cached(num_cells, sdb.generate_get_data, num_cells, sdb_drain.fifo)
+
+def valid_auth(auth):
+    # An Auth field is [ESBox IEEE, link key]
+    return isinstance(auth, list) and len(auth) == 2 and all(isinstance(each, basestring) for each in auth)
+
+def get_esbox_id(json_data):
+    # ESBoxes identify themselves with their IEEE in the first element of the Auth field.
+    # Anything that isn't an IEEE gets no per-ESBox state.
+    auth = json_data.get(AUTH)
+    if valid_auth(auth) and ESBOX_ID_PATTERN.match(auth[0]):
+        return auth[0]
+    return None
+
+class Container():
+    # Everything the message handlers need to know about the container a message came in
+
+    def __init__(self, json_data, protocol):
+        self.json_data = json_data
+        self.protocol = protocol
+        self.esbox_id = get_esbox_id(json_data)
+        self.sdb_drain = sdb_drain
+        self.receive_time = int(time.time())
+
+        # Convert the ESBox's time base to UTC once for the whole container
+        offset = timebase.container_offset(self.esbox_id, json_data.get(TIME), self.receive_time)
+        self.point_builder = PointBuilder(offset, self.receive_time)
+
+router = MessageRouter()
+# NoFurtherMessages and SendData (see handlers.py)
+handlers.register(router)
+
+@router.handler("1.1", M.SS_ESB.E.SendSupportedVersions_1_1, M.ClusterParts.SS_ESB)
+def handle_supported_versions(message, container):
+    versions = message.get(M.F.Gen.ProtocolVersions_1_1)
+    if not isinstance(versions, list):
+        log.warning("Received an invalid list of supported versions from ESBox %s", container.esbox_id)
+        versions = []
+    capabilities.received_versions(container.esbox_id, versions)
+    log.debug("ESBox %s supports protocol versions %s", container.esbox_id, versions)
+
+def handle_unrecognised_message(message, container):
+    log.warning("Received an unrecognised V%s message from ESBox %s", container.protocol.version, container.esbox_id,
+                extra=fields(msg_id=message.get(container.protocol.msg_id_key)))
+    log.debug("Unrecognised message: %s", message)
+
+router.unrecognised_handler = handle_unrecognised_message
+
+def process_data(json_data, esbox_id=None):
+    # Work out which protocol version the wrapper uses, then hand each message to its handler.
+    # Returns the protocol, or None if the container isn't valid.
+    protocol = capabilities.container_protocol(esbox_id, json_data)
+    if protocol is None:
+        log.warning("Malformed ESBox message wrapper received (missing or unknown protocol version)")
+        log.debug("Malformed container: %s", json_data)
+        return None
+    if protocol.esbox_version_key not in json_data or protocol.messages_key not in json_data:
+        log.warning("Received an invalid V%s container (no ESBox version or messages)", protocol.version)
+        log.debug("Invalid container: %s", json_data)
+        return None
+    if esbox_id is not None:
+        capabilities.check_firmware(esbox_id, json_data[protocol.esbox_version_key])
+
+    if protocol is PROTOCOL_1_0:
+        # Older firmware. Its containers are rewritten in the 1.1 shape and handled like any other.
+        json_data = normalise_container(json_data)
+        container = Container(json_data, PROTOCOL_1_1)
     else:
-            # Got a message we don't recognise
-        print "Received an invalid V1.1 message from the ESBox: %s" % json_data
-            
-def process_protocol_1_1(json_data):        
-    if M.F.Gen.ESBoxVersion_1_1 in json_data:
-        if M.F.Gen.Messages_1_1 in json_data:
-            for each_message in json_data[M.F.Gen.Messages_1_1]:
-                if each_message[M.F.Gen.MsgID_1_1] == M.SS_ESB.E.NoFurtherMessages_1_1:
-                    continue
-                if (each_message[M.F.Gen.MsgID_1_1] == M.SS_ESB.E.SendData):
-                    if each_message[M.F.Dat.Source] == M.V.Dat.Source.LatestReadings_1_1:
-                        for each_han_endpoint in each_message[M.F.Dat.Data_1_1]:
-                            
-                            this_node_ieee = each_han_endpoint[M.F.Nwk.HAN_1_1]
-                            this_endpoint_id = each_han_endpoint[M.F.Nwk.EndpointID_1_1]
-                           
-                            for each_cluster in each_han_endpoint[M.F.Dat.Clusters_1_1]:
-                                if each_cluster[M.F.Gen.Cluster_1_1] == M.Clusters_1_1.SM:  # Is this data from the simple metering cluster?
-                                    for each_attr in each_cluster[M.F.Dat.Attributes_1_1]:                                   
-                                        if each_attr[M.F.Dat.AttributeID_1_1] == VOLTAGE_ATTR_ID:
-                                            continue
-                                        #if each_attr[M.F.Dat.AttributeID_1_1] == CURRENT_ATTR_ID:
-                                        #    print "\t\t %s  " % (this_node_ieee) + str(float(each_attr[M.F.Dat.Data_1_1])/CURRENT_ATTR_DIVISOR)
-                    continue   
-                print "Received an unrecognised V1.1 message from the ESBox: %s" % json_data
-        else:
-            print "Received an invalid V1.1 message from the ESBox: %s" % json_data
-
-def process_db(json_data):
-    read_time = datetime.utcnow()
-    if M.F.Gen.ESBoxVersion_1_1 in json_data:
-        if M.F.Gen.Messages_1_1 in json_data:
-            for each_message in json_data[M.F.Gen.Messages_1_1]:
-                if each_message[M.F.Gen.MsgID_1_1] == M.SS_ESB.E.NoFurtherMessages_1_1:
-                    continue
-                if (each_message[M.F.Gen.MsgID_1_1] == M.SS_ESB.E.SendData):
-                    if each_message[M.F.Dat.Source] == M.V.Dat.Source.LatestReadings_1_1:
-                        for each_han_endpoint in each_message[M.F.Dat.Data_1_1]:
-                            this_node_ieee = each_han_endpoint[M.F.Nwk.HAN_1_1]
-                            for each_cluster in each_han_endpoint[M.F.Dat.Clusters_1_1]:
-                                if each_cluster[M.F.Gen.Cluster_1_1] == M.Clusters_1_1.SM:  # Is this data from the simple metering cluster?
-                                    for each_attr in each_cluster[M.F.Dat.Attributes_1_1]:
-
-                                        send_points = [
-                                            {
-                                                "measurement": "readings",
-                                                "tags": {
-                                                    "ieee": str(each_han_endpoint[M.F.Nwk.HAN_1_1]),
-                                                },
-                                                "time": int(time.time()),
-                                                "fields": {
-                                                    "ieee": str(each_han_endpoint[M.F.Nwk.HAN_1_1]),
-                                                    str(each_attr[M.F.Dat.AttributeID_1_1]): int(each_attr[M.F.Dat.Data_1_1])
-                                                }
-                                            }
-                                        ]
-                                        
-                                        
-                                        influx_client.write_points(send_points, time_precision='s')
-                                        print "reading submited"
-                    continue   
-                print
-        else:
-            print
+        container = Container(json_data, protocol)
+    router.route(container.protocol, json_data[container.protocol.messages_key], container)
 
+    # Hand everything from this container to the writer thread in one go
+    points = container.point_builder.finish()
+    points_built.inc(amount=len(points))
+    recent_readings.add_points(points, container.esbox_id)
+    write_pipeline.put(points)
+    return protocol
 
 
 
@@ -171,52 +349,186 @@ class TestServer(resource.Resource):
     isLeaf = True
     
     num_get_requests = 0
-    time_of_last_readings = time.time()-10
     
     def render_GET(self, request):
+        if request.path == "/metrics":
+            request.setHeader("content-type", "text/plain; version=0.0.4")
+            return render_metrics()
+
+        body = query_api.render(request)
+        if body is not None:
+            return body
+
         #self.numberGETRequests += 1
         request.setHeader("content-type", "text/plain")
-        print "Have been visited by a web browser " + str(self.num_get_requests) + " times!"
+        log.debug("Have been visited by a web browser %d times!", self.num_get_requests)
         return "Hello there! You're not an ESBox!\n"
     
     def render_PUT(self, request):
         
        # print "\n"
         
-        # Read the content of the PUT request
-        data = request.content.read()
+        start = time.time()
+
+        # The content of the PUT request has been decompressed and decoded as it arrived (see httpbody.py)
+        body = request.content
+        request_bytes.inc(amount=body.num_wire_bytes)
+        request_decoded_bytes.inc(amount=body.num_bytes)
+        response = self.respond_to_esbox(request, body, start)
+        if isinstance(response, defer.Deferred):
+            # Waiting on a thread
+            response.addErrback(self.response_failed, request)
+            response.addCallback(lambda response: request.send(self.encoded_response(request, body, start, response)))
+            return server.NOT_DONE_YET
+        return self.encoded_response(request, body, start, response)
+
+    def encoded_response(self, request, body, start, response):
+        if traffic_capture is not None:
+            traffic_capture.record(start, time.time() - start, body.text(), response)
+        return encode_response(request, response)
+
+    def response_failed(self, failure, request):
+        log.warning("Couldn't respond to an ESBox: %s", failure.getErrorMessage())
+        request.setResponseCode(500)
+        return ""
+
+    def respond_to_esbox(self, request, body, start):
+        # Returns the response to a container, or a Deferred that fires with it
         
         # We'll try to decode JSON sent by the ESBox here
         try:
-            decoded_json = json.loads(data)            
+            decoded_json = body.container()
             # Send it elsewhere for processing          
+        except BodyError as e:
+            log.warning("Couldn't receive a container from an ESBox: %s", e)
+            decode_errors.inc()
+            request.setResponseCode(e.code)
+            return ""
         except:
-          #  print "Couldn't decode valid JSON from the ESBox message wrapper :("
+            log.warning("Couldn't decode valid JSON from the ESBox message wrapper")
+            decode_errors.inc()
             return
-         
-        process_data(decoded_json)
-     
+        decode_seconds.observe(time.time() - start)
+
         # Prepare the response message and container for the ESBox
         request.setHeader("content-type", "application/json")
+
+        if not isinstance(decoded_json, dict):
+            log.warning("Malformed ESBox message wrapper received (not a JSON object)")
+            log.debug("Malformed container: %s", decoded_json)
+            return responses.container([CLOSE_CONNECTION])
+        auth = decoded_json.get(AUTH)
+        if auth is not None and not valid_auth(auth):
+            log.warning("Malformed ESBox message wrapper received (Auth isn't an ESBox IEEE and link key)")
+            log.debug("Malformed container: %s", decoded_json)
+            return responses.container([CLOSE_CONNECTION])
+
+        if not REQUIRE_AUTHENTICATION:
+            return self.respond_to_container(request, decoded_json, True, start)
+        # Verified link keys are cached, so this is normally a dict lookup. Otherwise the key is
+        # hashed, which is slow by design, so it's done in a thread.
+        verified = authenticator.cached(auth)
+        if verified is None:
+            verifying = threads.deferToThread(authenticator.verify, auth)
+            verifying.addCallback(lambda verified: self.respond_to_container(request, decoded_json, verified, start))
+            return verifying
+        return self.respond_to_container(request, decoded_json, verified, start)
+
+    def respond_to_container(self, request, decoded_json, verified, start):
+        # Returns the response to a well formed container, or a Deferred that fires with it
+        if not verified:
+            auth = decoded_json.get(AUTH)
+            log.warning("Rejected a container from ESBox %s that failed authentication",
+                        auth[0] if auth is not None else None)
+            auth_failures.inc()
+            return responses.container([NOT_AUTHENTICATED])
+
+        esbox_id = get_esbox_id(decoded_json)
+        process_start = time.time()
+        protocol = process_data(decoded_json, esbox_id)
+        protocol_version = protocol.version if protocol is not None else UNKNOWN_PROTOCOL
+        process_seconds.observe(time.time() - process_start, (protocol_version,))
         
-        # For now we're just going to see if it's been more than 10 seconds since we last requested latest readings, and if so we'll send a 
-        # GetData message and ask for the latest readings. Otherwise, we'll just close the connection.
-        if time.time() - self.time_of_last_readings > 10:
+        # If it's been long enough since we last requested this ESBox's latest readings send a GetData message and ask
+        # for them, along with any commands waiting for it. If there's nothing to send, we'll just close the connection.
+        fetch_readings = poll_scheduler.check_in(esbox_id)
+        versions = capabilities.supported_versions(esbox_id)
+        if versions is not None and PROTOCOL_1_1.version not in versions:
+            # A 1.0-only ESBox. Commands are 1.1 messages, so they stay queued.
+            request_seconds.observe(time.time() - start, (protocol_version,))
+            return responses_1_0.container([GET_LATEST_READINGS_1_0 if fetch_readings else CLOSE_CONNECTION_1_0])
+
+        response_messages = []
+        if capabilities.should_ask(esbox_id):
+            response_messages.append(GET_SUPPORTED_VERSIONS)
+        if sdb_drain.has_backlog(esbox_id):
+            # The last batch of stream database cells filled the request, so go straight back for more
+            response_messages.append(encoded_sdb_get_data(esbox_id))
+        elif fetch_readings and USE_STREAM_DATABASE and versions is not None:
+            response_messages.append(encoded_sdb_get_data(esbox_id))
+        elif fetch_readings:
 #            print "Requesting latest readings."
-            response_message = generate_get_latest_readings()
-            #print "Toggle device relay."
-            #esponse_message = toggle_relay()
-            self.time_of_last_readings = time.time()
-        else:
-#            print "Closing connection to ESBox."
-            response_message = generate_close_connection()
-        response_container = generate_container( [response_message] )
-        
-        return json.dumps(response_container)
+            response_messages.append(GET_LATEST_READINGS)
 
+        if not command_queue.has_commands(esbox_id):
+            return reply(esbox_id, response_messages, [], None, start, protocol_version)
 
+        # Taking commands leases them in the queue file, so it's done in a thread. Watch for the
+        # request finishing from now, in case the connection goes while they're being taken.
+        finished = request.notifyFinish()
+        taking = threads.deferToThread(command_queue.take, esbox_id, MAX_COMMANDS_PER_RESPONSE,
+                                       MAX_RESPONSE_BYTES - sum(map(len, response_messages)))
+        taking.addErrback(command_queue_failed, esbox_id)
+        taking.addCallback(lambda commands: reply(esbox_id, response_messages, commands, finished, start, protocol_version))
+        return taking
 
+def command_queue_failed(failure, esbox_id):
+    log.warning("Couldn't update the command queue for ESBox %s: %s", esbox_id, failure.getErrorMessage())
+    return []
 
-    
-reactor.listenTCP(SERVER_PORT, server.Site(TestServer()))
-reactor.run()
+def reply(esbox_id, response_messages, commands, finished, start, protocol_version):
+    # Returns the response container, with any commands taken for it
+    if commands:
+        response_messages.extend(encoded for command_id, encoded in commands)
+        # Only drop the commands from the queue once the reply has made it to the box. Both write
+        # the queue file, so keep them off the reactor thread.
+        command_ids = [command_id for command_id, encoded in commands]
+        finished.addCallbacks(lambda result: threads.deferToThread(command_queue.acknowledge, esbox_id, command_ids),
+                              lambda failure: threads.deferToThread(command_queue.release, esbox_id, command_ids))
+        finished.addErrback(command_queue_failed, esbox_id)
+    elif finished is not None:
+        # Nothing to do however the request ends
+        finished.addErrback(lambda failure: None)
+    if not response_messages:
+#        print "Closing connection to ESBox."
+        response_messages.append(CLOSE_CONNECTION)
+
+    request_seconds.observe(time.time() - start, (protocol_version,))
+    return responses.container(response_messages)
+
+
+
+
+
+def run_server(listening_socket=None):
+    # Serve ESBoxes on SERVER_PORT, or on a socket that's already listening (see supervisor.py)
+    reactor.callWhenRunning(write_pipeline.start)
+    reactor.addSystemEventTrigger('before', 'shutdown', write_pipeline.stop)
+    reactor.addSystemEventTrigger('after', 'shutdown', storage_backend.close)
+    if worker is not None:
+        reactor.callWhenRunning(LoopingCall(write_metrics_snapshot).start, METRICS_SNAPSHOT_INTERVAL, now=False)
+    if traffic_capture is not None:
+        reactor.callWhenRunning(LoopingCall(traffic_capture.flush).start, CAPTURE_FLUSH_INTERVAL, now=False)
+        reactor.addSystemEventTrigger('after', 'shutdown', traffic_capture.close)
+
+    site = server.Site(TestServer(), requestFactory=ESBoxRequest)
+    if listening_socket is None:
+        reactor.listenTCP(SERVER_PORT, site)
+    else:
+        reactor.adoptStreamPort(listening_socket.fileno(), listening_socket.family, site)
+        # The reactor has its own copy of the socket now
+        listening_socket.close()
+    reactor.run()
+
+if __name__ == '__main__':
+    run_server()